@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import copy, re
+from concurrent.futures import ProcessPoolExecutor
+
+from anki.consts import MODEL_CLOZE
+from anki.utils import splitFields
+
+"""
+Card generation over many notes at once.
+
+Which templates of a note produce cards depends only on the note's fields
+and its note type's requirements, so the check is done by plain functions
+over picklable (mid, flds) rows, which can be handed to worker processes.
+Notes are streamed in batches, and the ordinals found for each note are
+remembered along with the note's mod time, so a later scan only loads and
+re-checks the notes edited since. As mod times are in seconds, temp triggers
+also record the notes written to, so an edit made in the same second as a
+scan isn't missed, and notes whose cards were added, removed or moved, so
+notes found in order last time don't need their cards looked at again.
+Results for a note type are dropped when its requirements change.
+"""
+
+# Template requirements
+##########################################################################
+
+def availStdOrds(req, flds):
+    "Ordinals of a standard note type's REQ satisfied by joined FLDS."
+    fields = [f.strip() for f in splitFields(flds)]
+    avail = []
+    for ord, type, idxs in req:
+        # AND requirement?
+        if type == "all":
+            for idx in idxs:
+                if not fields[idx]:
+                    # missing and was required
+                    break
+            else:
+                avail.append(ord)
+        # OR requirement?
+        elif type == "any":
+            for idx in idxs:
+                if fields[idx]:
+                    avail.append(ord)
+                    break
+        # else unsatisfiable template
+    return avail
+
+def availClozeOrds(fieldOrds, flds, allowEmpty=True):
+    "Cloze ordinals used in the fields at FIELDORDS of joined FLDS."
+    sflds = splitFields(flds)
+    ords = set()
+    for ord in fieldOrds:
+        ords.update([int(m)-1 for m in re.findall(
+            r"(?s){{c(\d+)::.+?}}", sflds[ord])])
+    if -1 in ords:
+        ords.remove(-1)
+    if not ords and allowEmpty:
+        # empty clozes use first ord
+        return [0]
+    return list(ords)
+
+def clozeFieldOrds(m):
+    "Ords of the fields cloze note type M's template uses in cloze tags."
+    map = dict((f['name'], f['ord']) for f in m['flds'])
+    ords = []
+    matches = re.findall("{{[^}]*?cloze:(?:[^}]?:)*(.+?)}}", m['tmpls'][0]['qfmt'])
+    matches += re.findall("<%cloze:(.+?)%>", m['tmpls'][0]['qfmt'])
+    for fname in matches:
+        if fname in map:
+            ords.append(map[fname])
+    return ords
+
+def availOrds(spec, flds):
+    "Ordinals available to joined FLDS, given a note type's genSpec()."
+    type, data = spec
+    if type == MODEL_CLOZE:
+        return availClozeOrds(data, flds)
+    return availStdOrds(data, flds)
+
+def _availBatch(specs, rows):
+    # run in worker processes, so must stay at module level
+    return [(nid, availOrds(specs[mid], flds)) for nid, mid, flds in rows]
+
+# Scanning
+##########################################################################
+
+class CardGenerator:
+
+    batchSize = 1000
+    # rows sent to a worker process at a time
+    chunkSize = 5000
+
+    def __init__(self, col):
+        self.col = col
+        # nid -> (mod, mid, ords, whether its cards matched)
+        self._avail = {}
+        # mid -> genSpec() the results were found with
+        self._specs = {}
+        # the connection our triggers are installed on
+        self._db = None
+
+    def scan(self, mids=None, workers=0):
+        """Yield (nids, missing, empty) for each batch of notes.
+
+MISSING lists (nid, ord) for cards the note's templates call for but that
+don't exist, and EMPTY the ids of cards whose templates are now blank. Limit
+to note types MIDS if given. With WORKERS, note fields are checked across
+that many processes."""
+        pool = ProcessPoolExecutor(workers) if workers else None
+        try:
+            yield from self._scan(mids, pool, workers)
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def generate(self, mids=None, workers=0, progress=None):
+        """Add any missing cards, and return the ids of empty ones.
+PROGRESS is called with the number of notes checked after each batch."""
+        rem = []
+        done = 0
+        for nids, missing, empty in self.scan(mids, workers):
+            if missing:
+                self.col.genCards(list(set(nid for nid, ord in missing)))
+            rem.extend(empty)
+            done += len(nids)
+            if progress:
+                progress(done)
+        return rem
+
+    def reset(self):
+        "Forget remembered results, so every note is checked next time."
+        self._avail = {}
+        self._specs = {}
+        # a rollback may have discarded the trigger too
+        self._db = None
+
+    def _track(self):
+        "Drop results for notes written to since the last scan."
+        db = self.col.db
+        mod = db.mod
+        if self._db is not db:
+            # new connection; temp tables and triggers need recreating
+            self.reset()
+            db.execute(
+                "create temp table if not exists gendirty "
+                "(id integer primary key)")
+            for name, event, nid in (
+                    ("notes_ins", "insert on notes", "new.id"),
+                    ("notes_upd", "update of mid, flds on notes", "new.id"),
+                    ("cards_ins", "insert on cards", "new.nid"),
+                    ("cards_upd", "update of nid, ord on cards", "old.nid"),
+                    ("cards_upd2", "update of nid, ord on cards", "new.nid"),
+                    ("cards_del", "delete on cards", "old.nid")):
+                db.execute("""
+create temp trigger if not exists gendirty_%s after %s begin
+insert or ignore into gendirty values (%s); end""" % (name, event, nid))
+            self._db = db
+        for nid in db.list("select id from temp.gendirty"):
+            self._avail.pop(nid, None)
+        db.execute("delete from temp.gendirty")
+        db.mod = mod
+
+    def _scan(self, mids, pool, workers):
+        db = self.col.db
+        self._track()
+        # ids may be stored as strings in the registry
+        if mids is not None:
+            mids = set(int(mid) for mid in mids)
+        models = dict((int(m['id']), m) for m in self.col.models.all()
+                      if mids is None or int(m['id']) in mids)
+        if not models:
+            return
+        specs = dict((mid, self.col.models.genSpec(m))
+                     for mid, m in models.items())
+        changed = set(mid for mid, spec in specs.items()
+                      if self._specs.get(mid) != spec)
+        if changed:
+            self._avail = dict(
+                (nid, ent) for nid, ent in self._avail.items()
+                if ent[1] not in changed)
+            for mid in changed:
+                self._specs[mid] = copy.deepcopy(specs[mid])
+        sql = "select id, mid, mod from notes"
+        if mids is not None:
+            sql += " where mid in (%s)" % ",".join(str(m) for m in models)
+        sql += " order by id"
+        # with a pool, hand each worker a decent share of the batch
+        size = max(self.batchSize, self.chunkSize*workers)
+        batch = []
+        for row in db.iterate(sql, batch=size):
+            batch.append(row)
+            if len(batch) == size:
+                yield self._check(batch, specs, pool)
+                batch = []
+        if batch:
+            yield self._check(batch, specs, pool)
+
+    def _check(self, rows, specs, pool):
+        db = self.col.db
+        cache = self._avail
+        nids = []
+        stale = []
+        check = []
+        for nid, mid, mod in rows:
+            nids.append(nid)
+            ent = cache.get(nid)
+            if not ent or ent[0] != mod or ent[1] != mid:
+                stale.append(nid)
+                check.append(nid)
+            elif not ent[3]:
+                check.append(nid)
+        if stale:
+            data = [r for r in self._select(
+                "select id, mid, mod, flds from notes where id %s",
+                nids, stale) if r[1] in specs]
+            avail = self._availFor(
+                [(nid, mid, flds) for nid, mid, mod, flds in data],
+                specs, pool)
+            for (nid, mid, mod, flds), (nid, ords) in zip(data, avail):
+                cache[nid] = (mod, mid, frozenset(ords), False)
+        missing = []
+        empty = []
+        if not check:
+            return nids, missing, empty
+        # compare with the cards that exist
+        have = {}
+        for cid, nid, ord in self._select(
+                "select id, nid, ord from cards where nid %s", nids, check):
+            have.setdefault(nid, {})[ord] = cid
+        for nid in check:
+            if nid not in cache:
+                # removed since, or its note type is missing
+                continue
+            mod, mid, ords, settled = cache[nid]
+            cards = have.get(nid, {})
+            if cards.keys() != ords:
+                for ord in ords:
+                    if ord not in cards:
+                        missing.append((nid, ord))
+                for ord, cid in cards.items():
+                    if ord not in ords:
+                        empty.append(cid)
+            else:
+                # nothing to do until the note or its cards change
+                cache[nid] = (mod, mid, ords, True)
+        return nids, missing, empty
+
+    def _select(self, sql, nids, subset):
+        """Rows of SQL for SUBSET of the batch NIDS. If that's the whole
+batch, the ids are in order, so a range is cheaper than binding them; it
+may also pick up notes of other note types."""
+        db = self.col.db
+        if len(subset) == len(nids):
+            return db.all(sql % "between ? and ?", nids[0], nids[-1])
+        with db.boundIds(subset) as sids:
+            return db.all(sql % ("in " + sids))
+
+    def _availFor(self, rows, specs, pool):
+        if not pool or len(rows) <= self.chunkSize:
+            return _availBatch(specs, rows)
+        chunks = [rows[i:i+self.chunkSize]
+                  for i in range(0, len(rows), self.chunkSize)]
+        res = []
+        for part in pool.map(_availBatch, [specs]*len(chunks), chunks):
+            res.extend(part)
+        return res
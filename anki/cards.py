@@ -21,12 +21,27 @@ from anki.consts import *
 
 class Card:
 
-    def __init__(self, col, id=None):
+    # the columns of the cards table, in order
+    columns = ("id", "nid", "did", "ord", "mod", "usn", "type", "queue", "due",
+               "ivl", "factor", "reps", "lapses", "left", "odue", "odid",
+               "flags", "data")
+
+    # slots, as the browser and exporters may hold many cards at once.
+    # lastIvl and wasNew are set by the scheduler; __dict__ is kept for
+    # attributes add-ons set.
+    __slots__ = columns + ("col", "crt", "timerStarted", "_qa", "_qaText",
+                           "_note", "lastIvl", "wasNew", "__dict__")
+
+    def __init__(self, col, id=None, row=None):
+        "Load card ID, or a row of the cards table, or create a new card."
         self.col = col
         self.timerStarted = None
         self._qa = None
+        self._qaText = None
         self._note = None
-        if id:
+        if row:
+            self._setRow(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -47,6 +62,13 @@ class Card:
             self.data = ""
 
     def load(self):
+        self._setRow(self.col.db.first(
+            "select * from cards where id = ?", self.id))
+        self._qa = None
+        self._qaText = None
+        self._note = None
+
+    def _setRow(self, row):
         (self.id,
          self.nid,
          self.did,
@@ -64,10 +86,7 @@ class Card:
          self.odue,
          self.odid,
          self.flags,
-         self.data) = self.col.db.first(
-             "select * from cards where id = ?", self.id)
-        self._qa = None
-        self._note = None
+         self.data) = row
 
     def flush(self):
         self.mod = intTime()
@@ -116,17 +135,22 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             self.left, self.odue, self.odid, self.did, self.id)
         self.col.log(self)
 
-    def q(self, reload=False, browser=False):
+    def q(self, reload=False, browser=False, textOnly=False):
+        if textOnly:
+            return self._getQA(reload, browser, True)['q']
         return self.css() + self._getQA(reload, browser)['q']
 
-    def a(self):
+    def a(self, textOnly=False):
+        if textOnly:
+            return self._getQA(textOnly=True)['a']
         return self.css() + self._getQA()['a']
 
     def css(self):
         return "<style>%s</style>" % self.model()['css']
 
-    def _getQA(self, reload=False, browser=False):
-        if not self._qa or reload:
+    def _getQA(self, reload=False, browser=False, textOnly=False):
+        qa = self._qaText if textOnly else self._qa
+        if not qa or reload:
             f = self.note(reload); m = self.model(); t = self.template()
             data = [self.id, f.id, m['id'], self.odid or self.did, self.ord,
                     f.stringTags(), f.joinedFields(), self.flags]
@@ -134,8 +158,12 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
                 args = (t.get('bqfmt'), t.get('bafmt'))
             else:
                 args = tuple()
-            self._qa = self.col._renderQA(data, *args)
-        return self._qa
+            qa = self.col.qaCache.render(data, *args, textOnly=textOnly)
+            if textOnly:
+                self._qaText = qa
+            else:
+                self._qa = qa
+        return qa
 
     def note(self, reload=False):
         if not self._note or reload:
@@ -176,12 +204,9 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             return True
 
     def __repr__(self):
-        d = dict(self.__dict__)
-        # remove non-useful elements
-        del d['_note']
-        del d['_qa']
-        del d['col']
-        del d['timerStarted']
+        # only the useful elements
+        d = dict((k, getattr(self, k)) for k in self.columns
+                 if hasattr(self, k))
         return pprint.pformat(d, width=300)
 
     def userFlag(self):
@@ -7,12 +7,12 @@ import re
 import time
 import os
 import random
-import stat
 import datetime
 import copy
 import traceback
+from contextlib import contextmanager
 
-from anki.lang import _, ngettext
+from anki.lang import _
 from anki.utils import ids2str, fieldChecksum, stripHTML, \
     intTime, splitFields, joinFields, maxID, json, devMode, stripHTMLMedia
 from anki.hooks import  runFilter, runHook
@@ -20,13 +20,18 @@ from anki.models import ModelManager
 from anki.media import MediaManager
 from anki.decks import DeckManager
 from anki.tags import TagManager
+from anki.indexes import IndexManager
+from anki.complete import CompletionManager
+from anki.cardgen import CardGenerator
+from anki.dbcheck import DBChecker
+from anki.qacache import QACache
+from anki.render import Renderer, renderCard, flagName
+from anki.undo import UndoJournal
 from anki.consts import *
 from anki.errors import AnkiError
-from anki.sound import stripSounds
 import anki.latex # sets up hook
 import anki.cards
 import anki.notes
-import anki.template
 import anki.find
 
 
@@ -58,13 +63,27 @@ class _Collection:
         self._openLog()
         self.log(self.path, anki.version)
         self.server = server
+        # set by storage.Collection
+        self.tuning = None
+        self.pragmas = {}
+        self.journalMode = None
+        self.readPool = None
+        # pool size, so reopen() can open the readers again
+        self._readers = 0
         self._lastSave = time.time()
-        self.clearUndo()
+        self.undoJournal = UndoJournal(self)
         self.media = MediaManager(self, server)
+        self.completion = CompletionManager(self)
+        self.cardgen = CardGenerator(self)
+        self.dbcheck = DBChecker(self)
+        self.qaCache = QACache(self)
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
         self.tags = TagManager(self)
+        self.find = anki.find.Finder(self)
+        self.indexes = IndexManager(self)
         self.load()
+        self.indexes.connect()
         if not self.crt:
             d = datetime.datetime.today()
             d -= datetime.timedelta(hours=4)
@@ -169,7 +188,9 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         self.tags.flush()
         # and flush deck + bump mod if db has been changed
         if self.db.mod:
+            self.find.updateMaterialized()
             self.flush(mod=mod)
+            self.indexes.flush()
             self.db.commit()
             self.lock()
             self.db.mod = False
@@ -195,6 +216,7 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
                 self.save()
             else:
                 self.db.rollback()
+            self.closeReaders(keep=True)
             if not self.server:
                 self.db.setAutocommit(True)
                 self.db.execute("pragma journal_mode = delete")
@@ -209,14 +231,65 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         import anki.db
         if not self.db:
             self.db = anki.db.DB(self.path)
+            self.db.setPragmas(self.pragmas)
+            if self.journalMode and not self.server:
+                # close() went back to the default journal
+                self.db.setAutocommit(True)
+                self.db.execute("pragma journal_mode = %s" % self.journalMode)
+                self.db.setAutocommit(False)
+            self.indexes.connect()
             self.media.connect()
             self._openLog()
+            if self._readers:
+                self.openReaders(self._readers)
 
     def rollback(self):
         self.db.rollback()
+        # results remembered since may no longer hold
+        self.cardgen.reset()
+        self.clearUndo()
         self.load()
         self.lock()
 
+    # Read-only connections
+    ##########################################################################
+
+    def openReaders(self, size=2):
+        "Open a pool of read-only connections. Requires WAL mode."
+        import anki.db
+        self.closeReaders()
+        self._readers = size
+        if self.db.scalar("pragma journal_mode") != "wal":
+            # readers would block the writer and vice versa
+            return
+        # synchronous has no effect on a read-only connection
+        pragmas = dict((k, v) for k, v in self.pragmas.items()
+                       if k != "synchronous")
+        self.readPool = anki.db.ReadPool(
+            self.path, size, pragmas=pragmas,
+            attach=self.indexes.attachments())
+
+    def closeReaders(self, keep=False):
+        "Unless KEEP, reopen() won't open them again."
+        if not keep:
+            self._readers = 0
+        if self.readPool:
+            self.readPool.close()
+            self.readPool = None
+
+    @contextmanager
+    def reader(self):
+        """Yield a DB for read-only queries, eg from a worker thread.
+
+Pooled readers only see committed data, so call save() first if the reads
+need to include recent changes. Without a pool the main connection is
+yielded, which must not be used off the main thread."""
+        if not self.readPool:
+            yield self.db
+            return
+        with self.readPool.reader() as db:
+            yield db
+
     def modSchema(self, check):
         "Mark schema modified. Call this first so user can abort if necessary."
         if not self.schemaChanged():
@@ -260,6 +333,36 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     def getNote(self, id):
         return anki.notes.Note(self, id=id)
 
+    def getCards(self, ids, notes=False):
+        """Return the cards with IDS, loaded with a single query. They're in
+the same order as IDS, and ids that don't exist are skipped. If NOTES is
+true, their notes are loaded too."""
+        with self.db.boundIds(ids) as sids:
+            cmap = dict((row[0], anki.cards.Card(self, row=row))
+                        for row in self.db.execute(
+                            "select * from cards where id in " + sids))
+        cards = [cmap[id] for id in ids if id in cmap]
+        if notes:
+            nmap = dict((n.id, n) for n in self.getNotes(
+                list(set(c.nid for c in cards))))
+            for c in cards:
+                c._note = nmap.get(c.nid)
+        return cards
+
+    def getNotes(self, ids):
+        """Return the notes with IDS, loaded with a single query. They're in
+the same order as IDS, and ids that don't exist are skipped."""
+        nmap = {}
+        fmaps = {}
+        with self.db.boundIds(ids) as sids:
+            for row in self.db.execute("select %s from notes where id in %s" % (
+                    anki.notes.Note.loadColumns, sids)):
+                note = anki.notes.Note(self, row=row)
+                # notes of the same model can share a field map
+                note._fmap = fmaps.setdefault(note.mid, note._fmap)
+                nmap[note.id] = note
+        return [nmap[id] for id in ids if id in nmap]
+
     # Utils
     ##########################################################################
 
@@ -307,20 +410,97 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             ncards += 1
         return ncards
 
+    def addNotes(self, notes):
+        """Add NOTES in bulk, as addNote() would one at a time. Notes that
+wouldn't generate any cards are skipped. The added notes and their cards are
+given new ids in a single range. Return the number of new cards."""
+        now = intTime()
+        usn = self.usn()
+        nrows = []
+        crows = []
+        tags = set()
+        for note in notes:
+            assert note.scm == self.scm
+            cms = self.findTemplates(note)
+            if not cms:
+                continue
+            model = note.model()
+            note.mod = now
+            note.usn = usn
+            nrows.append(note)
+            tags.update(note.tags)
+            # deck conf governs which of these are used
+            due = self.nextID("pos")
+            for template in cms:
+                did = self._newCardDid(model, template)
+                crows.append((note, did, template['ord'],
+                              self._dueForDid(did, due)))
+        if not nrows:
+            return 0
+        ts = maxID(self.db)
+        for note in nrows:
+            note.id = ts
+            ts += 1
+        self.db.executemany("""
+insert into notes values (?,?,?,?,?,?,?,?,?,?,?)""", (
+            (n.id, n.guid, n.mid, now, usn, n.stringTags(), n.joinedFields(),
+             stripHTMLMedia(n.fields[self.models.sortIdx(n.model())]),
+             fieldChecksum(n.fields[0]), n.flags, n.data) for n in nrows))
+        self.db.executemany("""
+insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""", (
+            (ts + c, note.id, did, ord, now, usn, due)
+            for c, (note, did, ord, due) in enumerate(crows)))
+        self.tags.register(tags)
+        return len(crows)
+
+    def updateNotes(self, notes):
+        """Write changes to the fields and tags of existing NOTES in bulk, as
+note.flush() would one at a time, updating their field caches and generating
+any missing cards once for the batch. Return the number of notes changed."""
+        with self.db.boundIds([n.id for n in notes]) as sids:
+            old = dict((id, (tags, flds)) for id, tags, flds in self.db.execute(
+                "select id, tags, flds from notes where id in " + sids))
+        now = intTime()
+        usn = self.usn()
+        rows = []
+        tags = set()
+        for note in notes:
+            assert note.scm == self.scm
+            data = (note.stringTags(), note.joinedFields())
+            if old.get(note.id, data) == data:
+                # unchanged, or not in the collection
+                continue
+            note.mod = now
+            note.usn = usn
+            rows.append((note.guid, note.mid, now, usn) + data + (
+                note.flags, note.data, note.id))
+            tags.update(note.tags)
+        if not rows:
+            return 0
+        self.db.executemany("""
+update notes set guid=?, mid=?, mod=?, usn=?, tags=?, flds=?, flags=?, data=?
+where id=?""", rows)
+        nids = [r[-1] for r in rows]
+        self.updateFieldCache(nids)
+        self.genCards(nids)
+        self.tags.register(tags)
+        return len(rows)
+
     def remNotes(self, ids):
-        self.remCards(self.db.list("select id from cards where nid in "+
-                                   ids2str(ids)))
+        with self.db.boundIds(ids) as sids:
+            cids = self.db.list("select id from cards where nid in "+sids)
+        self.remCards(cids)
 
     def _remNotes(self, ids):
         "Bulk delete notes by ID. Don't call this directly."
         if not ids:
             return
-        strids = ids2str(ids)
         # we need to log these independently of cards, as one side may have
         # more card templates
         runHook("remNotes", self, ids)
         self._logRem(ids, REM_NOTE)
-        self.db.execute("delete from notes where id in %s" % strids)
+        with self.db.boundIds(ids) as sids:
+            self.db.execute("delete from notes where id in %s" % sids)
 
     # Card creation
     ##########################################################################
@@ -347,8 +527,11 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
 
     def genCards(self, nids):
         "Generate cards for non-empty templates, return ids to remove."
+        with self.db.boundIds(nids) as snids:
+            return self._genCards(snids)
+
+    def _genCards(self, snids):
         # build map of (nid,ord) so we don't create dupes
-        snids = ids2str(nids)
         have = {}
         dids = {}
         dues = {}
@@ -436,22 +619,24 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
         card = anki.cards.Card(self)
         card.nid = note.id
         card.ord = template['ord']
+        card.did = self._newCardDid(note.model(), template)
+        card.due = self._dueForDid(card.did, due)
+        if flush:
+            card.flush()
+        return card
+
+    def _newCardDid(self, model, template):
         # Use template did (deck override) if valid, otherwise model did
         if template['did'] and str(template['did']) in self.decks.decks:
-            card.did = template['did']
+            did = template['did']
         else:
-            card.did = note.model()['did']
+            did = model['did']
         # if invalid did, use default instead
-        deck = self.decks.get(card.did)
+        deck = self.decks.get(did)
         if deck['dyn']:
             # must not be a filtered deck
-            card.did = 1
-        else:
-            card.did = deck['id']
-        card.due = self._dueForDid(card.did, due)
-        if flush:
-            card.flush()
-        return card
+            return 1
+        return deck['id']
 
     def _dueForDid(self, did, due):
         conf = self.decks.confForDid(did)
@@ -478,30 +663,32 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
         "Bulk delete cards by ID."
         if not ids:
             return
-        sids = ids2str(ids)
-        nids = self.db.list("select nid from cards where id in "+sids)
-        # remove cards
-        self._logRem(ids, REM_CARD)
-        self.db.execute("delete from cards where id in "+sids)
+        with self.db.boundIds(ids) as sids:
+            nids = self.db.list("select nid from cards where id in "+sids)
+            # remove cards
+            self._logRem(ids, REM_CARD)
+            self.db.execute("delete from cards where id in "+sids)
         # then notes
         if not notes:
             return
-        nids = self.db.list("""
+        with self.db.boundIds(nids) as snids:
+            nids = self.db.list("""
 select id from notes where id in %s and id not in (select nid from cards)""" %
-                     ids2str(nids))
+                                snids)
         self._remNotes(nids)
 
-    def emptyCids(self):
-        rem = []
-        for m in self.models.all():
-            rem += self.genCards(self.models.nids(m))
-        return rem
+    def emptyCids(self, progress=None):
+        """Generate any missing cards, and return the ids of blank ones.
+PROGRESS is called with the number of notes checked so far."""
+        return self.cardgen.generate(progress=progress)
 
     def emptyCardReport(self, cids):
         rep = ""
-        for ords, cnt, flds in self.db.all("""
+        with self.db.boundIds(cids) as scids:
+            rows = self.db.all("""
 select group_concat(ord+1), count(), flds from cards c, notes n
-where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
+where c.nid = n.id and c.id in %s group by nid""" % scids)
+        for ords, cnt, flds in rows:
             rep += _("Empty card numbers: %(c)s\nFields: %(f)s\n\n") % dict(
                 c=ords, f=flds.replace("\x1f", " / "))
         return rep
@@ -515,9 +702,10 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
 
     def updateFieldCache(self, nids):
         "Update field checksums and sort cache, after find&replace, etc."
-        snids = ids2str(nids)
+        with self.db.boundIds(nids) as snids:
+            rows = self._fieldData(snids).fetchall()
         r = []
-        for (nid, mid, flds) in self._fieldData(snids):
+        for (nid, mid, flds) in rows:
             fields = splitFields(flds)
             model = self.models.get(mid)
             if not model:
@@ -532,89 +720,65 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
     # Q/A generation
     ##########################################################################
 
-    def renderQA(self, ids=None, type="card"):
+    def renderQA(self, ids=None, type="card", textOnly=False):
+        """Render the cards given by IDS and TYPE, in card id order. With
+TEXTONLY, skip media and LaTeX and return a line of plain text for each."""
+        return list(self.renderQAIter(ids, type, textOnly=textOnly))
+
+    def renderQAIter(self, ids=None, type="card", workers=0, textOnly=False):
+        """Yield renders like renderQA(), without holding them all in memory.
+With WORKERS, cards are rendered across that many processes, if the
+registered filters allow it; see anki/render.py."""
         # gather metadata
         if type == "card":
-            where = "and c.id in " + ids2str(ids)
+            where = "and c.id in %s"
         elif type == "note":
-            where = "and f.id in " + ids2str(ids)
+            where = "and f.id in %s"
         elif type == "model":
-            where = "and m.id in " + ids2str(ids)
+            where = "and f.mid in %s"
         elif type == "all":
             where = ""
         else:
             raise Exception()
-        return [self._renderQA(row)
-                for row in self._qaData(where)]
+        renderer = Renderer(self, workers)
+        if not where:
+            yield from renderer.render(self.db.iterate(
+                self._qaSql("order by c.id")), textOnly=textOnly)
+            return
+        with self.db.boundIds(ids) as sids:
+            yield from renderer.render(self.db.iterate(
+                self._qaSql((where % sids) + " order by c.id")),
+                                       textOnly=textOnly)
 
-    def _renderQA(self, data, qfmt=None, afmt=None):
+    def _renderQA(self, data, qfmt=None, afmt=None, textOnly=False):
         "Returns hash of id, question, answer."
         # data is [cid, nid, mid, did, ord, tags, flds, cardFlags]
-        # unpack fields and create dict
-        flist = splitFields(data[6])
-        fields = {}
-        model = self.models.get(data[2])
-        for (name, (idx, conf)) in list(self.models.fieldMap(model).items()):
-            fields[name] = flist[idx]
-        fields['Tags'] = data[5].strip()
-        fields['Type'] = model['name']
-        fields['Deck'] = self.decks.name(data[3])
-        fields['Subdeck'] = fields['Deck'].split('::')[-1]
-        fields['CardFlag'] = self._flagNameFromCardFlags(data[7])
-        if model['type'] == MODEL_STD:
-            template = model['tmpls'][data[4]]
-        else:
-            template = model['tmpls'][0]
-        fields['Card'] = template['name']
-        fields['c%d' % (data[4]+1)] = "1"
-        # render q & a
-        d = dict(id=data[0])
-        qfmt = qfmt or template['qfmt']
-        afmt = afmt or template['afmt']
-        for (type, format) in (("q", qfmt), ("a", afmt)):
-            if type == "q":
-                format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % (data[4]+1), format)
-                format = format.replace("<%cloze:", "<%%cq:%d:" % (
-                    data[4]+1))
-            else:
-                format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (data[4]+1), format)
-                format = format.replace("<%cloze:", "<%%ca:%d:" % (
-                    data[4]+1))
-                fields['FrontSide'] = stripSounds(d['q'])
-            fields = runFilter("mungeFields", fields, model, data, self)
-            html = anki.template.render(format, fields)
-            d[type] = runFilter(
-                "mungeQA", html, type, fields, model, data, self)
-            # empty cloze?
-            if type == 'q' and model['type'] == MODEL_CLOZE:
-                if not self.models._availClozeOrds(model, data[6], False):
-                    d['q'] += ("<p>" + _(
-                "Please edit this note and add some cloze deletions. (%s)") % (
-                "<a href=%s#cloze>%s</a>" % (HELP_SITE, _("help"))))
-        return d
+        return renderCard(data, self.models.get(data[2]),
+                          self.decks.name(data[3]), qfmt, afmt, self,
+                          textOnly=textOnly)
 
     def _qaData(self, where=""):
         "Return [cid, nid, mid, did, ord, tags, flds, cardFlags] db query"
-        return self.db.execute("""
+        return self.db.execute(self._qaSql(where))
+
+    def _qaSql(self, where):
+        return """
 select c.id, f.id, f.mid, c.did, c.ord, f.tags, f.flds, c.flags
 from cards c, notes f
 where c.nid == f.id
-%s""" % where)
+%s""" % where
 
     def _flagNameFromCardFlags(self, flags):
-        flag = flags & 0b111
-        if not flag:
-            return ""
-        return "flag%d" % flag
+        return flagName(flags)
 
     # Finding cards
     ##########################################################################
 
     def findCards(self, query, order=False):
-        return anki.find.Finder(self).findCards(query, order)
+        return self.find.findCards(query, order)
 
     def findNotes(self, query):
-        return anki.find.Finder(self).findNotes(query)
+        return self.find.findNotes(query)
 
     def findReplace(self, nids, src, dst, regex=None, field=None, fold=True):
         return anki.find.findReplace(self, nids, src, dst, regex, field, fold)
@@ -629,9 +793,9 @@ where c.nid == f.id
         from anki.stats import CardStats
         return CardStats(self, card).report()
 
-    def stats(self):
+    def stats(self, db=None):
         from anki.stats import CollectionStats
-        return CollectionStats(self)
+        return CollectionStats(self, db)
 
     # Timeboxing
     ##########################################################################
@@ -653,71 +817,33 @@ where c.nid == f.id
     ##########################################################################
 
     def clearUndo(self):
-        # [type, undoName, data]
-        # type 1 = review; type 2 = checkpoint
-        self._undo = None
+        self.undoJournal.clear()
 
     def undoName(self):
         "Undo menu item name, or None if undo unavailable."
-        if not self._undo:
-            return None
-        return self._undo[1]
+        return self.undoJournal.undoName()
+
+    def redoName(self):
+        "Redo menu item name, or None if redo unavailable."
+        return self.undoJournal.redoName()
 
     def undo(self):
-        if self._undo[0] == 1:
-            return self._undoReview()
-        else:
-            self._undoOp()
+        "Undo the last step. Returns the card id if it was a review."
+        return self.undoJournal.undo()
+
+    def redo(self):
+        self.undoJournal.redo()
 
     def markReview(self, card):
-        old = []
-        if self._undo:
-            if self._undo[0] == 1:
-                old = self._undo[2]
-            self.clearUndo()
-        wasLeech = card.note().hasTag("leech") or False
-        self._undo = [1, _("Review"), old + [copy.copy(card)], wasLeech]
-
-    def _undoReview(self):
-        data = self._undo[2]
-        wasLeech = self._undo[3]
-        c = data.pop()
-        if not data:
-            self.clearUndo()
-        # remove leech tag if it didn't have it before
-        if not wasLeech and c.note().hasTag("leech"):
-            c.note().delTag("leech")
-            c.note().flush()
-        # write old data
-        c.flush()
-        # and delete revlog entry
-        last = self.db.scalar(
-            "select id from revlog where cid = ? "
-            "order by id desc limit 1", c.id)
-        self.db.execute("delete from revlog where id = ?", last)
-        # restore any siblings
-        self.db.execute(
-            "update cards set queue=type,mod=?,usn=? where queue=-2 and nid=?",
-            intTime(), self.usn(), c.nid)
-        # and finally, update daily counts
-        n = 1 if c.queue == 3 else c.queue
-        type = ("new", "lrn", "rev")[n]
-        self.sched._updateStats(c, type, -1)
-        self.sched.reps -= 1
-        return c.id
+        "Start an undo step for answering CARD. The scheduler closes it."
+        self.undoJournal.open(_("Review"), card.id)
 
     def _markOp(self, name):
         "Call via .save()"
+        # saving ends the current step, and a name starts a new one
+        self.undoJournal.close()
         if name:
-            self._undo = [2, name]
-        else:
-            # saving disables old checkpoint, but not review undo
-            if self._undo and self._undo[0] == 2:
-                self.clearUndo()
-
-    def _undoOp(self):
-        self.rollback()
-        self.clearUndo()
+            self.undoJournal.open(name)
 
     # DB maintenance
     ##########################################################################
@@ -746,138 +872,11 @@ select id from notes where mid = ?) limit 1""" %
                 return
         return True
 
-    def fixIntegrity(self):
-        "Fix possible problems and rebuild caches."
-        problems = []
-        self.save()
-        oldSize = os.stat(self.path)[stat.ST_SIZE]
-        if self.db.scalar("pragma integrity_check") != "ok":
-            return (_("Collection is corrupt. Please see the manual."), False)
-        # note types with a missing model
-        ids = self.db.list("""
-select id from notes where mid not in """ + ids2str(self.models.ids()))
-        if ids:
-            problems.append(
-                ngettext("Deleted %d note with missing note type.",
-                         "Deleted %d notes with missing note type.", len(ids))
-                         % len(ids))
-            self.remNotes(ids)
-        # for each model
-        for m in self.models.all():
-            for t in m['tmpls']:
-                if t['did'] == "None":
-                    t['did'] = None
-                    problems.append(_("Fixed AnkiDroid deck override bug."))
-                    self.models.save(m)
-            if m['type'] == MODEL_STD:
-                # model with missing req specification
-                if 'req' not in m:
-                    self.models._updateRequired(m)
-                    problems.append(_("Fixed note type: %s") % m['name'])
-                # cards with invalid ordinal
-                ids = self.db.list("""
-select id from cards where ord not in %s and nid in (
-select id from notes where mid = ?)""" %
-                                   ids2str([t['ord'] for t in m['tmpls']]),
-                                   m['id'])
-                if ids:
-                    problems.append(
-                        ngettext("Deleted %d card with missing template.",
-                                 "Deleted %d cards with missing template.",
-                                 len(ids)) % len(ids))
-                    self.remCards(ids)
-            # notes with invalid field count
-            ids = []
-            for id, flds in self.db.execute(
-                    "select id, flds from notes where mid = ?", m['id']):
-                if (flds.count("\x1f") + 1) != len(m['flds']):
-                    ids.append(id)
-            if ids:
-                problems.append(
-                    ngettext("Deleted %d note with wrong field count.",
-                             "Deleted %d notes with wrong field count.",
-                             len(ids)) % len(ids))
-                self.remNotes(ids)
-        # delete any notes with missing cards
-        ids = self.db.list("""
-select id from notes where id not in (select distinct nid from cards)""")
-        if ids:
-            cnt = len(ids)
-            problems.append(
-                ngettext("Deleted %d note with no cards.",
-                         "Deleted %d notes with no cards.", cnt) % cnt)
-            self._remNotes(ids)
-        # cards with missing notes
-        ids = self.db.list("""
-select id from cards where nid not in (select id from notes)""")
-        if ids:
-            cnt = len(ids)
-            problems.append(
-                ngettext("Deleted %d card with missing note.",
-                         "Deleted %d cards with missing note.", cnt) % cnt)
-            self.remCards(ids)
-        # cards with odue set when it shouldn't be
-        ids = self.db.list("""
-select id from cards where odue > 0 and (type=1 or queue=2) and not odid""")
-        if ids:
-            cnt = len(ids)
-            problems.append(
-                ngettext("Fixed %d card with invalid properties.",
-                         "Fixed %d cards with invalid properties.", cnt) % cnt)
-            self.db.execute("update cards set odue=0 where id in "+
-                ids2str(ids))
-        # cards with odid set when not in a dyn deck
-        dids = [id for id in self.decks.allIds() if not self.decks.isDyn(id)]
-        ids = self.db.list("""
-select id from cards where odid > 0 and did in %s""" % ids2str(dids))
-        if ids:
-            cnt = len(ids)
-            problems.append(
-                ngettext("Fixed %d card with invalid properties.",
-                         "Fixed %d cards with invalid properties.", cnt) % cnt)
-            self.db.execute("update cards set odid=0, odue=0 where id in "+
-                ids2str(ids))
-        # tags
-        self.tags.registerNotes()
-        # field cache
-        for m in self.models.all():
-            self.updateFieldCache(self.models.nids(m))
-        # new cards can't have a due position > 32 bits
-        self.db.execute("""
-update cards set due = 1000000, mod = ?, usn = ? where due > 1000000
-and type = 0""", intTime(), self.usn())
-        # new card position
-        self.conf['nextPos'] = self.db.scalar(
-            "select max(due)+1 from cards where type = 0") or 0
-        # reviews should have a reasonable due #
-        ids = self.db.list(
-            "select id from cards where queue = 2 and due > 100000")
-        if ids:
-            problems.append("Reviews had incorrect due date.")
-            self.db.execute(
-                "update cards set due = ?, ivl = 1, mod = ?, usn = ? where id in %s"
-                % ids2str(ids), self.sched.today, intTime(), self.usn())
-        # v2 sched had a bug that could create decimal intervals
-        curs = self.db.cursor()
-
-        curs.execute("update cards set ivl=round(ivl),due=round(due) where ivl!=round(ivl) or due!=round(due)")
-        if curs.rowcount:
-            problems.append("Fixed %d cards with v2 scheduler bug." % curs.rowcount)
-
-        curs.execute("update revlog set ivl=round(ivl),lastIvl=round(lastIvl) where ivl!=round(ivl) or lastIvl!=round(lastIvl)")
-        if curs.rowcount:
-            problems.append("Fixed %d review history entries with v2 scheduler bug." % curs.rowcount)
-        # and finally, optimize
-        self.optimize()
-        newSize = os.stat(self.path)[stat.ST_SIZE]
-        txt = _("Database rebuilt and optimized.")
-        ok = not problems
-        problems.append(txt)
-        # if any problems were found, force a full sync
-        if not ok:
-            self.modSchema(check=False)
-        self.save()
-        return ("\n".join(problems), ok)
+    def fixIntegrity(self, progress=None, optimize=True, workers=0):
+        """Fix possible problems and rebuild caches. Returns (report, ok).
+See DBChecker.check() for the arguments; per-phase timings are left in
+self.dbcheck.timings."""
+        return self.dbcheck.check(progress, optimize, workers)
 
     def optimize(self):
         self.db.setAutocommit(True)
@@ -926,5 +925,6 @@ and type = 0""", intTime(), self.usn())
 
     def setUserFlag(self, flag, cids):
         assert 0 <= flag <= 7
-        self.db.execute("update cards set flags = (flags & ~?) | ?, usn=?, mod=? where id in %s" %
-                        ids2str(cids), 0b111, flag, self._usn, intTime())
+        with self.db.boundIds(cids) as scids:
+            self.db.execute("update cards set flags = (flags & ~?) | ?, usn=?, mod=? where id in %s" %
+                            scids, 0b111, flag, self._usn, intTime())
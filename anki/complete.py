@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import bisect
+
+from anki.find import fieldNames
+
+"""
+Autocomplete for tags, deck names, note type names and field names.
+
+Each vocabulary is kept as a case-folded sorted list, so a completion is a
+binary search for the prefix followed by a slice. They're built on first
+use, then the tag, deck and model managers add new names as they're
+registered, or reset a vocabulary when names are removed or renamed so it's
+rebuilt on next use.
+"""
+
+class PrefixIndex:
+    "A set of words that can be looked up by case-insensitive prefix."
+
+    def __init__(self, words=()):
+        pairs = sorted((w.casefold(), w) for w in set(words))
+        self._keys = [k for k, w in pairs]
+        self._words = [w for k, w in pairs]
+
+    def __len__(self):
+        return len(self._words)
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def add(self, word):
+        key = word.casefold()
+        i = bisect.bisect_left(self._keys, key)
+        # words differing only in case are kept together
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._words[i] == word:
+                return
+            i += 1
+        self._keys.insert(i, key)
+        self._words.insert(i, word)
+
+    def remove(self, word):
+        i = self._find(word)
+        if i is not None:
+            del self._keys[i]
+            del self._words[i]
+
+    def complete(self, prefix, limit=20):
+        "Up to LIMIT words starting with PREFIX, in case-insensitive order."
+        prefix = prefix.casefold()
+        i = bisect.bisect_left(self._keys, prefix)
+        res = []
+        while (i < len(self._keys) and len(res) < limit and
+               self._keys[i].startswith(prefix)):
+            res.append(self._words[i])
+            i += 1
+        return res
+
+    def _find(self, word):
+        key = word.casefold()
+        i = bisect.bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._words[i] == word:
+                return i
+            i += 1
+        return None
+
+class CompletionManager:
+
+    def __init__(self, col):
+        self.col = col
+        self._indexes = {}
+
+    def complete(self, kind, prefix, limit=20):
+        """Up to LIMIT names of KIND starting with PREFIX, ignoring case.
+KIND is one of 'tags', 'decks', 'models' or 'fields'."""
+        return self._index(kind).complete(prefix, limit)
+
+    def add(self, kind, names):
+        "Called when NAMES are added to the collection."
+        idx = self._indexes.get(kind)
+        if idx is None:
+            # built with them on first use
+            return
+        for name in names:
+            idx.add(name)
+
+    def reset(self, kind=None):
+        "Rebuild KIND (or everything) from the collection on next use."
+        if kind is None:
+            self._indexes = {}
+        else:
+            self._indexes.pop(kind, None)
+
+    def _index(self, kind):
+        idx = self._indexes.get(kind)
+        if idx is None:
+            idx = self._indexes[kind] = PrefixIndex(self._names(kind))
+        return idx
+
+    def _names(self, kind):
+        if kind == "tags":
+            return self.col.tags.all()
+        elif kind == "decks":
+            return self.col.decks.allNames()
+        elif kind == "models":
+            return self.col.models.allNames()
+        elif kind == "fields":
+            return fieldNames(self.col, downcase=False)
+        raise Exception("unknown completion kind: %s" % kind)
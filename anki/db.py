@@ -3,19 +3,44 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import os
+import re
 import time
+import json
+import traceback
+import queue
+import functools
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
 from sqlite3 import dbapi2 as sqlite, Cursor
 
+from anki.utils import stripHTMLMedia
+
 DBError = sqlite.Error
 
 class DB:
-    def __init__(self, path, timeout=0):
-        self._db = sqlite.connect(path, timeout=timeout)
+    def __init__(self, path, timeout=0, readonly=False):
+        if readonly:
+            # may be handed to a worker thread by ReadPool
+            self._db = sqlite.connect(
+                "file:%s?mode=ro" % pathname2url(path), timeout=timeout,
+                uri=True, check_same_thread=False)
+        else:
+            self._db = sqlite.connect(path, timeout=timeout)
         self._db.text_factory = self._textFactory
         self._path = path
         self.echo = os.environ.get("DBECHO")
         self.mod = False
+        self.profiler = None
+        self._idDepth = 0
+        self._readonly = readonly
+        # name -> path of attached databases
+        self.attached = {}
+        self.changes = 0
+        self._changed()
+        self._addFunctions()
+        if os.environ.get("DBPROFILE"):
+            self.startProfile()
 
     def execute(self, sql, *a, **ka):
         s = sql.strip().lower()
@@ -23,6 +48,7 @@ class DB:
         for stmt in "insert", "update", "delete":
             if s.startswith(stmt):
                 self.mod = True
+                self._changed()
         t = time.time()
         if ka:
             # execute("...where id = :id", id=5)
@@ -35,31 +61,59 @@ class DB:
             print(sql, "%0.3fms" % ((time.time() - t)*1000))
             if self.echo == "2":
                 print(a, ka)
+        if self.profiler:
+            self.profiler.record(sql, time.time() - t, ka or a)
         return res
 
     def executemany(self, sql, l):
         self.mod = True
+        self._changed()
         t = time.time()
         self._db.executemany(sql, l)
         if self.echo:
             print(sql, "%0.3fms" % ((time.time() - t)*1000))
             if self.echo == "2":
                 print(l)
+        if self.profiler:
+            self.profiler.record(sql, time.time() - t)
+
+    def executeQuietly(self, sql, *a):
+        """Like execute(), for writes to caches that searches and the
+collection don't read from; .mod and .changes are left alone."""
+        mod, changes = self.mod, self.changes
+        res = self.execute(sql, *a)
+        self.mod, self.changes = mod, changes
+        return res
 
     def commit(self):
         t = time.time()
         self._db.commit()
+        # other connections can now see the changes
+        self._changed()
         if self.echo:
             print("commit %0.3fms" % ((time.time() - t)*1000))
+        if self.profiler:
+            self.profiler.record("commit", time.time() - t)
 
     def executescript(self, sql):
         self.mod = True
+        self._changed()
         if self.echo:
             print(sql)
         self._db.executescript(sql)
 
     def rollback(self):
         self._db.rollback()
+        self._changed()
+
+    # the last value of .changes handed out by any connection
+    _changeSeq = 0
+
+    def _changed(self):
+        """Bump .changes, which callers can compare to tell whether anything
+may have been written since they last looked."""
+        DB._changeSeq += 1
+        self.changes = DB._changeSeq
 
     def scalar(self, *a, **kw):
         res = self.execute(*a, **kw).fetchone()
@@ -68,7 +122,12 @@ class DB:
         return None
 
     def all(self, *a, **kw):
-        return self.execute(*a, **kw).fetchall()
+        c = self.execute(*a, **kw)
+        t = time.time()
+        res = c.fetchall()
+        if self.profiler:
+            self.profiler.recordFetch(a[0], time.time() - t)
+        return res
 
     def first(self, *a, **kw):
         c = self.execute(*a, **kw)
@@ -76,13 +135,63 @@ class DB:
         c.close()
         return res
 
+    def iterate(self, sql, *a, batch=1000, **kw):
+        """Yield the rows of SQL, fetching BATCH rows at a time.
+
+Unlike all() and list(), the whole result set is never held in memory."""
+        c = self.execute(sql, *a, **kw)
+        while 1:
+            rows = c.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+
     def list(self, *a, **kw):
-        return [x[0] for x in self.execute(*a, **kw)]
+        c = self.execute(*a, **kw)
+        t = time.time()
+        res = [x[0] for x in c]
+        if self.profiler:
+            self.profiler.recordFetch(a[0], time.time() - t)
+        return res
 
     def close(self):
         self._db.text_factory = None
         self._db.close()
 
+    def setPragmas(self, pragmas):
+        "Apply a dict of per-connection pragmas, eg {'cache_size': 10000}."
+        for k, v in pragmas.items():
+            self._db.execute("pragma %s = %s" % (k, v))
+
+    def attach(self, path, name):
+        """Attach the database at PATH as NAME, read-only if this connection is.
+Attaching isn't possible inside a transaction, so any open one is committed."""
+        if name in self.attached:
+            return
+        if self._readonly:
+            path = "file:%s?mode=ro" % pathname2url(path)
+        elif self._db.in_transaction:
+            mod = self.mod
+            self.commit()
+            self.mod = mod
+        self._db.execute("attach database ? as %s" % name, (path,))
+        self.attached[name] = path
+
+    def createFunction(self, name, nargs, fn):
+        "Make python function FN callable from SQL as NAME."
+        try:
+            # lets sqlite call it once for constant arguments
+            self._db.create_function(name, nargs, fn, deterministic=True)
+        except (TypeError, sqlite.NotSupportedError):
+            # python < 3.8, or sqlite < 3.8.3
+            self._db.create_function(name, nargs, fn)
+
+    def _addFunctions(self):
+        # lets searches filter on field content without fetching the notes
+        self.createFunction("regexp", 2, _regexp)
+        self.createFunction("field_at", 2, _fieldAt)
+        self.createFunction("strip_html_media", 1, _stripHTMLMedia)
+
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
 
@@ -111,3 +220,255 @@ class DB:
 
     def cursor(self, factory=Cursor):
         return self._db.cursor(factory)
+
+    # Binding id sets
+    ##########################################################################
+
+    # sets smaller than this are inlined as literals
+    bindThreshold = 100
+
+    @contextmanager
+    def boundIds(self, ids):
+        """Bind IDS for use in a query, yielding a string usable after 'in'.
+
+Small sets are inlined like ids2str(). Larger ones are inserted into a
+session temp table, so sqlite doesn't need to parse a huge literal and the
+statement text stays the same between calls. The yielded string is only
+valid inside the with block:
+
+with col.db.boundIds(cids) as sids:
+    col.db.execute("delete from cards where id in " + sids)"""
+        if not isinstance(ids, (list, tuple, set, frozenset)):
+            ids = list(ids)
+        if len(ids) < self.bindThreshold:
+            yield "(%s)" % ",".join(str(i) for i in ids)
+            return
+        # one table per nesting level, so statement text is reused
+        self._idDepth += 1
+        tbl = "temp.ids%d" % self._idDepth
+        try:
+            # a no-op once created, but a rollback may have discarded it
+            self._db.execute(
+                "create table if not exists %s (id integer primary key)" % tbl)
+            self._fillIds(tbl, ids)
+            yield "(select id from %s)" % tbl
+        finally:
+            self._db.execute("delete from %s" % tbl)
+            self._idDepth -= 1
+
+    _haveJSON = True
+
+    def _fillIds(self, tbl, ids):
+        if DB._haveJSON:
+            # a single bound string is much cheaper than a row per id
+            try:
+                self._db.execute(
+                    "insert or ignore into %s select value from json_each(?)"
+                    % tbl, (json.dumps(list(ids)),))
+                return
+            except sqlite.OperationalError:
+                # sqlite built without json1
+                DB._haveJSON = False
+        self._db.executemany(
+            "insert or ignore into %s values (?)" % tbl, ((i,) for i in ids))
+
+    # Profiling
+    ##########################################################################
+
+    def startProfile(self, slowMs=100):
+        "Start collecting per-statement timings. Resets any previous data."
+        self.profiler = Profiler(self._db, slowMs=slowMs)
+
+    def stopProfile(self):
+        "Stop profiling and return the collected report."
+        if not self.profiler:
+            return None
+        res = self.profiler.report()
+        self.profiler = None
+        return res
+
+    def profile(self):
+        "Return the current profile report, or None if not profiling."
+        if not self.profiler:
+            return None
+        return self.profiler.report()
+
+    def dumpProfile(self, path):
+        "Write the current profile report to PATH as JSON."
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.profile(), f, indent=1)
+
+# SQL functions
+##########################################################################
+
+@functools.lru_cache(maxsize=100)
+def _compileRegex(pattern):
+    return re.compile(pattern)
+
+def _regexp(pattern, s):
+    "S regexp PATTERN: true if PATTERN matches anywhere in S."
+    if s is None:
+        return False
+    return _compileRegex(pattern).search(s) is not None
+
+def _fieldAt(flds, ord):
+    "Field ORD of a note's flds, or null if it doesn't have that many."
+    if flds is None:
+        return None
+    try:
+        return flds.split("\x1f", ord+1)[ord]
+    except IndexError:
+        return None
+
+def _stripHTMLMedia(s):
+    if s is None:
+        return None
+    return stripHTMLMedia(s)
+
+# Read-only connections
+##########################################################################
+
+class ReadPool:
+    """A pool of read-only connections to a WAL-mode database.
+
+Each reader sees the last committed state as a consistent snapshot, and can
+run in a worker thread while the main connection keeps writing. Changes that
+the main connection has not yet committed are not visible."""
+
+    def __init__(self, path, size=2, timeout=10, pragmas=None, attach=None):
+        self.size = size
+        self._free = queue.Queue()
+        self._all = []
+        for i in range(size):
+            db = DB(path, timeout=timeout, readonly=True)
+            db.setAutocommit(True)
+            if pragmas:
+                db.setPragmas(pragmas)
+            for name, apath in (attach or {}).items():
+                db.attach(apath, name)
+            self._all.append(db)
+            self._free.put(db)
+
+    @contextmanager
+    def reader(self):
+        "Borrow a connection, blocking until one is free."
+        db = self._free.get()
+        try:
+            # the snapshot is taken by the first read and held until rollback
+            db.execute("begin")
+            yield db
+        finally:
+            db.rollback()
+            self._free.put(db)
+
+    def close(self):
+        for db in self._all:
+            db.close()
+        self._all = []
+
+# Query profiling
+##########################################################################
+
+# upper bounds of the latency histogram buckets, in milliseconds
+PROFILE_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+class Profiler:
+    """Aggregate statement timings by normalized shape.
+
+Literals and id lists are replaced with placeholders, so that eg 'where id in
+(1,2,3)' and 'where id in (4,5)' are counted together. Statements slower than
+slowMs are additionally kept in a bounded log, along with their query plan."""
+
+    maxSlow = 100
+
+    _reStr = re.compile(r"'(?:[^']|'')*'")
+    _reNum = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?")
+    _reList = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+    _reSpace = re.compile(r"\s+")
+
+    def __init__(self, db, slowMs=100):
+        self._db = db
+        self.slowMs = slowMs
+        self.started = time.time()
+        self.stats = {}
+        self.slow = []
+        self._shapes = {}
+
+    def normalize(self, sql):
+        try:
+            return self._shapes[sql]
+        except KeyError:
+            pass
+        s = self._reSpace.sub(" ", sql).strip()
+        s = self._reStr.sub("?", s)
+        s = self._reNum.sub("?", s)
+        s = self._reList.sub("(...)", s)
+        if len(self._shapes) < 10000:
+            self._shapes[sql] = s
+        return s
+
+    def _entry(self, sql):
+        shape = self.normalize(sql)
+        e = self.stats.get(shape)
+        if not e:
+            e = self.stats[shape] = dict(
+                sql=shape, calls=0, total=0.0, max=0.0, fetch=0.0,
+                hist=[0]*(len(PROFILE_BUCKETS)+1))
+        return e
+
+    def record(self, sql, secs, args=()):
+        e = self._entry(sql)
+        ms = secs*1000
+        e['calls'] += 1
+        e['total'] += ms
+        e['max'] = max(e['max'], ms)
+        for c, limit in enumerate(PROFILE_BUCKETS):
+            if ms <= limit:
+                break
+        else:
+            c = len(PROFILE_BUCKETS)
+        e['hist'][c] += 1
+        if ms >= self.slowMs:
+            self._logSlow(sql, ms, args)
+
+    def recordFetch(self, sql, secs):
+        "Add time spent pulling rows for SQL into Python."
+        e = self._entry(sql)
+        e['fetch'] += secs*1000
+        e['total'] += secs*1000
+
+    def _logSlow(self, sql, ms, args):
+        if len(self.slow) >= self.maxSlow:
+            self.slow.pop(0)
+        self.slow.append(dict(
+            sql=sql.strip(), ms=ms, time=time.time(),
+            caller=self._caller(), plan=self._plan(sql, args)))
+
+    def _caller(self):
+        "The first function outside this module, as 'file:line:func'."
+        for path, line, fn, txt in reversed(traceback.extract_stack()):
+            if os.path.basename(path) != "db.py":
+                return "%s:%d:%s" % (os.path.basename(path), line, fn)
+        return ""
+
+    def _plan(self, sql, args):
+        if not sql.strip().lower().startswith(
+                ("select", "insert", "update", "delete", "with")):
+            return []
+        try:
+            return [r[-1] for r in self._db.execute(
+                "explain query plan " + sql, args)]
+        except sqlite.Error:
+            return []
+
+    def report(self):
+        "Return a dict of statements sorted by total time, and the slow log."
+        queries = sorted(self.stats.values(),
+                         key=lambda e: e['total'], reverse=True)
+        for e in queries:
+            e['avg'] = e['total'] / e['calls'] if e['calls'] else 0
+        return dict(
+            elapsed=time.time() - self.started,
+            buckets=list(PROFILE_BUCKETS),
+            queries=queries,
+            slow=list(self.slow))
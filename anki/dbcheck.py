@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import collections
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from anki.consts import *
+from anki.lang import _, ngettext
+from anki.utils import intTime, splitFields, fieldChecksum, stripHTMLMedia
+
+"""
+The "Check Database" pipeline.
+
+Rather than a query per problem and per note type, notes are streamed in id
+order alongside cards in note id order, and merged, so each note is checked
+with its cards in one pass over each table. Problems are only collected
+while streaming, as writing to a table being read isn't safe; the fixes are
+then applied in batches, with only the rows that need them written. The time
+taken by each phase is kept in .timings.
+
+Most of the scan's time goes on recomputing each note's sort field and
+checksum, so with workers that part is handed to a process pool in chunks,
+while this process carries on merging.
+"""
+
+def _sqlRound(x):
+    # SQLite's round() rounds halves away from zero, unlike Python's
+    return math.copysign(math.floor(abs(x) + 0.5), x)
+
+def _fieldCacheBatch(rows):
+    "(sfld, csum, nid) for the notes in ROWS whose field cache is stale."
+    # run in worker processes, so must stay at module level
+    res = []
+    for nid, flds, sortf, sfld, csum in rows:
+        fields = splitFields(flds)
+        newSfld = stripHTMLMedia(fields[sortf])
+        newCsum = fieldChecksum(fields[0])
+        # numbers in sfld are stored as numbers
+        if str(sfld) != newSfld or csum != newCsum:
+            res.append((newSfld, newCsum, nid))
+    return res
+
+class DBChecker:
+
+    # rows written at a time
+    batchSize = 5000
+    # notes checked between progress reports
+    progressEvery = 10000
+    # notes sent to a worker process at a time
+    chunkSize = 5000
+
+    def __init__(self, col):
+        self.col = col
+        # [(phase, seconds)] for the last check
+        self.timings = []
+        self._progress = None
+
+    def check(self, progress=None, optimize=True, workers=0):
+        """Fix possible problems and rebuild caches. Returns (report, ok).
+PROGRESS is called with the phase, and a count of rows for the 'notes' and
+'fix' phases. If not OPTIMIZE, skip the vacuum and analyze. With WORKERS,
+field caches are checked across that many processes."""
+        col = self.col
+        self.timings = []
+        self._progress = progress
+        self._lastPhase = time.time()
+        col.save()
+        self._phase("integrity")
+        if col.db.scalar("pragma integrity_check") != "ok":
+            return (_("Collection is corrupt. Please see the manual."), False)
+        self._lap("integrity")
+        self._phase("models")
+        problems = self._checkModels()
+        self._lap("models")
+        self._phase("notes", 0)
+        pool = ProcessPoolExecutor(workers) if workers else None
+        try:
+            found = self._scan(pool, workers)
+        finally:
+            if pool:
+                pool.shutdown()
+        self._lap("notes")
+        problems += self._fix(found)
+        self._lap("fix")
+        if optimize:
+            self._phase("optimize")
+            col.optimize()
+            self._lap("optimize")
+        txt = _("Database rebuilt and optimized.") if optimize else _(
+            "Database rebuilt.")
+        ok = not problems
+        problems.append(txt)
+        # if any problems were found, force a full sync
+        if not ok:
+            col.modSchema(check=False)
+        col.save()
+        col.log("check database", self.timings)
+        return ("\n".join(problems), ok)
+
+    # Phases
+    ######################################################################
+
+    def _phase(self, name, count=None):
+        if self._progress:
+            self._progress(name, count)
+
+    def _lap(self, name):
+        now = time.time()
+        self.timings.append((name, now - self._lastPhase))
+        self._lastPhase = now
+
+    def _checkModels(self):
+        "Fixes to the note types themselves, which need no scan."
+        problems = []
+        for m in self.col.models.all():
+            for t in m['tmpls']:
+                if t['did'] == "None":
+                    t['did'] = None
+                    problems.append(_("Fixed AnkiDroid deck override bug."))
+                    self.col.models.save(m)
+            if m['type'] == MODEL_STD and 'req' not in m:
+                # model with missing req specification
+                self.col.models._updateRequired(m)
+                problems.append(_("Fixed note type: %s") % m['name'])
+        return problems
+
+    # Scanning
+    ######################################################################
+
+    def _scan(self, pool=None, workers=0):
+        "Stream notes and their cards once, collecting what needs fixing."
+        col = self.col
+        db = col.db
+        # mid -> (field count, sort field, template ords if standard); ids
+        # may be stored as strings in the registry
+        self._models = dict(
+            (int(m['id']), (len(m['flds']), m['sortf'],
+                            set(t['ord'] for t in m['tmpls'])
+                            if m['type'] == MODEL_STD else None))
+            for m in col.models.all())
+        self._normal = set(int(did) for did in col.decks.allIds()
+                           if not col.decks.isDyn(did))
+        self._today = col.sched.today
+        self._now = intTime()
+        self._usn = col.usn()
+        found = self._found = dict(
+            # notes to delete, by reason
+            missingModel=[], fieldCount=[], noCards=[],
+            # cards to delete, by reason
+            badOrd=[], missingNote=[],
+            # rows to write
+            cardFixes=[], fieldCache=[],
+            # counts of card fixes, by reason
+            odue=0, odid=0, revDue=0, decimal=0,
+            tags=set(), maxNewDue=None)
+        self._pool = pool
+        self._inFlight = max(1, workers*2)
+        # notes whose field cache is yet to be checked, and chunks of them
+        # being checked
+        self._pending = []
+        self._futures = collections.deque()
+        notes = db.iterate("""
+select id, mid, flds, tags, sfld, csum from notes order by id""")
+        cards = db.iterate("""
+select id, nid, ord, did, type, queue, due, ivl, odue, odid, mod, usn
+from cards order by nid, id""")
+        note = next(notes, None)
+        ncards = []
+        done = 0
+        for card in cards:
+            # notes before this card's note have all their cards
+            while note is not None and note[0] < card[1]:
+                self._checkNote(note, ncards)
+                ncards = []
+                note = next(notes, None)
+                done += 1
+                if done % self.progressEvery == 0:
+                    self._phase("notes", done)
+            if note is not None and note[0] == card[1]:
+                ncards.append(card)
+            else:
+                found['missingNote'].append(card[0])
+        while note is not None:
+            self._checkNote(note, ncards)
+            ncards = []
+            note = next(notes, None)
+        self._submit()
+        while self._futures:
+            found['fieldCache'].extend(self._futures.popleft().result())
+        return found
+
+    def _checkNote(self, note, cards):
+        found = self._found
+        nid, mid, flds, tags, sfld, csum = note
+        m = self._models.get(mid)
+        if not m:
+            found['missingModel'].append(nid)
+            return
+        nflds, sortf, ords = m
+        if flds.count("\x1f") + 1 != nflds:
+            found['fieldCount'].append(nid)
+            return
+        if not cards:
+            found['noCards'].append(nid)
+            return
+        if ords is not None:
+            bad = [c[0] for c in cards if c[2] not in ords]
+            if bad:
+                found['badOrd'].extend(bad)
+                if len(bad) == len(cards):
+                    # the note goes with them
+                    return
+                cards = [c for c in cards if c[2] in ords]
+        found['tags'].add(tags)
+        self._pending.append((nid, flds, sortf, sfld, csum))
+        if len(self._pending) == self.chunkSize:
+            self._submit()
+        for card in cards:
+            self._checkCard(card)
+
+    def _submit(self):
+        "Check the field caches of the pending notes."
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        if not self._pool:
+            self._found['fieldCache'].extend(_fieldCacheBatch(rows))
+            return
+        self._futures.append(self._pool.submit(_fieldCacheBatch, rows))
+        # keep memory bounded
+        if len(self._futures) > self._inFlight:
+            self._found['fieldCache'].extend(self._futures.popleft().result())
+
+    def _checkCard(self, card):
+        found = self._found
+        (cid, nid, ord, did, type, queue, due, ivl, odue, odid,
+         mod, usn) = card
+        old = (due, ivl, odue, odid)
+        # odue set when it shouldn't be
+        if odue > 0 and (type == 1 or queue == 2) and not odid:
+            odue = 0
+            found['odue'] += 1
+        # odid set when not in a dyn deck
+        if odid > 0 and did in self._normal:
+            odid = odue = 0
+            found['odid'] += 1
+        # new cards can't have a due position > 32 bits
+        if due > 1000000 and type == 0:
+            due = 1000000
+            mod, usn = self._now, self._usn
+        if type == 0:
+            if found['maxNewDue'] is None or due > found['maxNewDue']:
+                found['maxNewDue'] = due
+        # reviews should have a reasonable due #
+        if queue == 2 and due > 100000:
+            due, ivl = self._today, 1
+            mod, usn = self._now, self._usn
+            found['revDue'] += 1
+        # v2 sched had a bug that could create decimal intervals
+        if ((ivl.__class__ is float or due.__class__ is float) and
+                (ivl != _sqlRound(ivl) or due != _sqlRound(due))):
+            ivl, due = _sqlRound(ivl), _sqlRound(due)
+            found['decimal'] += 1
+        if (due, ivl, odue, odid) != old:
+            found['cardFixes'].append((due, ivl, odue, odid, mod, usn, cid))
+
+    # Fixing
+    ######################################################################
+
+    def _fix(self, found):
+        col = self.col
+        problems = []
+        self._fixed = 0
+        def report(ids, singular, plural):
+            if ids:
+                cnt = ids if isinstance(ids, int) else len(ids)
+                problems.append(ngettext(singular, plural, cnt) % cnt)
+        self._phase("fix", 0)
+        ids = found['missingModel']
+        report(ids, "Deleted %d note with missing note type.",
+               "Deleted %d notes with missing note type.")
+        self._batched(col.remNotes, ids)
+        ids = found['badOrd']
+        report(ids, "Deleted %d card with missing template.",
+               "Deleted %d cards with missing template.")
+        self._batched(col.remCards, ids)
+        ids = found['fieldCount']
+        report(ids, "Deleted %d note with wrong field count.",
+               "Deleted %d notes with wrong field count.")
+        self._batched(col.remNotes, ids)
+        ids = found['noCards']
+        report(ids, "Deleted %d note with no cards.",
+               "Deleted %d notes with no cards.")
+        self._batched(col._remNotes, ids)
+        ids = found['missingNote']
+        report(ids, "Deleted %d card with missing note.",
+               "Deleted %d cards with missing note.")
+        self._batched(col.remCards, ids)
+        for key in ("odue", "odid"):
+            report(found[key], "Fixed %d card with invalid properties.",
+                   "Fixed %d cards with invalid properties.")
+        if found['revDue']:
+            problems.append("Reviews had incorrect due date.")
+        if found['decimal']:
+            problems.append("Fixed %d cards with v2 scheduler bug." %
+                            found['decimal'])
+        self._batched(lambda rows: col.db.executemany("""
+update cards set due=?, ivl=?, odue=?, odid=?, mod=?, usn=? where id=?""",
+                                                      rows),
+                      found['cardFixes'])
+        # relying on the check forcing a full sync if needed, as
+        # updateFieldCache() does
+        self._batched(lambda rows: col.db.executemany(
+            "update notes set sfld=?, csum=? where id=?", rows),
+                      found['fieldCache'])
+        col.tags.registerAll(col.tags.split(" ".join(found['tags'])))
+        # new card position
+        if found['maxNewDue'] is None:
+            col.conf['nextPos'] = 0
+        else:
+            col.conf['nextPos'] = found['maxNewDue'] + 1
+        curs = col.db.cursor()
+        curs.execute("update revlog set ivl=round(ivl),lastIvl=round(lastIvl) where ivl!=round(ivl) or lastIvl!=round(lastIvl)")
+        if curs.rowcount:
+            problems.append("Fixed %d review history entries with v2 scheduler bug." % curs.rowcount)
+        return problems
+
+    def _batched(self, fn, rows):
+        for i in range(0, len(rows), self.batchSize):
+            batch = rows[i:i+self.batchSize]
+            fn(batch)
+            self._fixed += len(batch)
+            self._phase("fix", self._fixed)
@@ -95,10 +95,15 @@ class DeckManager:
 
     def __init__(self, col):
         self.col = col
+        # bumped on every change, so caches built from the registry can tell
+        # when they need rebuilding
+        self.gen = 0
 
     def load(self, decks, dconf):
         self.decks = json.loads(decks)
         self.dconf = json.loads(dconf)
+        self.gen += 1
+        self.col.completion.reset("decks")
         # set limits to within bounds
         found = False
         for c in list(self.dconf.values()):
@@ -117,6 +122,7 @@ class DeckManager:
             g['mod'] = intTime()
             g['usn'] = self.col.usn()
         self.changed = True
+        self.gen += 1
 
     def flush(self):
         if self.changed:
@@ -149,6 +155,7 @@ class DeckManager:
         g['id'] = id
         self.decks[str(id)] = g
         self.save(g)
+        self.col.completion.add("decks", [name])
         self.maybeAddToActive()
         runHook("newDeck")
         return int(id)
@@ -168,6 +175,7 @@ class DeckManager:
                     if not self.byName(name):
                         deck['name'] = name
                         self.save(deck)
+                        self.col.completion.reset("decks")
                         break
                     suffix += "1"
             return
@@ -198,6 +206,7 @@ class DeckManager:
                 self.col.remCards(cids)
         # delete the deck and add a grave
         del self.decks[str(did)]
+        self.col.completion.reset("decks")
         # ensure we have an active deck
         if did in self.active():
             self.select(int(list(self.decks.keys())[0]))
@@ -247,6 +256,7 @@ class DeckManager:
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
         self.decks[str(g['id'])] = g
+        self.col.completion.reset("decks")
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
         self.save()
@@ -273,6 +283,7 @@ class DeckManager:
         # ensure we have parents again, as we may have renamed parent->child
         newName = self._ensureParents(newName)
         self.save(g)
+        self.col.completion.reset("decks")
         # renaming may have altered active did order
         self.maybeAddToActive()
 
@@ -417,9 +428,10 @@ class DeckManager:
         return None
 
     def setDeck(self, cids, did):
-        self.col.db.execute(
-            "update cards set did=?,usn=?,mod=? where id in "+
-            ids2str(cids), did, self.col.usn(), intTime())
+        with self.col.db.boundIds(cids) as scids:
+            self.col.db.execute(
+                "update cards set did=?,usn=?,mod=? where id in "+
+                scids, did, self.col.usn(), intTime())
 
     def maybeAddToActive(self):
         # reselect current deck, or default if current has disappeared
@@ -473,6 +485,8 @@ class DeckManager:
     def checkIntegrity(self):
         self._recoverOrphans()
         self._checkDeckTree()
+        # names may have been fixed
+        self.col.completion.reset("decks")
 
     # Deck selection
     #############################################################
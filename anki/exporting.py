@@ -13,6 +13,9 @@ class Exporter:
     def __init__(self, col, did=None):
         self.col = col
         self.did = did
+        # reads go through this, so a pooled reader can be swapped in to
+        # export from a worker thread
+        self.db = col.db
 
     def exportInto(self, path):
         self._escapeCount = 0
@@ -33,9 +36,12 @@ class Exporter:
 
     def cardIds(self):
         if not self.did:
-            cids = self.col.db.list("select id from cards")
+            cids = self.db.list("select id from cards")
         else:
-            cids = self.col.decks.cids(self.did, children=True)
+            dids = [self.did] + [
+                x[1] for x in self.col.decks.children(self.did)]
+            cids = self.db.list("select id from cards where did in "+
+                                ids2str(dids))
         self.count = len(cids)
         return cids
 
@@ -51,18 +57,13 @@ class TextCardExporter(Exporter):
         Exporter.__init__(self, col)
 
     def doExport(self, file):
-        ids = sorted(self.cardIds())
-        strids = ids2str(ids)
-        def esc(s):
-            # strip off the repeated question in answer if exists
-            s = re.sub("(?si)^.*<hr id=answer>\n*", "", s)
-            return self.escapeText(s)
-        out = ""
-        for cid in ids:
-            c = self.col.getCard(cid)
-            out += esc(c.q())
-            out += "\t" + esc(c.a()) + "\n"
-        file.write(out.encode("utf-8"))
+        ids = self.cardIds()
+        # rendered as text, so no media or LaTeX images are generated, and
+        # the answer comes without the question
+        for d in self.col.renderQAIter(ids, textOnly=True):
+            out = self.escapeText(d['q'])
+            out += "\t" + self.escapeText(d['a']) + "\n"
+            file.write(out.encode("utf-8"))
 
 # Notes as TSV
 ######################################################################
@@ -79,25 +80,29 @@ class TextNoteExporter(Exporter):
 
     def doExport(self, file):
         cardIds = self.cardIds()
-        data = []
-        for id, flds, tags in self.col.db.execute("""
+        count = 0
+        with self.db.boundIds(cardIds) as scids:
+            for id, flds, tags in self.db.iterate("""
 select guid, flds, tags from notes
 where id in
 (select nid from cards
-where cards.id in %s)""" % ids2str(cardIds)):
-            row = []
-            # note id
-            if self.includeID:
-                row.append(str(id))
-            # fields
-            row.extend([self.escapeText(f) for f in splitFields(flds)])
-            # tags
-            if self.includeTags:
-                row.append(tags.strip())
-            data.append("\t".join(row))
-        self.count = len(data)
-        out = "\n".join(data)
-        file.write(out.encode("utf-8"))
+where cards.id in %s)""" % scids):
+                row = []
+                # note id
+                if self.includeID:
+                    row.append(str(id))
+                # fields
+                row.extend([self.escapeText(f) for f in splitFields(flds)])
+                # tags
+                if self.includeTags:
+                    row.append(tags.strip())
+                # rows are newline separated, without a trailing newline
+                out = "\t".join(row)
+                if count:
+                    out = "\n" + out
+                file.write(out.encode("utf-8"))
+                count += 1
+        self.count = count
 
 # Anki decks
 ######################################################################
@@ -129,8 +134,10 @@ class AnkiExporter(Exporter):
         # copy cards, noting used nids
         nids = {}
         data = []
-        for row in self.src.db.execute(
-            "select * from cards where id in "+ids2str(cids)):
+        with self.db.boundIds(cids) as scids:
+            rows = self.db.all(
+                "select * from cards where id in "+scids)
+        for row in rows:
             nids[row[1]] = True
             data.append(row)
             # clear flags
@@ -140,10 +147,11 @@ class AnkiExporter(Exporter):
             "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
             data)
         # notes
-        strnids = ids2str(list(nids.keys()))
         notedata = []
-        for row in self.src.db.all(
-            "select * from notes where id in "+strnids):
+        with self.db.boundIds(list(nids.keys())) as snids:
+            rows = self.db.all(
+                "select * from notes where id in "+snids)
+        for row in rows:
             # remove system tags if not exporting scheduling info
             if not self.includeSched:
                 row = list(row)
@@ -153,12 +161,12 @@ class AnkiExporter(Exporter):
             "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)",
             notedata)
         # models used by the notes
-        mids = self.dst.db.list("select distinct mid from notes where id in "+
-                                strnids)
+        mids = self.dst.db.list("select distinct mid from notes")
         # card history and revlog
         if self.includeSched:
-            data = self.src.db.all(
-                "select * from revlog where cid in "+ids2str(cids))
+            with self.db.boundIds(cids) as scids:
+                data = self.db.all(
+                    "select * from revlog where cid in "+scids)
             self.dst.db.executemany(
                 "insert into revlog values (?,?,?,?,?,?,?,?,?)",
                 data)
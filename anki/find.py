@@ -4,9 +4,11 @@
 
 import re
 import sre_constants
+import time
 import unicodedata
+from collections import OrderedDict
 
-from anki.utils import ids2str, splitFields, joinFields, intTime, fieldChecksum, stripHTMLMedia
+from anki.utils import ids2str, splitFields, joinFields, intTime, fieldChecksum, stripHTMLMedia, json
 from anki.consts import *
 from anki.hooks import *
 
@@ -14,10 +16,37 @@ from anki.hooks import *
 # Find
 ##########################################################################
 
+class SearchSyntaxError(Exception):
+    pass
+
+class _InvalidCommand(Exception):
+    pass
+
+def _lruGet(cache, key):
+    try:
+        cache.move_to_end(key)
+    except KeyError:
+        return None
+    return cache[key]
+
+def _lruPut(cache, key, val, size):
+    cache[key] = val
+    while len(cache) > size:
+        cache.popitem(last=False)
+
 class Finder:
 
-    def __init__(self, col):
+    # number of compiled searches to keep
+    cacheSize = 200
+    # number of search results to keep
+    resultCacheSize = 20
+    # results with more ids than this aren't kept
+    resultCacheMaxIds = 50000
+
+    def __init__(self, col, db=None):
         self.col = col
+        # a pooled reader may be passed in to search off the main thread
+        self._db = db
         self.search = dict(
             added=self._findAdded,
             card=self._findTemplate,
@@ -31,30 +60,71 @@ class Finder:
             tag=self._findTag,
             dupe=self._findDupes,
             flag=self._findFlag,
+            re=self._findRegex,
         )
         self.search['is'] = self._findCardState
+        builtin = dict(self.search)
         runHook("search", self.search)
+        # the results of these depend only on the collection, so can be
+        # reused until it changes, and their SQL depends only on the query
+        # and the collection state in _cacheKey(). add-on commands may look
+        # at anything.
+        self._stable = set(
+            k for k, fn in self.search.items() if builtin.get(k) == fn)
+        # whether a card matches these depends only on its own row and its
+        # note's, so materialized searches can be updated card by card
+        self._local = self._stable - set(["rated", "dupe"])
+        self._parsed = OrderedDict()
+        self._compiled = OrderedDict()
+        self._results = OrderedDict()
+        # the counter the kept results are for
+        self._resultsAt = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def db(self):
+        return self._db or self.col.db
 
     def findCards(self, query, order=False):
         "Return a list of card ids for QUERY."
-        tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
+        conf = self.col.conf
+        # taken before the query runs, so a write committed meanwhile can't
+        # leave an older result cached under the newer counter
+        key = self._resultKey(("cards", query, order, conf.get('sortType'),
+                               conf.get('sortBackwards')))
+        res = self._cachedResult(key)
+        if res is not None:
+            return res
+        try:
+            preds, args, stable = self._compile(query)
+        except SearchSyntaxError:
+            # invalid grouping
+            return []
         if preds is None:
             raise Exception("invalidSearch")
         order, rev = self._order(order)
         sql = self._query(preds, order)
         try:
-            res = self.col.db.list(sql, *args)
+            res = self.db.list(sql, *args)
         except:
             # invalid grouping
             return []
         if rev:
             res.reverse()
+        if stable:
+            self._cacheResult(key, res)
         return res
 
     def findNotes(self, query):
-        tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
+        key = self._resultKey(("notes", query))
+        res = self._cachedResult(key)
+        if res is not None:
+            return res
+        try:
+            preds, args, stable = self._compile(query)
+        except SearchSyntaxError:
+            return []
         if preds is None:
             return []
         if preds:
@@ -64,12 +134,147 @@ class Finder:
         sql = """
 select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         try:
-            res = self.col.db.list(sql, *args)
+            res = self.db.list(sql, *args)
         except:
             # invalid grouping
             return []
+        if stable:
+            self._cacheResult(key, res)
+        return res
+
+    # Paging
+    ######################################################################
+
+    def findCardsPage(self, query, order=False, after=None, limit=1000):
+        """Return (ids, cursor) for the first LIMIT cards of QUERY sorting after
+AFTER, a cursor returned by a previous call. The cursor is None once there are
+no more cards. Unlike findCards(), memory use doesn't grow with the number of
+matches."""
+        try:
+            preds, args, stable = self._compile(query)
+        except SearchSyntaxError:
+            return [], None
+        if preds is None:
+            raise Exception("invalidSearch")
+        if order and order is not True:
+            # custom order strings can't be used as a key, so fall back to
+            # an offset
+            offset = after or 0
+            sql = self._query(preds, " order by %s limit %d offset %d" % (
+                order, limit, offset))
+            ids = self.db.list(sql, *args)
+            return ids, offset + len(ids) if len(ids) == limit else None
+        if order:
+            cols, rev = self._sortColumns()
+        else:
+            cols, rev = [], False
+        # card ids make the key unique
+        cols.append("c.id")
+        if after is not None:
+            cond = "(%s) %s (%s)" % (
+                ", ".join(cols), "<" if rev else ">",
+                ", ".join("?" * len(cols)))
+            preds = "(%s) and %s" % (preds, cond) if preds else cond
+            args = args + list(after)
+        dir = " desc" if rev else ""
+        sql = self._query(preds, " order by %s limit %d" % (
+            ", ".join(c + dir for c in cols), limit), cols=", ".join(cols))
+        rows = self.db.all(sql, *args)
+        cursor = None
+        if len(rows) == limit:
+            cursor = rows[-1]
+        return [r[-1] for r in rows], cursor
+
+    def countCards(self, query):
+        "Return the number of cards matching QUERY."
+        try:
+            preds, args, stable = self._compile(query)
+        except SearchSyntaxError:
+            return 0
+        if preds is None:
+            raise Exception("invalidSearch")
+        return self.db.scalar(self._query(preds, "", cols="count()"), *args)
+
+    def pagedCards(self, query, order=False, pageSize=1000):
+        "Return a PagedCards for QUERY, with the first page fetched."
+        return PagedCards(self, query, order, pageSize)
+
+    # Explaining
+    ######################################################################
+
+    def explain(self, query, order=False):
+        """Describe how QUERY is run, to find out why a search is slow.
+
+Returns a dict with the generated sql and args, sqlite's query plan, the
+number of matching cards, and timings in ms for parsing, building the sql and
+running it. 'clauses' lists each search term with its own sql, build time,
+and the time and card count when run on its own. The sql and results are not
+cached."""
+        res = dict(query=query)
+        t = time.time()
+        try:
+            tree = self._parse(query)
+        except SearchSyntaxError:
+            res['error'] = "syntax"
+            return res
+        timings = res['timings'] = dict(parse=(time.time() - t)*1000)
+        clauses = res['clauses'] = []
+        t = time.time()
+        try:
+            preds, args = self._build(
+                tree, dict(cacheable=False, stable=True, clauses=clauses))
+        except _InvalidCommand:
+            res['error'] = "invalidSearch"
+            return res
+        timings['build'] = (time.time() - t)*1000
+        order, rev = self._order(order)
+        sql = res['sql'] = self._query(preds or "", order)
+        res['args'] = args
+        res['plan'] = [r[-1] for r in self.db.all(
+            "explain query plan " + sql, *args)]
+        t = time.time()
+        res['rows'] = len(self.db.list(sql, *args))
+        timings['sql'] = (time.time() - t)*1000
+        for c in clauses:
+            if not c['sql'] or c['sql'] == "skip":
+                continue
+            t = time.time()
+            c['rows'] = self.db.scalar(
+                self._query(c['sql'], "", cols="count()"), *c['args'])
+            c['runMs'] = (time.time() - t)*1000
         return res
 
+    # Result cache
+    ######################################################################
+
+    def _resultKey(self, key):
+        # the main connection's counter also covers commits seen by readers
+        return (key, self._cacheKey(), self.col.db.changes)
+
+    def _cachedResult(self, key):
+        "KEY is from _resultKey()."
+        if key[-1] != self._resultsAt:
+            # written to since, so the results kept can't be hit again
+            self._results = OrderedDict()
+            self._resultsAt = key[-1]
+        res = _lruGet(self._results, key)
+        if res is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # callers may modify the list
+        return list(res)
+
+    def _cacheResult(self, key, res):
+        if key[-1] != self.col.db.changes or len(res) > self.resultCacheMaxIds:
+            return
+        _lruPut(self._results, key, tuple(res), self.resultCacheSize)
+
+    def cacheStats(self):
+        "Return result cache hits, misses and size, eg for monitoring."
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._results))
+
     # Tokenizing
     ######################################################################
 
@@ -124,73 +329,184 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             tokens.append(token)
         return tokens
 
+    # Parsing
+    ######################################################################
+    # Queries are parsed into a tree of tuples:
+    # ('and', [nodes]), ('or', [nodes]), ('not', node),
+    # ('cmd', cmd, val) for cmd:val, and ('text', val) for a plain word.
+    # As with SQL, 'and' binds more tightly than 'or'.
+
+    def _parse(self, query):
+        "Return the tree for QUERY, reusing a previous parse if possible."
+        tree = _lruGet(self._parsed, query)
+        if tree is None:
+            tree = self._parseTokens(self._tokenize(query))
+            _lruPut(self._parsed, query, tree, self.cacheSize)
+        return tree
+
+    def _parseTokens(self, tokens):
+        pos = [0]
+        def peek():
+            if pos[0] < len(tokens):
+                return tokens[pos[0]]
+        def take():
+            pos[0] += 1
+            return tokens[pos[0]-1]
+        def orExpr():
+            nodes = [andExpr()]
+            while peek() is not None and peek().lower() == "or":
+                take()
+                nodes.append(andExpr())
+            nodes = [n for n in nodes if n is not None]
+            if len(nodes) < 2:
+                return nodes[0] if nodes else None
+            return ('or', nodes)
+        def andExpr():
+            nodes = []
+            while peek() is not None and peek() != ")" and \
+                    peek().lower() != "or":
+                n = unary()
+                if n is not None:
+                    nodes.append(n)
+            if len(nodes) < 2:
+                return nodes[0] if nodes else None
+            return ('and', nodes)
+        def unary():
+            tok = take()
+            if tok == "-":
+                if peek() is None or peek() == ")" or peek().lower() == "or":
+                    # nothing to negate
+                    return None
+                return ('not', unary())
+            elif tok == "(":
+                node = orExpr()
+                if peek() != ")" or node is None:
+                    raise SearchSyntaxError()
+                take()
+                return ('group', node)
+            elif ":" in tok:
+                cmd, val = tok.split(":", 1)
+                return ('cmd', cmd.lower(), val)
+            else:
+                return ('text', tok)
+        node = orExpr()
+        if peek() is not None:
+            # unbalanced ')'
+            raise SearchSyntaxError()
+        return node
+
     # Query building
     ######################################################################
 
+    def _cacheKey(self):
+        "Collection state that the built-in commands depend on."
+        col = self.col
+        return (col.scm, col.models.gen, col.decks.gen, col.indexes.gen,
+                col.conf.get('curDeck'),
+                col.sched.today, col.sched.dayCutoff)
+
+    def _compile(self, query):
+        """Return (preds, args, stable) for QUERY, or (None, None, False) if
+a command was invalid. Raises SearchSyntaxError for unbalanced groups.
+stable is true if the results depend only on the collection."""
+        tree = self._parse(query)
+        key = (query, self._cacheKey())
+        hit = _lruGet(self._compiled, key)
+        if hit is not None:
+            sql, args = hit
+            args = list(args)
+            stable = True
+        else:
+            state = dict(cacheable=True, stable=True)
+            try:
+                sql, args = self._build(tree, state)
+            except _InvalidCommand:
+                return None, None, False
+            if sql is None:
+                sql = ""
+            if state['cacheable']:
+                _lruPut(self._compiled, key, (sql, tuple(args)),
+                        self.cacheSize)
+            stable = state['stable']
+        saved = self._materialized(query, sql, args)
+        if saved is not None:
+            return saved[0], saved[1], True
+        return sql, args, stable
+
     def _where(self, tokens):
-        # state and query
-        s = dict(isnot=False, isor=False, join=False, q="", bad=False)
+        "Return (preds, args) for a tokenized query."
+        try:
+            sql, args = self._build(
+                self._parseTokens(tokens), dict(cacheable=False))
+        except (_InvalidCommand, SearchSyntaxError):
+            return None, None
+        return sql or "", args
+
+    def _build(self, node, state, negated=False):
+        """Return (sql, args) for NODE, or (None, []) if it should be
+ignored."""
+        if node is None:
+            return None, []
+        kind = node[0]
+        if kind in ('and', 'or'):
+            parts = []
+            for child in node[1]:
+                sql, args = self._build(child, state)
+                if sql is not None:
+                    parts.append((sql, args))
+            if not parts:
+                return None, []
+            if kind == 'and':
+                # evaluate predicates that only need the cards table first
+                parts.sort(key=lambda p: "n." in p[0])
+            sql = (" %s " % kind).join("(%s)" % p[0] for p in parts)
+            return sql, [a for p in parts for a in p[1]]
+        elif kind == 'group':
+            sql, args = self._build(node[1], state)
+            if sql is None:
+                return None, []
+            return "(%s)" % sql, args
+        elif kind == 'not':
+            sql, args = self._build(node[1], state, negated=True)
+            if sql is None:
+                return None, []
+            return "not (%s)" % sql, args
+        # leaves
         args = []
-        def add(txt, wrap=True):
-            # failed command?
-            if not txt:
-                # if it was to be negated then we can just ignore it
-                if s['isnot']:
-                    s['isnot'] = False
-                    return
-                else:
-                    s['bad'] = True
-                    return
-            elif txt == "skip":
-                return
-            # do we need a conjunction?
-            if s['join']:
-                if s['isor']:
-                    s['q'] += " or "
-                    s['isor'] = False
-                else:
-                    s['q'] += " and "
-            if s['isnot']:
-                s['q'] += " not "
-                s['isnot'] = False
-            if wrap:
-                txt = "(" + txt + ")"
-            s['q'] += txt
-            s['join'] = True
-        for token in tokens:
-            if s['bad']:
-                return None, None
-            # special tokens
-            if token == "-":
-                s['isnot'] = True
-            elif token.lower() == "or":
-                s['isor'] = True
-            elif token == "(":
-                add(token, wrap=False)
-                s['join'] = False
-            elif token == ")":
-                s['q'] += ")"
-            # commands
-            elif ":" in token:
-                cmd, val = token.split(":", 1)
-                cmd = cmd.lower()
-                if cmd in self.search:
-                    add(self.search[cmd]((val, args)))
-                else:
-                    add(self._findField(cmd, val))
-            # normal text search
+        t = time.time()
+        if kind == 'cmd':
+            cmd, val = node[1], node[2]
+            if cmd in self.search:
+                if cmd not in self._stable:
+                    state['cacheable'] = False
+                    state['stable'] = False
+                if cmd not in self._local:
+                    state['local'] = False
+                sql = self.search[cmd]((val, args))
             else:
-                add(self._findText(token, args))
-        if s['bad']:
-            return None, None
-        return s['q'], args
+                sql = self._findField(cmd, val, args)
+        else:
+            sql = self._findText(node[1], args)
+        if 'clauses' in state:
+            state['clauses'].append(dict(
+                clause=node, sql=sql, args=list(args),
+                buildMs=(time.time() - t)*1000))
+        if sql == "skip":
+            return None, []
+        elif not sql:
+            # if it was to be negated then we can just ignore it
+            if negated:
+                return None, []
+            raise _InvalidCommand()
+        return sql, args
 
-    def _query(self, preds, order):
+    def _query(self, preds, order, cols="c.id"):
         # can we skip the note table?
-        if "n." not in preds and "n." not in order:
-            sql = "select c.id from cards c where "
+        if "n." not in preds and "n." not in order and "n." not in cols:
+            sql = "select %s from cards c where " % cols
         else:
-            sql = "select c.id from cards c, notes n where c.nid=n.id and "
+            sql = "select %s from cards c, notes n where c.nid=n.id and " % (
+                cols)
         # combine with preds
         if preds:
             sql += "(" + preds + ")"
@@ -201,42 +517,169 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             sql += " " + order
         return sql
 
+    # Materialized searches
+    ######################################################################
+
+    def materialize(self, name, query):
+        """Keep the ids of the cards matching QUERY in a table, so that
+searching for QUERY again only needs to read them. When the collection is
+saved, searches whose terms look only at each card and its note are updated
+card by card. Others, and searches whose meaning has changed (eg a deck was
+renamed), are left stale until refreshMaterialized() refills them, as the
+browser does when one is opened. Until then, searches combine the table with
+the cards changed since, or run as usual. Returns False if QUERY is
+invalid."""
+        if self._fresh(query)[0] is None:
+            return False
+        self.col.indexes.enable("saved")
+        self.col.db.execute("""
+insert or replace into idx.saved (name, query) values (?, ?)""", name, query)
+        self._refresh(name, query)
+        return True
+
+    def dematerialize(self, name):
+        if not self._indexed("saved"):
+            return
+        self.col.db.execute("delete from idx.saved where name = ?", name)
+        self.col.db.execute("delete from idx.savedcards where name = ?", name)
+        if not self.col.db.scalar("select 1 from idx.saved limit 1"):
+            # stop tracking changes
+            self.col.indexes.disable("saved")
+
+    def materialized(self):
+        "Return a dict of name -> query for the materialized searches."
+        if not self._indexed("saved"):
+            return {}
+        return dict(self.col.db.all("select name, query from idx.saved"))
+
+    def updateMaterialized(self):
+        """Apply the cards changed since last time to the materialized
+searches that can be updated card by card, and mark the rest stale. Called
+when the collection is saved; searches only read the tables."""
+        if self._db or not self._indexed("saved"):
+            return
+        self._applyChanges()
+
+    def refreshMaterialized(self, name=None):
+        "Bring materialized search NAME, or all of them, fully up to date."
+        if self._db or not self._indexed("saved"):
+            return
+        self._applyChanges()
+        for sname, query in self.col.db.all(
+                "select name, query from idx.saved"):
+            if name is None or sname == name:
+                self._refresh(sname, query)
+
+    def _materialized(self, query, preds, args):
+        """Return (preds, args) reading the cards of the materialized search
+for QUERY, or None if it's not materialized, or not filled with PREDS and
+ARGS, what QUERY means now."""
+        # readers don't have the tables
+        if self._db or not self._indexed("saved"):
+            return None
+        db = self.col.db
+        row = db.first("""
+select name, local from idx.saved where query = ? and not stale
+and sql = ? and args = ?""", query, preds, json.dumps(args))
+        if not row:
+            return None
+        name, local = row
+        saved = "c.id in (select cid from idx.savedcards where name = ?)"
+        if not db.scalar("select 1 from idx.saveddirty limit 1"):
+            return saved, [name]
+        if not local:
+            # any change may affect it
+            return None
+        # cards changed since are checked as usual
+        changed = "c.id in (select cid from idx.saveddirty)"
+        return "(%s and not %s) or (%s%s)" % (
+            saved, changed, changed, " and (%s)" % preds if preds else ""), [
+                name] + list(args)
+
+    def _refresh(self, name, query):
+        "Refill NAME if it's stale or what QUERY means has changed."
+        db = self.col.db
+        preds, args, local = self._fresh(query)
+        if preds is None:
+            # no longer valid (eg its deck was removed); searching will say
+            return
+        sql, oldArgs, stale = db.first(
+            "select sql, args, stale from idx.saved where name = ?", name)
+        args = json.dumps(args)
+        if not stale and sql == preds and oldArgs == args:
+            return
+        # new, or what the search means has changed (eg a deck was renamed,
+        # or the day rolled over)
+        db.executeQuietly("delete from idx.savedcards where name = ?", name)
+        db.executeQuietly("insert into idx.savedcards " + self._query(
+            preds, "", cols="?, c.id"), name, *json.loads(args))
+        db.executeQuietly("""
+update idx.saved set sql = ?, args = ?, local = ?, stale = 0
+where name = ?""", preds, args, local, name)
+
+    def _applyChanges(self):
+        "Update materialized searches with the cards changed since last time."
+        db = self.col.db
+        if not db.scalar("select 1 from idx.saveddirty limit 1"):
+            return
+        for name, sql, args, local in db.all(
+                "select name, sql, args, local from idx.saved where not stale"):
+            if not local:
+                db.executeQuietly(
+                    "update idx.saved set stale = 1 where name = ?", name)
+                continue
+            changed = "c.id in (select cid from idx.saveddirty)"
+            db.executeQuietly("""
+delete from idx.savedcards where name = ?
+and cid in (select cid from idx.saveddirty)""", name)
+            db.executeQuietly("insert into idx.savedcards " + self._query(
+                "%s and (%s)" % (changed, sql) if sql else changed,
+                "", cols="?, c.id"), name, *json.loads(args))
+        db.executeQuietly("delete from idx.saveddirty")
+
+    def _fresh(self, query):
+        """Return (preds, args, local) for QUERY without using the cache, or
+(None, None, False) if it's invalid. local is true if whether a card matches
+depends only on the card and its note."""
+        state = dict(cacheable=False, stable=True, local=True)
+        try:
+            sql, args = self._build(self._parse(query), state)
+        except (_InvalidCommand, SearchSyntaxError):
+            return None, None, False
+        return sql or "", args, state['local'] and state['stable']
+
     # Ordering
     ######################################################################
 
+    # columns for each sortType
+    sortColumns = dict(
+        noteCrt=("n.id", "c.ord"),
+        noteMod=("n.mod", "c.ord"),
+        noteFld=("n.sfld collate nocase", "c.ord"),
+        cardMod=("c.mod",),
+        cardReps=("c.reps",),
+        cardDue=("c.type", "c.due"),
+        cardEase=("c.factor",),
+        cardLapses=("c.lapses",),
+        cardIvl=("c.ivl",),
+    )
+
     def _order(self, order):
         if not order:
             return "", False
         elif order is not True:
             # custom order string provided
             return " order by " + order, False
-        # use deck default
-        type = self.col.conf['sortType']
-        sort = None
-        if type.startswith("note"):
-            if type == "noteCrt":
-                sort = "n.id, c.ord"
-            elif type == "noteMod":
-                sort = "n.mod, c.ord"
-            elif type == "noteFld":
-                sort = "n.sfld collate nocase, c.ord"
-        elif type.startswith("card"):
-            if type == "cardMod":
-                sort = "c.mod"
-            elif type == "cardReps":
-                sort = "c.reps"
-            elif type == "cardDue":
-                sort = "c.type, c.due"
-            elif type == "cardEase":
-                sort = "c.factor"
-            elif type == "cardLapses":
-                sort = "c.lapses"
-            elif type == "cardIvl":
-                sort = "c.ivl"
-        if not sort:
+        cols, rev = self._sortColumns()
+        return " order by " + ", ".join(cols), rev
+
+    def _sortColumns(self):
+        "Return (columns, reverse) for the deck default sort."
+        cols = self.sortColumns.get(self.col.conf['sortType'])
+        if not cols:
             # deck has invalid sort order; revert to noteCrt
-            sort = "n.id, c.ord"
-        return " order by " + sort, self.col.conf['sortBackwards']
+            cols = self.sortColumns['noteCrt']
+        return list(cols), self.col.conf['sortBackwards']
 
     # Commands
     ######################################################################
@@ -246,6 +689,15 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         if val == "none":
             return 'n.tags = ""'
         val = val.replace("*", "%")
+        # wildcards other than at the ends can match across two tags in
+        # the tag string, so only the string match will do
+        core = re.sub(r"^%+|(?<!\\)%+$", "", val)
+        if (self._indexed("tags") and " " not in val and core and
+                not re.search(r"(?<!\\)[%_]", core)):
+            # match against each tag rather than the whole string
+            args.append(val)
+            return """n.id in (select nid from idx.notetags
+where tag like ? escape '\\')"""
         if not val.startswith("%"):
             val = "% " + val
         if not val.endswith("%") or val.endswith('\\%'):
@@ -289,14 +741,22 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             days = int(r[0])
         except ValueError:
             return
-        days = min(days, 31)
+        indexed = self._indexed("rated")
+        if not indexed:
+            # scanning the revlog gets expensive further back
+            days = min(days, 31)
         # ease
         ease = ""
         if len(r) > 1:
             if r[1] not in ("1", "2", "3", "4"):
                 return
-            ease = "and ease=%s" % r[1]
+            ease = r[1]
         cutoff = (self.col.sched.dayCutoff - 86400*days)*1000
+        if indexed:
+            return ("c.id in (select cid from idx.rated where last%s>%d)" %
+                    (ease, cutoff))
+        if ease:
+            ease = "and ease=%s" % ease
         return ("c.id in (select cid from revlog where id>%d %s)" %
                 (cutoff, ease))
 
@@ -342,9 +802,44 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
 
     def _findText(self, val, args):
         val = val.replace("*", "%")
+        sql = "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        match = self._textMatch(val)
+        if match:
+            # narrow down with the index, then check with like as before
+            args.append(match)
+            sql = """(n.id in (select rowid from idx.notes_fts
+where notes_fts match ?) and %s)""" % sql
         args.append("%"+val+"%")
         args.append("%"+val+"%")
-        return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        return sql
+
+    def _textMatch(self, val):
+        """Return an FTS query matching at least the notes that LIKE pattern VAL
+does, or None if the text index can't be used."""
+        if not self._indexed("text"):
+            return None
+        # split into the literal runs between wildcards
+        runs = [""]
+        i = 0
+        while i < len(val):
+            c = val[i]
+            if c == "\\" and i + 1 < len(val):
+                runs[-1] += val[i+1]
+                i += 1
+            elif c in "%_":
+                runs.append("")
+            else:
+                runs[-1] += c
+            i += 1
+        # trigrams can't find anything shorter
+        runs = [r for r in runs if len(r) >= 3]
+        if not runs:
+            return None
+        return " AND ".join('"%s"' % r.replace('"', '""') for r in runs)
+
+    def _indexed(self, name):
+        "True if index NAME is enabled and usable from our connection."
+        return "idx" in self.db.attached and self.col.indexes.enabled(name)
 
     def _findNids(self, args):
         (val, args) = args
@@ -428,9 +923,8 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                             m['id'], t['ord']))
         return " or ".join(lims)
 
-    def _findField(self, field, val):
+    def _findField(self, field, val, args):
         field = field.lower()
-        val = val.replace("*", "%")
         # find models that have that field
         mods = {}
         for m in self.col.models.all():
@@ -440,25 +934,87 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         if not mods:
             # nothing has that field
             return
-        # gather nids
-        regex = re.escape(val).replace("_", ".").replace(re.escape("%"), ".*")
-        nids = []
-        for (id,mid,flds) in self.col.db.execute("""
-select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(list(mods.keys()))),
-                         "%"+val+"%"):
-            flds = splitFields(flds)
-            ord = mods[str(mid)][1]
-            strg = flds[ord]
-            try:
-                if re.search("(?si)^"+regex+"$", strg):
-                    nids.append(id)
-            except sre_constants.error:
+        byOrd = {}
+        for mid, (m, ord) in mods.items():
+            byOrd.setdefault(ord, []).append(mid)
+        if val.startswith("re:"):
+            # field:re:regex matches anywhere in the field
+            regex = self._regex("(?si)" + val[3:])
+            if regex is None:
                 return
-        if not nids:
-            return "0"
-        return "n.id in %s" % ids2str(nids)
+            like = None
+        else:
+            like, regex = self._fieldPattern(val)
+            # like and the regex both match the whole field
+            regex = "(?si)^%s$" % regex
+        if self._indexed("fields"):
+            if like is None:
+                args.append(regex)
+                cond = "val regexp ?"
+            else:
+                args.append(like)
+                cond = "val like ? escape '\\'"
+            return """n.id in (select nid from idx.fields
+where %s and (%s))""" % (cond, " or ".join(
+                "mid in %s and ord = %d" % (ids2str(mids), ord)
+                for ord, mids in sorted(byOrd.items())))
+        # like is cheap and narrows down the notes the regex is run on
+        sql = "n.mid in %s" % ids2str(list(mods.keys()))
+        if like is not None:
+            args.append("%"+like+"%")
+            sql += " and n.flds like ? escape '\\'"
+        ords = []
+        for ord, mids in sorted(byOrd.items()):
+            args.append(regex)
+            if len(byOrd) == 1:
+                ords.append("field_at(n.flds, %d) regexp ?" % ord)
+            else:
+                ords.append("n.mid in %s and field_at(n.flds, %d) regexp ?" % (
+                    ids2str(mids), ord))
+        return "%s and (%s)" % (sql, " or ".join(ords))
+
+    def _fieldPattern(self, val):
+        """A LIKE pattern and a regex for the field search VAL, which agree:
+* or % match anything, _ any one character, and a backslash makes the next
+character literal."""
+        like = []
+        regex = []
+        chars = iter(val)
+        for c in chars:
+            if c == "\\":
+                # a trailing backslash is taken literally
+                c = next(chars, "\\")
+                like.append("\\" + c)
+                regex.append(re.escape(c))
+            elif c in "*%":
+                like.append("%")
+                regex.append(".*")
+            elif c == "_":
+                like.append("_")
+                regex.append(".")
+            else:
+                like.append(c)
+                regex.append(re.escape(c))
+        return "".join(like), "".join(regex)
+
+    def _regex(self, regex):
+        "REGEX if it's valid, else None."
+        try:
+            re.compile(regex)
+        except sre_constants.error:
+            return None
+        return regex
+
+    def _findRegex(self, args):
+        # case insensitive, against each field
+        (val, args) = args
+        regex = self._regex("(?i)" + val)
+        if regex is None:
+            return
+        count = max(len(m['flds']) for m in self.col.models.all())
+        args.extend([regex]*count)
+        return "(%s)" % " or ".join(
+            "field_at(n.flds, %d) regexp ?" % ord for ord in range(count))
 
     def _findDupes(self, args):
         # caller must call stripHTMLMedia on passed val
@@ -467,14 +1023,102 @@ where mid in %s and flds like ? escape '\\'""" % (
             mid, val = val.split(",", 1)
         except OSError:
             return
-        csum = fieldChecksum(val)
-        nids = []
-        for nid, flds in self.col.db.execute(
-                "select id, flds from notes where mid=? and csum=?",
-                mid, csum):
-            if stripHTMLMedia(splitFields(flds)[0]) == val:
-                nids.append(nid)
-        return "n.id in %s" % ids2str(nids)
+        if self._indexed("fields"):
+            args.extend([mid, val])
+            return """n.id in (select nid from idx.fields
+where mid = ? and ord = 0 and norm = ?)"""
+        args.extend([mid, fieldChecksum(val), val])
+        return """n.id in (select id from notes where mid = ? and csum = ?
+and strip_html_media(field_at(flds, 0)) = ?)"""
+
+# Paged results
+##########################################################################
+
+class PagedCards:
+    """The card ids matching a search, fetched a page at a time as they're
+accessed. Behaves like a read-only list, slices included; len() runs a
+separate count query the first time it's needed, so the first rows are
+available without loading the rest. The count can also be run elsewhere with
+countWith() and passed in with setCount()."""
+
+    def __init__(self, finder, query, order=False, pageSize=1000):
+        self.finder = finder
+        self.query = query
+        self.order = order
+        self.pageSize = pageSize
+        self._ids = []
+        self._cursor = None
+        self._done = False
+        self._count = None
+        self._fetch()
+
+    def _fetch(self):
+        ids, self._cursor = self.finder.findCardsPage(
+            self.query, self.order, self._cursor, self.pageSize)
+        self._ids.extend(ids)
+        if self._cursor is None:
+            self._done = True
+            self._count = len(self._ids)
+
+    def loaded(self):
+        "The ids fetched so far."
+        return self._ids
+
+    def _fetchTo(self, count):
+        while len(self._ids) < count and not self._done:
+            self._fetch()
+
+    def countKnown(self):
+        "True if len() can answer without running the count query."
+        return self._count is not None
+
+    def countWith(self, db):
+        """Count the matches on DB, eg a pooled reader in a worker thread. The
+result isn't stored; hand it to setCount() from the main thread."""
+        return Finder(self.finder.col, db).countCards(self.query)
+
+    def setCount(self, count):
+        if self._count is None:
+            self._count = count
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self.finder.countCards(self.query)
+        return self._count
+
+    def __bool__(self):
+        return bool(self._ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.start, idx.stop, idx.step
+            if stop is not None and stop >= 0 and (start or 0) >= 0 \
+                    and (step or 1) > 0:
+                # no need to count the rest
+                self._fetchTo(stop)
+            else:
+                self._fetchTo(len(self))
+            return self._ids[idx]
+        if idx < 0:
+            idx += len(self)
+        self._fetchTo(idx + 1)
+        return self._ids[idx]
+
+    def __iter__(self):
+        idx = 0
+        while True:
+            while idx >= len(self._ids):
+                if self._done:
+                    return
+                self._fetch()
+            yield self._ids[idx]
+            idx += 1
+
+    def index(self, id):
+        for idx, cid in enumerate(self):
+            if cid == id:
+                return idx
+        raise ValueError("%d is not in list" % id)
 
 # Find and replace
 ##########################################################################
@@ -498,10 +1142,19 @@ def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
     def repl(str):
         return re.sub(regex, dst, str)
     d = []
-    snids = ids2str(nids)
+    with col.db.boundIds(nids) as snids:
+        if field:
+            # only fetch the notes whose field the regex matches
+            rows = col.db.all("""
+select id, mid, flds from notes where id in %s and (%s)""" % (
+                snids, " or ".join(
+                    "mid = %s and field_at(flds, %d) regexp :re" % (mid, ord)
+                    for mid, ord in mmap.items())), re=src)
+        else:
+            rows = col.db.all(
+                "select id, mid, flds from notes where id in "+snids)
     nids = []
-    for nid, mid, flds in col.db.execute(
-        "select id, mid, flds from notes where id in "+snids):
+    for nid, mid, flds in rows:
         origFlds = flds
         # does it match?
         sflds = splitFields(flds)
@@ -543,7 +1196,8 @@ def fieldNames(col, downcase=True):
 def fieldNamesForNotes(col, nids):
     downcasedNames = set()
     origNames = []
-    mids = col.db.list("select distinct mid from notes where id in %s" % ids2str(nids))
+    with col.db.boundIds(nids) as snids:
+        mids = col.db.list("select distinct mid from notes where id in %s" % snids)
     for mid in mids:
         model = col.models.get(mid)
         for field in col.models.fieldNames(model):
@@ -573,21 +1227,39 @@ def findDupes(col, fieldName, search=""):
                     fields[mid] = c
                     break
         return fields[mid]
-    for nid, mid, flds in col.db.all(
-        "select id, mid, flds from notes where id in "+ids2str(
-            col.findNotes(search))):
-        flds = splitFields(flds)
-        ord = ordForMid(mid)
-        if ord is None:
-            continue
-        val = flds[ord]
-        val = stripHTMLMedia(val)
-        # empty does not count as duplicate
-        if not val:
-            continue
-        if val not in vals:
-            vals[val] = []
-        vals[val].append(nid)
-        if len(vals[val]) == 2:
-            dupes.append((val, vals[val]))
+    def stripped(rows):
+        for nid, mid, flds in rows:
+            flds = splitFields(flds)
+            ord = ordForMid(mid)
+            if ord is None:
+                continue
+            yield nid, stripHTMLMedia(flds[ord])
+    with col.db.boundIds(col.findNotes(search)) as snids:
+        if col.indexes.enabled("fields"):
+            # already split and stripped
+            mids = {}
+            for m in col.models.all():
+                for f in m['flds']:
+                    if f['name'].lower() == fieldName.lower():
+                        mids.setdefault(f['ord'], []).append(m['id'])
+                        break
+            if not mids:
+                return []
+            rows = col.db.iterate("""
+select nid, norm from idx.fields where nid in %s and (%s)
+order by nid""" % (snids, " or ".join(
+                "mid in %s and ord = %d" % (ids2str(v), ord)
+                for ord, v in sorted(mids.items()))))
+        else:
+            rows = stripped(col.db.iterate(
+                "select id, mid, flds from notes where id in "+snids))
+        for nid, val in rows:
+            # empty does not count as duplicate
+            if not val:
+                continue
+            if val not in vals:
+                vals[val] = []
+            vals[val].append(nid)
+            if len(vals[val]) == 2:
+                dupes.append((val, vals[val]))
     return dupes
@@ -19,9 +19,13 @@ import decorator
 ##############################################################################
 
 _hooks = {}
+# hook -> number of times its functions have changed, so caches of filter
+# output can tell when to start again
+_changes = {}
 
 def runHook(hook, *args):
     "Run all functions on hook."
+    name = hook
     hook = _hooks.get(hook, None)
     if hook:
         for func in hook:
@@ -29,9 +33,11 @@ def runHook(hook, *args):
                 func(*args)
             except:
                 hook.remove(func)
+                _changed(name)
                 raise
 
 def runFilter(hook, arg, *args):
+    name = hook
     hook = _hooks.get(hook, None)
     if hook:
         for func in hook:
@@ -39,6 +45,7 @@ def runFilter(hook, arg, *args):
                 arg = func(arg, *args)
             except:
                 hook.remove(func)
+                _changed(name)
                 raise
     return arg
 
@@ -48,12 +55,41 @@ def addHook(hook, func):
         _hooks[hook] = []
     if func not in _hooks[hook]:
         _hooks[hook].append(func)
+        _changed(hook)
 
 def remHook(hook, func):
     "Remove a function if is on hook."
-    hook = _hooks.get(hook, [])
-    if func in hook:
-        hook.remove(func)
+    funcs = _hooks.get(hook, [])
+    if func in funcs:
+        funcs.remove(func)
+        _changed(hook)
+
+def hookChanges(hook):
+    "A number that changes whenever HOOK's functions do."
+    return _changes.get(hook, 0)
+
+def _changed(hook):
+    _changes[hook] = _changes.get(hook, 0) + 1
+
+# filters that mustn't run in worker processes; see anki/render.py
+_workerUnsafe = set()
+
+def setWorkerUnsafe(func):
+    "While FUNC is registered, render in the main process, eg if it needs the collection."
+    _workerUnsafe.add(func)
+
+def workerUnsafe(func):
+    return func in _workerUnsafe
+
+# set by filters whose output from the current render mustn't be reused;
+# see anki/qacache.py
+_skipCache = False
+
+def skipCache():
+    """Called by a filter if its output this time shouldn't be cached, eg as
+it depends on the time or on files that may appear later."""
+    global _skipCache
+    _skipCache = True
 
 # Instrumenting
 ##############################################################################
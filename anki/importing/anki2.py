@@ -19,6 +19,8 @@ class Anki2Importer(Importer):
     needMapper = False
     deckPrefix = None
     allowUpdate = True
+    # notes are written to the collection this many at a time
+    batchSize = 1000
 
     def run(self, media=None):
         self._prepareFiles()
@@ -64,10 +66,13 @@ class Anki2Importer(Importer):
     ######################################################################
 
     def _logNoteRow(self, action, noteRow):
-        self.log.append("[%s] %s" % (
+        self.log.append(self._noteRowLog(action, noteRow))
+
+    def _noteRowLog(self, action, noteRow):
+        return "[%s] %s" % (
             action,
             noteRow[6].replace("\x1f", ", ")
-        ))
+        )
 
     def _importNotes(self):
         # build guid -> (id,mod,mid) hash & map of existing note ids
@@ -83,15 +88,24 @@ class Anki2Importer(Importer):
         # we ignore updates to changed schemas. we need to note the ignored
         # guids, so we avoid importing invalid cards
         self._ignoredGuids = {}
-        # iterate over source collection
+        # iterate over source collection, writing notes out in batches
         add = []
         update = []
         dirty = []
         usn = self.dst.usn()
-        dupesIdentical = []
-        dupesIgnored = []
+        # log lines, by action
+        logs = dict(skipped=[], updated=[], added=[], identical=[])
         total = 0
-        for note in self.src.db.execute(
+        def flush():
+            self.dst.db.executemany(
+                "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
+                add)
+            self.dst.db.executemany(
+                "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
+                update)
+            add.clear()
+            update.clear()
+        for note in self.src.db.iterate(
             "select * from notes"):
             total += 1
             # turn the db result into a mutable list
@@ -107,6 +121,7 @@ class Anki2Importer(Importer):
                 # update media references in case of dupes
                 note[6] = self._mungeMedia(note[MID], note[6])
                 add.append(note)
+                logs['added'].append(self._noteRowLog(_("Added"), note))
                 dirty.append(note[0])
                 # note we have the added the guid
                 self._notes[note[GUID]] = (note[0], note[3], note[MID])
@@ -123,58 +138,48 @@ class Anki2Importer(Importer):
                             note[4] = usn
                             note[6] = self._mungeMedia(note[MID], note[6])
                             update.append(note)
+                            logs['updated'].append(
+                                self._noteRowLog(_("Updated"), note))
                             dirty.append(note[0])
                         else:
-                            dupesIgnored.append(note)
+                            logs['skipped'].append(
+                                self._noteRowLog(_("Skipped"), note))
                             self._ignoredGuids[note[GUID]] = True
                     else:
-                        dupesIdentical.append(note)
+                        logs['identical'].append(
+                            self._noteRowLog(_("Identical"), note))
+            if len(add) + len(update) >= self.batchSize:
+                flush()
+        flush()
 
         self.log.append(_("Notes found in file: %d") % total)
 
-        if dupesIgnored:
+        if logs['skipped']:
             self.log.append(
                 _("Notes that could not be imported as note type has changed: %d") %
-                len(dupesIgnored))
-        if update:
+                len(logs['skipped']))
+        if logs['updated']:
             self.log.append(
                 _("Notes updated, as file had newer version: %d") %
-                len(update))
-        if add:
+                len(logs['updated']))
+        if logs['added']:
             self.log.append(
                 _("Notes added from file: %d") %
-                len(add))
-        if dupesIdentical:
+                len(logs['added']))
+        if logs['identical']:
             self.log.append(
                 _("Notes skipped, as they're already in your collection: %d") %
-                len(dupesIdentical))
+                len(logs['identical']))
 
         self.log.append("")
 
-        if dupesIgnored:
-            for row in dupesIgnored:
-                self._logNoteRow(_("Skipped"), row)
-        if update:
-            for row in update:
-                self._logNoteRow(_("Updated"), row)
-        if add:
-            for row in add:
-                self._logNoteRow(_("Added"), row)
-        if dupesIdentical:
-            for row in dupesIdentical:
-                self._logNoteRow(_("Identical"), row)
+        for action in "skipped", "updated", "added", "identical":
+            self.log.extend(logs[action])
 
         # export info for calling code
-        self.dupes = len(dupesIdentical)
-        self.added = len(add)
-        self.updated = len(update)
-        # add to col
-        self.dst.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            add)
-        self.dst.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            update)
+        self.dupes = len(logs['identical'])
+        self.added = len(logs['added'])
+        self.updated = len(logs['updated'])
         self.dst.updateFieldCache(dirty)
         self.dst.tags.registerNotes(dirty)
 
@@ -99,14 +99,17 @@ class NoteImporter(Importer):
         for f in self.mapping:
             if f == "_tags":
                 self._tagsMapped = True
-        # gather checks for duplicate comparison
+        # gather checks for duplicate comparison, unless the field index can
+        # look them up directly
         csums = {}
-        for csum, id in self.col.db.execute(
-            "select csum, id from notes where mid = ?", self.model['id']):
-            if csum in csums:
-                csums[csum].append(id)
-            else:
-                csums[csum] = [id]
+        indexed = self.col.indexes.enabled("fields")
+        if not indexed:
+            for csum, id in self.col.db.execute(
+                "select csum, id from notes where mid = ?", self.model['id']):
+                if csum in csums:
+                    csums[csum].append(id)
+                else:
+                    csums[csum] = [id]
         firsts = {}
         fld0idx = self.mapping.index(self.model['flds'][0]['name'])
         self._fmap = self.col.models.fieldMap(self.model)
@@ -147,9 +150,16 @@ class NoteImporter(Importer):
             firsts[fld0] = True
             # already exists?
             found = False
-            if csum in csums:
-                # csum is not a guarantee; have to check
-                for id in csums[csum]:
+            if indexed:
+                cands = self.col.db.list("""
+select nid from idx.fields where mid = ? and ord = 0 and val = ?""",
+                                         self.model['id'], fld0)
+            else:
+                cands = csums.get(csum)
+            if cands:
+                # neither csum nor the case insensitive index lookup is a
+                # guarantee; have to check
+                for id in cands:
                     flds = self.col.db.scalar(
                         "select flds from notes where id = ?", id)
                     sflds = splitFields(flds)
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import os
+import re
+from contextlib import contextmanager
+
+from anki.db import sqlite
+from anki.utils import splitFields, json
+
+# Search indexes
+##########################################################################
+# Optional indexes used to speed up searching. They're kept in a separate
+# file next to the collection (attached as 'idx'), so the collection itself
+# stays readable by other clients and unchanged on sync. Temporary triggers
+# keep them up to date with changes made through this connection, and the
+# collection mod time recorded on each save lets us detect changes made
+# elsewhere (eg a full sync download), in which case they're rebuilt.
+
+class TextIndex:
+    "Trigram index of note text, for unqualified searches."
+
+    name = "text"
+    table = "notes_fts"
+
+    def supported(self):
+        # trigram tokenizer requires sqlite 3.34+ built with fts5
+        db = sqlite.connect(":memory:")
+        try:
+            db.execute(
+                "create virtual table t using fts5(a, tokenize='trigram')")
+            return True
+        except sqlite.OperationalError:
+            return False
+        finally:
+            db.close()
+
+    def create(self, db):
+        db.execute("""
+create virtual table if not exists idx.notes_fts using fts5
+(sfld, flds, tokenize='trigram')""")
+
+    def drop(self, db):
+        db.execute("drop table if exists idx.notes_fts")
+
+    def rebuild(self, db):
+        db.execute("delete from idx.notes_fts")
+        db.execute("""
+insert into idx.notes_fts (rowid, sfld, flds)
+select id, sfld, flds from main.notes""")
+
+    def triggers(self):
+        # trigger bodies can't qualify table names. notes are written with
+        # 'insert or replace', which doesn't fire delete triggers.
+        return dict(
+            notes_fts_ins="""
+after insert on main.notes begin
+delete from notes_fts where rowid = new.id;
+insert into notes_fts (rowid, sfld, flds) values (new.id, new.sfld, new.flds);
+end""",
+            notes_fts_upd="""
+after update of sfld, flds on main.notes begin
+delete from notes_fts where rowid = old.id;
+insert into notes_fts (rowid, sfld, flds) values (new.id, new.sfld, new.flds);
+end""",
+            notes_fts_del="""
+after delete on main.notes begin
+delete from notes_fts where rowid = old.id;
+end""")
+
+class FieldIndex:
+    """Each field of each note, for field searches and duplicate checks. val
+is the field as stored, and norm has HTML and media references removed."""
+
+    name = "fields"
+    table = "fields"
+
+    def supported(self):
+        # fields are split with json_each()
+        db = sqlite.connect(":memory:")
+        try:
+            db.execute("select * from json_each('[1]')")
+            return True
+        except sqlite.OperationalError:
+            return False
+        finally:
+            db.close()
+
+    def create(self, db):
+        db.execute("""
+create table if not exists idx.fields (
+    nid integer not null,
+    mid integer not null,
+    ord integer not null,
+    val text collate nocase not null,
+    norm text not null,
+    primary key (nid, ord)
+) without rowid""")
+        # val is case insensitive so 'like' can use the index
+        db.execute("""
+create index if not exists idx.ix_fields_val on fields (mid, ord, val)""")
+        db.execute("""
+create index if not exists idx.ix_fields_norm on fields (mid, ord, norm)""")
+
+    def drop(self, db):
+        db.execute("drop table if exists idx.fields")
+
+    def rebuild(self, db):
+        db.execute("delete from idx.fields")
+        db.execute("""
+insert into idx.fields
+select n.id, n.mid, f.key, f.value, strip_html_media(f.value)
+from main.notes n, json_each(split_fields(n.flds)) f""")
+
+    def triggers(self):
+        ins = """
+insert into fields
+select new.id, new.mid, f.key, f.value, strip_html_media(f.value)
+from json_each(split_fields(new.flds)) f;"""
+        return dict(
+            fields_ins="""
+after insert on main.notes begin
+delete from fields where nid = new.id;%s
+end""" % ins,
+            fields_upd="""
+after update of mid, flds on main.notes begin
+delete from fields where nid = old.id;%s
+end""" % ins,
+            fields_del="""
+after delete on main.notes begin
+delete from fields where nid = old.id;
+end""")
+
+class TagIndex:
+    "Each tag of each note, for tag searches and bulk tag changes."
+
+    name = "tags"
+    table = "notetags"
+
+    supported = FieldIndex.supported
+
+    def create(self, db):
+        # tags are compared case insensitively
+        db.execute("""
+create table if not exists idx.notetags (
+    nid integer not null,
+    tag text collate nocase not null,
+    primary key (nid, tag)
+) without rowid""")
+        db.execute("""
+create index if not exists idx.ix_notetags_tag on notetags (tag, nid)""")
+
+    def drop(self, db):
+        db.execute("drop table if exists idx.notetags")
+
+    def retag(self, db, rows):
+        """Update the entries of the notes in ROWS, (nid, old tags, new tags)
+triples, writing only the tags that differ."""
+        rem = []
+        add = []
+        for nid, old, new in rows:
+            old, new = set(old), set(new)
+            rem.extend((nid, tag) for tag in old - new)
+            add.extend((nid, tag) for tag in new - old)
+        # removals first, as a tag whose case changed matches both
+        db.executemany(
+            "delete from idx.notetags where nid = ? and tag = ?", rem)
+        db.executemany(
+            "insert or ignore into idx.notetags values (?, ?)", add)
+
+    def rebuild(self, db):
+        db.execute("delete from idx.notetags")
+        db.execute("""
+insert or ignore into idx.notetags
+select n.id, t.value from main.notes n, json_each(split_tags(n.tags)) t""")
+
+    def triggers(self):
+        ins = """
+insert or ignore into notetags
+select new.id, t.value from json_each(split_tags(new.tags)) t;"""
+        return dict(
+            notetags_ins="""
+after insert on main.notes begin
+delete from notetags where nid = new.id;%s
+end""" % ins,
+            notetags_upd="""
+after update of tags on main.notes begin
+delete from notetags where nid = old.id;%s
+end""" % ins,
+            notetags_del="""
+after delete on main.notes begin
+delete from notetags where nid = old.id;
+end""")
+
+class RatedIndex:
+    """The time of each card's most recent review, overall and for each
+ease, for rated searches over any number of days."""
+
+    name = "rated"
+    table = "rated"
+
+    def supported(self):
+        return True
+
+    def create(self, db):
+        db.execute("""
+create table if not exists idx.rated (
+    cid integer primary key,
+    last integer not null default 0,
+    last1 integer not null default 0,
+    last2 integer not null default 0,
+    last3 integer not null default 0,
+    last4 integer not null default 0
+)""")
+        for col in self._columns():
+            db.execute("""
+create index if not exists idx.ix_rated_%s on rated (%s)""" % (col, col))
+
+    def drop(self, db):
+        db.execute("drop table if exists idx.rated")
+
+    def rebuild(self, db):
+        db.execute("delete from idx.rated")
+        db.execute("insert into idx.rated %s group by cid" % self._select(
+            "main.revlog"))
+
+    def triggers(self):
+        # reviews are only ever appended, so an insert just moves the times
+        # forward. deleting or changing a log entry recomputes its card.
+        sets = ", ".join(
+            "last%d = case when new.ease = %d then max(last%d, new.id) "
+            "else last%d end" % (e, e, e, e) for e in range(1, 5))
+        recompute = """
+delete from rated where cid = %(c)s.cid;
+insert into rated %(sel)s where cid = %(c)s.cid group by cid;"""
+        return dict(
+            rated_ins="""
+after insert on main.revlog begin
+insert or ignore into rated (cid) values (new.cid);
+update rated set last = max(last, new.id), %s where cid = new.cid;
+end""" % sets,
+            rated_upd="""
+after update of id, cid, ease on main.revlog begin%s%s
+end""" % (recompute % dict(c="old", sel=self._select("revlog")),
+          recompute % dict(c="new", sel=self._select("revlog"))),
+            rated_del="""
+after delete on main.revlog begin%s
+end""" % (recompute % dict(c="old", sel=self._select("revlog"))))
+
+    def _columns(self):
+        return ["last"] + ["last%d" % e for e in range(1, 5)]
+
+    def _select(self, table):
+        eases = ", ".join(
+            "max(case when ease = %d then id else 0 end)" % e
+            for e in range(1, 5))
+        return "select cid, max(id), %s from %s" % (eases, table)
+
+class SavedIndex:
+    """The cards matching materialized saved searches (see
+Finder.materialize()), and the cards changed since they were last brought up
+to date."""
+
+    name = "saved"
+    table = "saved"
+
+    def supported(self):
+        return True
+
+    def create(self, db):
+        # sql and args are what the search compiled to when it was filled
+        db.execute("""
+create table if not exists idx.saved (
+    name text primary key,
+    query text not null,
+    sql text,
+    args text,
+    local integer not null default 0,
+    stale integer not null default 1
+)""")
+        db.execute("""
+create index if not exists idx.ix_saved_query on saved (query)""")
+        db.execute("""
+create table if not exists idx.savedcards (
+    name text not null,
+    cid integer not null,
+    primary key (name, cid)
+) without rowid""")
+        db.execute("""
+create table if not exists idx.saveddirty (cid integer primary key)""")
+
+    def drop(self, db):
+        for table in ("saved", "savedcards", "saveddirty"):
+            db.execute("drop table if exists idx.%s" % table)
+
+    def rebuild(self, db):
+        # the searches are refilled when next used
+        db.execute("update idx.saved set stale = 1")
+        db.execute("delete from idx.saveddirty")
+
+    def triggers(self):
+        notes = """
+insert or ignore into saveddirty select id from cards where nid = new.id;"""
+        return dict(
+            saved_cards_ins="""
+after insert on main.cards begin
+insert or ignore into saveddirty values (new.id);
+end""",
+            saved_cards_upd="""
+after update on main.cards begin
+insert or ignore into saveddirty values (new.id);
+end""",
+            saved_cards_del="""
+after delete on main.cards begin
+insert or ignore into saveddirty values (old.id);
+end""",
+            saved_notes_ins="""
+after insert on main.notes begin%s
+end""" % notes,
+            saved_notes_upd="""
+after update on main.notes begin%s
+end""" % notes)
+
+class QAIndex:
+    "Rendered questions and answers saved by the QA cache (see QACache)."
+
+    name = "qa"
+    table = "qa"
+
+    def supported(self):
+        return True
+
+    def create(self, db):
+        # key is a hash of everything the rendering depended on
+        db.execute("""
+create table if not exists idx.qa (
+    key text primary key,
+    cid integer not null,
+    q text not null,
+    a text not null
+)""")
+        db.execute("create index if not exists idx.ix_qa_cid on qa (cid)")
+
+    def drop(self, db):
+        db.execute("drop table if exists idx.qa")
+
+    def rebuild(self, db):
+        # entries can't go stale, but those of removed cards can be dropped
+        db.execute(
+            "delete from idx.qa where cid not in (select id from main.cards)")
+
+    def triggers(self):
+        return dict(
+            qa_cards_del="""
+after delete on main.cards begin
+delete from qa where cid = old.id;
+end""")
+
+class IndexManager:
+
+    def __init__(self, col):
+        self.col = col
+        self.path = re.sub(r"\.anki2$", ".index.db", col.path)
+        self.indexes = {}
+        for idx in (TextIndex(), FieldIndex(), TagIndex(),
+                    RatedIndex(), SavedIndex(), QAIndex()):
+            self.indexes[idx.name] = idx
+        self._enabled = set()
+        # bumped when indexes are enabled or disabled, as it changes the
+        # generated search SQL
+        self.gen = 0
+
+    def connect(self):
+        "Attach the index file if it exists, rebuilding stale indexes."
+        self._enabled = set()
+        self.gen += 1
+        if not os.path.exists(self.path):
+            return
+        self._attach()
+        mod = self.col.db.scalar("select mod from col")
+        if self._meta("mod") != mod:
+            self.rebuild()
+            self._setMeta("mod", mod)
+            # committing doesn't change the collection
+            mod = self.col.db.mod
+            self.col.db.commit()
+            self.col.db.mod = mod
+
+    def enabled(self, name):
+        return name in self._enabled
+
+    def attachments(self):
+        "Databases that read-only connections should attach."
+        if not self._enabled:
+            return {}
+        return dict(idx=self.path)
+
+    def enable(self, name):
+        """Create and fill index NAME. Returns False if this version of sqlite
+doesn't support it."""
+        idx = self.indexes[name]
+        if name in self._enabled:
+            return True
+        if not idx.supported():
+            return False
+        self._attach()
+        idx.create(self.col.db)
+        idx.rebuild(self.col.db)
+        self._installTriggers(idx)
+        self._enabled.add(name)
+        self.gen += 1
+        # commit, so a later rollback doesn't discard the table or triggers
+        self.col.save()
+        return True
+
+    def disable(self, name):
+        idx = self.indexes[name]
+        if name not in self._enabled:
+            return
+        for tname in idx.triggers():
+            self.col.db.execute("drop trigger if exists temp.%s" % tname)
+        idx.drop(self.col.db)
+        self._enabled.discard(name)
+        self.gen += 1
+        self.col.save()
+
+    @contextmanager
+    def paused(self, name):
+        """Drop index NAME's triggers for the duration, for bulk changes whose
+effect on it the caller applies itself, more cheaply than row by row."""
+        idx = self.indexes[name]
+        for tname in idx.triggers():
+            self.col.db.execute("drop trigger if exists temp.%s" % tname)
+        try:
+            yield idx
+        finally:
+            self._installTriggers(idx)
+
+    def rebuild(self):
+        "Refill all enabled indexes from the collection."
+        for name in self._enabled:
+            self.indexes[name].rebuild(self.col.db)
+
+    def flush(self):
+        "Called when the collection is saved."
+        if self._enabled:
+            self._setMeta("mod", self.col.mod)
+
+    # Internal
+    ######################################################################
+
+    def _attach(self):
+        db = self.col.db
+        if "idx" in db.attached:
+            return
+        db.attach(self.path, "idx")
+        # used by the triggers and rebuild(), with the functions every DB
+        # provides
+        db.createFunction("split_fields", 1,
+                          lambda flds: json.dumps(splitFields(flds)))
+        db.createFunction("split_tags", 1,
+                          lambda tags: json.dumps(self.col.tags.split(tags)))
+        db.execute("pragma idx.journal_mode = %s" %
+                   db.scalar("pragma main.journal_mode"))
+        db.execute("""
+create table if not exists idx.meta (key text primary key, val)""")
+        tables = set(db.list("select name from idx.sqlite_master"))
+        for name, idx in self.indexes.items():
+            if idx.table in tables:
+                self._enabled.add(name)
+                self._installTriggers(idx)
+
+    def _installTriggers(self, idx):
+        for tname, body in idx.triggers().items():
+            self.col.db.execute(
+                "create temp trigger if not exists %s %s" % (tname, body))
+
+    def _meta(self, key):
+        return self.col.db.scalar(
+            "select val from idx.meta where key = ?", key)
+
+    def _setMeta(self, key, val):
+        self.col.db.execute(
+            "insert or replace into idx.meta values (?, ?)", key, val)
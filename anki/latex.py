@@ -4,7 +4,7 @@
 
 import re, os, shutil, html
 from anki.utils import checksum, call, namedtmp, tmpdir, isMac, stripHTML
-from anki.hooks import addHook
+from anki.hooks import addHook, setWorkerUnsafe, skipCache
 from anki.lang import _
 
 pngCommands = [
@@ -67,10 +67,13 @@ def _imgLink(col, latex, model):
 
     # building disabled?
     if not build:
+        # the image may be built later
+        skipCache()
         return "[latex]%s[/latex]" % latex
 
     err = _buildImg(col, txt, fname, model)
     if err:
+        skipCache()
         return err
     else:
         return link
@@ -145,3 +148,5 @@ def _errMsg(type, texpath):
 
 # setup q/a filter
 addHook("mungeQA", mungeQA)
+# builds images in shared temp files, with the collection's media folder
+setWorkerUnsafe(mungeQA)
@@ -263,7 +263,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         mdir = self.dir()
         # gather all media references in NFC form
         allRefs = set()
-        for nid, mid, flds in self.col.db.execute("select id, mid, flds from notes"):
+        for nid, mid, flds in self.col.db.iterate("select id, mid, flds from notes"):
             noteRefs = self.filesInStr(mid, flds)
             # check the refs are in NFC
             for f in noteRefs:
@@ -8,6 +8,8 @@ from anki.utils import intTime, joinFields, splitFields, ids2str,\
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
+from anki.cardgen import availOrds, availClozeOrds, clozeFieldOrds
+import anki.template
 import time
 
 # Models
@@ -76,21 +78,33 @@ class ModelManager:
 
     def __init__(self, col):
         self.col = col
+        # bumped on every change, so caches built from the registry can tell
+        # when they need rebuilding
+        self.gen = 0
 
     def load(self, json_):
         "Load registry from JSON."
         self.changed = False
         self.models = json.loads(json_)
+        self.gen += 1
+        self.col.completion.reset("models")
+        self.col.completion.reset("fields")
 
     def save(self, m=None, templates=False):
         "Mark M modified if provided, and schedule registry flush."
         if m and m['id']:
             m['mod'] = intTime()
             m['usn'] = self.col.usn()
+            # drop compiled copies of the old templates
+            anki.template.compiled.clearCache()
             self._updateRequired(m)
             if templates:
                 self._syncTemplates(m)
         self.changed = True
+        self.gen += 1
+        # names may have changed
+        self.col.completion.reset("models")
+        self.col.completion.reset("fields")
         runHook("newModel")
 
     def flush(self):
@@ -362,12 +376,14 @@ select c.id from cards c, notes f where c.nid=f.id and mid = ? and ord = ?""",
                                  m['id'], ord)
         # all notes with this template must have at least two cards, or we
         # could end up creating orphaned notes
-        if self.col.db.scalar("""
+        with self.col.db.boundIds(cids) as scids:
+            orphans = self.col.db.scalar("""
 select nid, count() from cards where
 nid in (select nid from cards where id in %s)
 group by nid
 having count() < 2
-limit 1""" % ids2str(cids)):
+limit 1""" % scids)
+        if orphans:
             return False
         # ok to proceed; remove cards
         self.col.modSchema(check=True)
@@ -409,7 +425,7 @@ select id from notes where mid = ?)""" % " ".join(map),
                              self.col.usn(), intTime(), m['id'])
 
     def _syncTemplates(self, m):
-        rem = self.col.genCards(self.nids(m))
+        self.col.cardgen.generate([m['id']])
 
     # Model changing
     ##########################################################################
@@ -428,8 +444,10 @@ select id from notes where mid = ?)""" % " ".join(map),
     def _changeNotes(self, nids, newModel, map):
         d = []
         nfields = len(newModel['flds'])
-        for (nid, flds) in self.col.db.execute(
-            "select id, flds from notes where id in "+ids2str(nids)):
+        with self.col.db.boundIds(nids) as snids:
+            rows = self.col.db.all(
+                "select id, flds from notes where id in "+snids)
+        for (nid, flds) in rows:
             newflds = {}
             flds = splitFields(flds)
             for old, new in list(map.items()):
@@ -447,8 +465,10 @@ select id from notes where mid = ?)""" % " ".join(map),
     def _changeCards(self, nids, oldModel, newModel, map):
         d = []
         deleted = []
-        for (cid, ord) in self.col.db.execute(
-            "select id, ord from cards where nid in "+ids2str(nids)):
+        with self.col.db.boundIds(nids) as snids:
+            rows = self.col.db.all(
+                "select id, ord from cards where nid in "+snids)
+        for (cid, ord) in rows:
             # if the src model is a cloze, we ignore the map, as the gui
             # doesn't currently support mapping them
             if oldModel['type'] == MODEL_CLOZE:
@@ -536,56 +556,17 @@ select id from notes where mid = ?)""" % " ".join(map),
 
     def availOrds(self, m, flds):
         "Given a joined field string, return available template ordinals."
+        return availOrds(self.genSpec(m), flds)
+
+    def genSpec(self, m):
+        """What card generation needs from M, as a picklable tuple:
+(MODEL_STD, req) or (MODEL_CLOZE, ords of fields used in cloze tags)."""
         if m['type'] == MODEL_CLOZE:
-            return self._availClozeOrds(m, flds)
-        fields = {}
-        for c, f in enumerate(splitFields(flds)):
-            fields[c] = f.strip()
-        avail = []
-        for ord, type, req in m['req']:
-            # unsatisfiable template
-            if type == "none":
-                continue
-            # AND requirement?
-            elif type == "all":
-                ok = True
-                for idx in req:
-                    if not fields[idx]:
-                        # missing and was required
-                        ok = False
-                        break
-                if not ok:
-                    continue
-            # OR requirement?
-            elif type == "any":
-                ok = False
-                for idx in req:
-                    if fields[idx]:
-                        ok = True
-                        break
-                if not ok:
-                    continue
-            avail.append(ord)
-        return avail
+            return MODEL_CLOZE, clozeFieldOrds(m)
+        return MODEL_STD, m['req']
 
     def _availClozeOrds(self, m, flds, allowEmpty=True):
-        sflds = splitFields(flds)
-        map = self.fieldMap(m)
-        ords = set()
-        matches = re.findall("{{[^}]*?cloze:(?:[^}]?:)*(.+?)}}", m['tmpls'][0]['qfmt'])
-        matches += re.findall("<%cloze:(.+?)%>", m['tmpls'][0]['qfmt'])
-        for fname in matches:
-            if fname not in map:
-                continue
-            ord = map[fname][0]
-            ords.update([int(m)-1 for m in re.findall(
-                "(?s){{c(\d+)::.+?}}", sflds[ord])])
-        if -1 in ords:
-            ords.remove(-1)
-        if not ords and allowEmpty:
-            # empty clozes use first ord
-            return [0]
-        return list(ords)
+        return availClozeOrds(clozeFieldOrds(m), flds, allowEmpty)
 
     # Sync handling
     ##########################################################################
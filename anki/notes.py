@@ -2,15 +2,26 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+from anki.cards import Card
 from anki.utils import fieldChecksum, intTime, \
     joinFields, splitFields, stripHTMLMedia, timestampID, guid64
 
 class Note:
 
-    def __init__(self, col, model=None, id=None):
+    # slots, as many notes may be loaded at once. newlyAdded is set when
+    # flushing; __dict__ is kept for attributes add-ons set.
+    __slots__ = ("col", "id", "guid", "mid", "mod", "usn", "tags", "fields",
+                 "flags", "data", "_model", "_fmap", "scm", "newlyAdded",
+                 "__dict__")
+
+    def __init__(self, col, model=None, id=None, row=None):
+        """Load note ID, or a row from getNotes(), or create a new note of
+MODEL."""
         assert not (model and id)
         self.col = col
-        if id:
+        if row:
+            self._setRow(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -25,17 +36,23 @@ class Note:
             self._fmap = self.col.models.fieldMap(self._model)
             self.scm = self.col.scm
 
+    # the columns _setRow() expects
+    loadColumns = "id, guid, mid, mod, usn, tags, flds, flags, data"
+
     def load(self):
-        (self.guid,
+        self._setRow(self.col.db.first(
+            "select %s from notes where id = ?" % self.loadColumns, self.id))
+
+    def _setRow(self, row):
+        (self.id,
+         self.guid,
          self.mid,
          self.mod,
          self.usn,
          self.tags,
          self.fields,
          self.flags,
-         self.data) = self.col.db.first("""
-select guid, mid, mod, usn, tags, flds, flags, data
-from notes where id = ?""", self.id)
+         self.data) = row
         self.fields = splitFields(self.fields)
         self.tags = self.col.tags.split(self.tags)
         self._model = self.col.models.get(self.mid)
@@ -69,8 +86,8 @@ insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)""",
         return joinFields(self.fields)
 
     def cards(self):
-        return [self.col.getCard(id) for id in self.col.db.list(
-            "select id from cards where nid = ? order by ord", self.id)]
+        return [Card(self.col, row=row) for row in self.col.db.all(
+            "select * from cards where nid = ? order by ord", self.id)]
 
     def model(self):
         return self._model
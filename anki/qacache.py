@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+from collections import OrderedDict
+
+import anki
+from anki import hooks
+from anki.consts import MODEL_STD
+from anki.find import _lruGet, _lruPut
+from anki.utils import checksum
+
+"""
+A cache of rendered questions and answers.
+
+Entries are keyed on everything rendering reads: the card's row and its
+note's fields and tags, the deck name, the note type's mod time and the
+templates used. An edit to any of them gives a new key, so nothing needs
+invalidating; stale entries fall out of the LRU. If the 'qa' index is enabled
+(see anki/indexes.py), entries are also saved next to the collection and
+reused across sessions.
+
+The mungeFields and mungeQA filters are assumed to give the same output for
+the same card, unless they call hooks.skipCache(), in which case that render
+isn't kept. When filters are added or removed, the entries in memory are
+dropped, and saved ones are keyed on the filters registered as well.
+"""
+
+class QACache:
+
+    # rendered cards to keep in memory
+    cacheSize = 2000
+    # rendered cards to keep in the index file
+    persistSize = 100000
+
+    def __init__(self, col):
+        self.col = col
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._filterChanges = None
+        self._filters = ()
+
+    def render(self, data, qfmt=None, afmt=None, textOnly=False):
+        "Like Collection._renderQA(), reusing earlier results where possible."
+        self._checkFilters()
+        key = self._key(data, qfmt, afmt, textOnly)
+        if key is None:
+            # note type missing; let rendering raise as usual
+            return self.col._renderQA(data, qfmt, afmt, textOnly)
+        res = _lruGet(self._cache, key)
+        if res is None and self._persisted():
+            res = self._load(data[0], key)
+        if res is not None:
+            self.hits += 1
+            # callers may modify the dict
+            return dict(res)
+        self.misses += 1
+        hooks._skipCache = False
+        res = self.col._renderQA(data, qfmt, afmt, textOnly)
+        if hooks._skipCache:
+            return res
+        _lruPut(self._cache, key, dict(res), self.cacheSize)
+        if self._persisted():
+            self._save(data[0], key, res)
+        return res
+
+    def clear(self):
+        "Drop all entries, eg after changing what a filter outputs."
+        self._cache = OrderedDict()
+        if self._persisted():
+            self._write("delete from idx.qa")
+
+    def stats(self):
+        "Return hits, misses, size and limit, and the hit rate."
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._cache), limit=self.cacheSize,
+                    hitRate=self.hits / total if total else 0.0)
+
+    # Internal
+    ######################################################################
+
+    def _checkFilters(self):
+        "Start again if the filters rendering runs have changed."
+        changes = (hooks.hookChanges("mungeFields"),
+                   hooks.hookChanges("mungeQA"))
+        if changes == self._filterChanges:
+            return
+        self._filterChanges = changes
+        self._cache = OrderedDict()
+        self._filters = tuple(
+            "%s.%s" % (f.__module__, getattr(f, "__qualname__", repr(f)))
+            for name in ("mungeFields", "mungeQA")
+            for f in hooks._hooks.get(name) or [])
+
+    def _key(self, data, qfmt, afmt, textOnly):
+        # data is [cid, nid, mid, did, ord, tags, flds, cardFlags]
+        model = self.col.models.get(data[2])
+        if not model:
+            return None
+        if model['type'] == MODEL_STD:
+            template = model['tmpls'][data[4]]
+        else:
+            template = model['tmpls'][0]
+        return (data[0], data[1], data[2], data[4], data[5], data[6], data[7],
+                self.col.decks.name(data[3]), model['mod'], model['name'],
+                template['name'],
+                qfmt or template['qfmt'], afmt or template['afmt'], textOnly)
+
+    def _persisted(self):
+        return self.col.indexes.enabled("qa")
+
+    def _hash(self, key):
+        # the version too, as rendering may differ between releases, and the
+        # filters, which may differ between sessions
+        return checksum(repr((anki.version, self._filters) + key))
+
+    def _load(self, cid, key):
+        row = self.col.db.first(
+            "select q, a from idx.qa where key = ?", self._hash(key))
+        if not row:
+            return None
+        res = dict(id=cid, q=row[0], a=row[1])
+        _lruPut(self._cache, key, res, self.cacheSize)
+        return res
+
+    def _save(self, cid, key, res):
+        self._write("insert or replace into idx.qa values (?, ?, ?, ?)",
+                    self._hash(key), cid, res['q'], res['a'])
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            # rows are renumbered when replaced, so this drops the least
+            # recently rendered
+            self._write("""
+delete from idx.qa where rowid <= (select max(rowid) from idx.qa) - ?""",
+                        self.persistSize)
+
+    def _write(self, sql, *args):
+        # the index file doesn't count as a change to the collection, nor
+        # invalidate search results
+        self.col.db.executeQuietly(sql, *args)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import collections
+import functools
+import multiprocessing
+import re
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import anki.template
+from anki import hooks
+from anki.cardgen import availClozeOrds, clozeFieldOrds
+from anki.consts import *
+from anki.hooks import runFilter
+from anki.lang import _
+from anki.sound import stripSounds
+from anki.utils import splitFields, htmlToTextLine
+
+"""
+Rendering questions and answers, in this process or across worker processes.
+
+Rendering a card only needs its row, its note type and its deck's name, so
+renderCard() takes those rather than the collection. For bulk renders, rows
+are streamed in batches to a process pool that holds a snapshot of the note
+types and deck names, and results are yielded in order with only a few
+batches in flight.
+
+Filters on the mungeFields and mungeQA hooks run in the workers too, without a
+collection. Workers are forked, so they see the filters registered at the
+time. Forking copies only the calling thread, so a lock another thread holds,
+eg in sqlite or the GUI toolkit, would stay locked in the workers; rendering
+therefore stays in this process while other threads are running, as in the
+desktop app, and also where fork isn't available or python is older than 3.7.
+Filters that need a collection, or that aren't safe to run several at once (eg
+LaTeX, which writes to shared temp files), should be registered with
+hooks.setWorkerUnsafe(), and while any are, rendering stays in this process
+too. Filters can't be run afterwards on the workers' output instead, as the
+answer's {{FrontSide}} is built from the filtered question.
+
+With textOnly, mungeQA filters are skipped altogether, so no media or LaTeX
+images are generated, and the output is reduced to a line of plain text, as
+the browser's columns and the text exporter want. The answer's text leaves out
+the question: everything up to <hr id=answer> is cut, or where a template has
+no marker, a leading copy of the question's text. An answer format passed in,
+like the browser's own, is kept verbatim.
+"""
+
+@functools.lru_cache(maxsize=1000)
+def clozeFormat(format, type, ord):
+    "Point the cloze tags in FORMAT at cloze ORD, for side TYPE."
+    if type == "q":
+        format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % ord, format)
+        return format.replace("<%cloze:", "<%%cq:%d:" % ord)
+    format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % ord, format)
+    return format.replace("<%cloze:", "<%%ca:%d:" % ord)
+
+def flagName(flags):
+    flag = flags & 0b111
+    if not flag:
+        return ""
+    return "flag%d" % flag
+
+def renderCard(data, model, deckName, qfmt=None, afmt=None, col=None,
+               filter=runFilter, textOnly=False):
+    """Returns hash of id, question, answer.
+DATA is [cid, nid, mid, did, ord, tags, flds, cardFlags]. Hooks are run with
+FILTER, and passed COL. If TEXTONLY, return plain text without munging."""
+    # a custom answer format is shown as is
+    verbatim = bool(afmt)
+    # unpack fields and create dict
+    flist = splitFields(data[6])
+    fields = {}
+    for f in model['flds']:
+        fields[f['name']] = flist[f['ord']]
+    fields['Tags'] = data[5].strip()
+    fields['Type'] = model['name']
+    fields['Deck'] = deckName
+    fields['Subdeck'] = fields['Deck'].split('::')[-1]
+    fields['CardFlag'] = flagName(data[7])
+    if model['type'] == MODEL_STD:
+        template = model['tmpls'][data[4]]
+    else:
+        template = model['tmpls'][0]
+    fields['Card'] = template['name']
+    fields['c%d' % (data[4]+1)] = "1"
+    # render q & a
+    d = dict(id=data[0])
+    qfmt = qfmt or template['qfmt']
+    afmt = afmt or template['afmt']
+    for (type, format) in (("q", qfmt), ("a", afmt)):
+        format = clozeFormat(format, type, data[4]+1)
+        if type == "a":
+            fields['FrontSide'] = stripSounds(d['q'])
+        fields = filter("mungeFields", fields, model, data, col)
+        html = anki.template.render(format, fields)
+        if textOnly:
+            d[type] = html
+        else:
+            d[type] = filter(
+                "mungeQA", html, type, fields, model, data, col)
+        # empty cloze?
+        if type == 'q' and model['type'] == MODEL_CLOZE:
+            if not availClozeOrds(clozeFieldOrds(model), data[6], False):
+                d['q'] += ("<p>" + _(
+            "Please edit this note and add some cloze deletions. (%s)") % (
+            "<a href=%s#cloze>%s</a>" % (HELP_SITE, _("help"))))
+    if textOnly:
+        d['q'] = htmlToTextLine(d['q'])
+        if verbatim:
+            d['a'] = htmlToTextLine(d['a'])
+        else:
+            d['a'] = answerText(d['a'], d['q'])
+    return d
+
+def answerText(html, q):
+    "The answer HTML as a line of text, without the question text Q."
+    if "<hr id=answer>" in html:
+        # cut before converting, as the text could start with anything
+        return htmlToTextLine(re.sub("(?si)^.*<hr id=answer>", "", html))
+    a = htmlToTextLine(html)
+    if a.startswith(q):
+        a = a[len(q):].strip()
+    return a
+
+# Bulk rendering
+##########################################################################
+
+# set in each worker process by _initWorker()
+_snapshot = None
+
+def _initWorker(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+def _renderBatch(rows, qfmt, afmt, textOnly):
+    models, decks = _snapshot
+    return [renderCard(row, models[row[2]], decks.get(row[3], _("[no deck]")),
+                       qfmt, afmt, None, runFilter, textOnly)
+            for row in rows]
+
+class Renderer:
+    "Render rows from Collection._qaData() in batches, optionally in parallel."
+
+    # rows handed to a worker at a time
+    batchSize = 200
+
+    def __init__(self, col, workers=0):
+        self.col = col
+        self.workers = workers
+        # spawned workers wouldn't see filters added at runtime, and the
+        # pool's initializer and mp_context need python 3.7
+        if "fork" not in multiprocessing.get_all_start_methods() or \
+           sys.version_info < (3, 7):
+            self.workers = 0
+
+    def _inProcess(self, textOnly):
+        "True if a filter that will run isn't safe in a worker."
+        hooksRun = ["mungeFields"] if textOnly else ["mungeFields", "mungeQA"]
+        return any(hooks.workerUnsafe(f)
+                   for name in hooksRun for f in hooks._hooks.get(name) or [])
+
+    def _threaded(self):
+        "True if forking now could copy a lock held by another thread."
+        return threading.active_count() > 1
+
+    def render(self, rows, qfmt=None, afmt=None, textOnly=False):
+        "Yield the render of each of ROWS, in order."
+        if not self.workers or self._inProcess(textOnly) or self._threaded():
+            for row in rows:
+                yield self.col._renderQA(row, qfmt, afmt, textOnly)
+            return
+        col = self.col
+        snapshot = (dict((int(m['id']), m) for m in col.models.all()),
+                    dict((int(d['id']), d['name']) for d in col.decks.all()))
+        pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("fork"),
+            initializer=_initWorker, initargs=(snapshot,))
+        try:
+            pending = collections.deque()
+            for batch in self._batches(rows):
+                pending.append(pool.submit(
+                    _renderBatch, batch, qfmt, afmt, textOnly))
+                # keep memory bounded
+                if len(pending) > self.workers*2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # stop early, eg if the caller stops iterating
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
+
+    def _batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) == self.batchSize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
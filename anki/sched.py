@@ -92,6 +92,8 @@ class Scheduler:
         card.mod = intTime()
         card.usn = self.col.usn()
         card.flushSched()
+        # writes made after answering aren't part of the review
+        self.col.undoJournal.close()
 
     def counts(self, card=None):
         counts = [self.newCount, self.lrnCount, self.revCount]
@@ -1354,16 +1356,17 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
 
     def resetCards(self, ids):
         "Completely reset cards for export."
-        sids = ids2str(ids)
-        # we want to avoid resetting due number of existing new cards on export
-        nonNew = self.col.db.list(
-            "select id from cards where id in %s and (queue != 0 or type != 0)"
-            % sids)
-        # reset all cards
-        self.col.db.execute(
-            "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
-            " where id in %s" % sids
-        )
+        with self.col.db.boundIds(ids) as sids:
+            # we want to avoid resetting due number of existing new cards on
+            # export
+            nonNew = self.col.db.list(
+                "select id from cards where id in %s and (queue != 0 or type != 0)"
+                % sids)
+            # reset all cards
+            self.col.db.execute(
+                "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
+                " where id in %s" % sids
+            )
         # and forget any non-new cards, changing their due numbers
         self.forgetCards(nonNew)
         self.col.log(ids)
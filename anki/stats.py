@@ -99,8 +99,10 @@ colSusp = "#ff0"
 
 class CollectionStats:
 
-    def __init__(self, col):
+    def __init__(self, col, db=None):
         self.col = col
+        # may be a pooled reader, so the report can be built off the main thread
+        self.db = db or col.db
         self._stats = None
         self.type = 0
         self.width = 600
@@ -147,7 +149,7 @@ body {background-image: url(data:image/png;base64,%s); }
         lim = self._revlogLimit()
         if lim:
             lim = " and " + lim
-        cards, thetime, failed, lrn, rev, relrn, filt = self.col.db.first("""
+        cards, thetime, failed, lrn, rev, relrn, filt = self.db.first("""
 select count(), sum(time)/1000,
 sum(case when ease = 1 then 1 else 0 end), /* failed */
 sum(case when type = 0 then 1 else 0 end), /* learning */
@@ -181,7 +183,7 @@ from revlog where id > ? """+lim, (self.col.sched.dayCutoff-86400)*1000)
             b += (_("Learn: %(a)s, Review: %(b)s, Relearn: %(c)s, Filtered: %(d)s")
                   % dict(a=bold(lrn), b=bold(rev), c=bold(relrn), d=bold(filt)))
             # mature today
-            mcnt, msum = self.col.db.first("""
+            mcnt, msum = self.db.first("""
     select count(), sum(case when ease = 1 then 0 else 1 end) from revlog
     where lastIvl >= 21 and id > ?"""+lim, (self.col.sched.dayCutoff-86400)*1000)
             b += "<br>"
@@ -240,7 +242,7 @@ from revlog where id > ? """+lim, (self.col.sched.dayCutoff-86400)*1000)
         self._line(i, _("Total"), ngettext("%d review", "%d reviews", tot) % tot)
         self._line(i, _("Average"), self._avgDay(
             tot, num, _("reviews")))
-        tomorrow = self.col.db.scalar("""
+        tomorrow = self.db.scalar("""
 select count() from cards where did in %s and queue in (2,3)
 and due = ?""" % self._limit(), self.col.sched.today+1)
         tomorrow = ngettext("%d card", "%d cards", tomorrow) % tomorrow
@@ -253,7 +255,7 @@ and due = ?""" % self._limit(), self.col.sched.today+1)
             lim += " and due-:today >= %d" % start
         if end is not None:
             lim += " and day < %d" % end
-        return self.col.db.all("""
+        return self.db.all("""
 select (due-:today)/:chunk as day,
 sum(case when ivl < 21 then 1 else 0 end), -- yng
 sum(case when ivl >= 21 then 1 else 0 end) -- mtr
@@ -450,7 +452,7 @@ group by day order by day""" % (self._limit(), lim),
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.col.db.all("""
+        return self.db.all("""
 select
 (cast((id/1000.0 - :cut) / 86400.0 as int))/:chunk as day,
 count(id)
@@ -473,7 +475,7 @@ group by day order by day""" % lim, cut=self.col.sched.dayCutoff,tf=tf, chunk=ch
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.col.db.all("""
+        return self.db.all("""
 select
 (cast((id/1000.0 - :cut) / 86400.0 as int))/:chunk as day,
 sum(case when type = 0 then 1 else 0 end), -- lrn count
@@ -507,7 +509,7 @@ group by day order by day""" % lim,
             lim = "where " + " and ".join(lims)
         else:
             lim = ""
-        return self.col.db.first("""
+        return self.db.first("""
 select count(), abs(min(day)) from (select
 (cast((id/1000 - :cut) / 86400.0 as int)+1) as day
 from revlog %s
@@ -553,12 +555,12 @@ group by day order by day)""" % lim,
             chunk = 7; lim = " and grp <= 52"
         else:
             chunk = 30; lim = ""
-        data = [self.col.db.all("""
+        data = [self.db.all("""
 select ivl / :chunk as grp, count() from cards
 where did in %s and queue = 2 %s
 group by grp
 order by grp""" % (self._limit(), lim), chunk=chunk)]
-        return data + list(self.col.db.first("""
+        return data + list(self.db.first("""
 select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
                                          self._limit()))
 
@@ -641,7 +643,7 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
             ease4repl = "3"
         else:
             ease4repl = "ease"
-        return self.col.db.all("""
+        return self.db.all("""
 select (case
 when type in (0,2) then 0
 when lastIvl < 21 then 1
@@ -712,7 +714,7 @@ order by thetype, ease""" % (ease4repl, lim))
         pd = self._periodDays()
         if pd:
             lim += " and id > %d" % ((self.col.sched.dayCutoff-(86400*pd))*1000)
-        return self.col.db.all("""
+        return self.db.all("""
 select
 23 - ((cast((:cut - id/1000) / 3600.0 as int)) %% 24) as hour,
 sum(case when ease = 1 then 0 else 1 end) /
@@ -737,7 +739,7 @@ group by hour having count() > 30 order by hour""" % lim,
             d.append(dict(data=div[c], label="%s: %s" % (t, div[c]), color=col))
         # text data
         i = []
-        (c, f) = self.col.db.first("""
+        (c, f) = self.db.first("""
 select count(id), count(distinct nid) from cards
 where did in %s """ % self._limit())
         self._line(i, _("Total cards"), c)
@@ -770,7 +772,7 @@ when you answer "good" on a review.''')
         return "<table width=400>" + "".join(i) + "</table>"
 
     def _factors(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 min(factor) / 10.0,
 avg(factor) / 10.0,
@@ -778,7 +780,7 @@ max(factor) / 10.0
 from cards where did in %s and queue = 2""" % self._limit())
 
     def _cards(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 sum(case when queue=2 and ivl >= 21 then 1 else 0 end), -- mtr
 sum(case when queue in (1,3) or (queue=2 and ivl < 21) then 1 else 0 end), -- yng/lrn
@@ -922,10 +924,10 @@ $(function () {
         if lim:
             lim = " where " + lim
         if by == 'review':
-            t = self.col.db.scalar("select id from revlog %s order by id limit 1" % lim)
+            t = self.db.scalar("select id from revlog %s order by id limit 1" % lim)
         elif by == 'add':
             lim = "where did in %s" % ids2str(self.col.decks.active())
-            t = self.col.db.scalar("select id from cards %s order by id limit 1" % lim)
+            t = self.db.scalar("select id from cards %s order by id limit 1" % lim)
         if not t:
             period = 1
         else:
@@ -13,9 +13,64 @@ from anki.consts import *
 from anki.stdmodels import addBasicModel, addClozeModel, addForwardReverse, \
     addForwardOptionalReverse, addBasicTypingModel
 
-def Collection(path, lock=True, server=False, log=False):
-    "Open a new or existing collection. Path must be unicode."
+# SQLite tuning
+######################################################################
+
+# desktop matches the settings used before profiles were introduced
+tuningProfiles = {
+    'desktop': {
+        'temp_store': "memory",
+        'cache_size': 10000,
+        'journal_mode': "wal",
+    },
+    # large caches and memory mapped reads; WAL makes synchronous=normal safe
+    # against corruption, but the last commits may be lost on power failure
+    'server': {
+        'temp_store': "memory",
+        'cache_size': -256*1024,
+        'mmap_size': 256*1024*1024,
+        'synchronous': "normal",
+        'journal_mode': "wal",
+    },
+    'low-memory': {
+        'temp_store': "file",
+        'cache_size': -2*1024,
+        'mmap_size': 0,
+        'journal_mode': "wal",
+    },
+}
+
+# these can only be changed when the collection is created
+creationPragmas = ("page_size", "auto_vacuum")
+# and this one is handled separately, as it persists in the file
+connectionPragmas = ("temp_store", "cache_size", "mmap_size", "synchronous")
+
+def tuningPragmas(tuning="desktop", pragmas=None):
+    "Return the pragmas for profile TUNING, with PRAGMAS overriding them."
+    if tuning not in tuningProfiles:
+        raise Exception("Unknown tuning profile: %s" % tuning)
+    conf = dict(tuningProfiles[tuning])
+    # WAL is not used on Windows unless explicitly asked for
+    if isWin and not (pragmas and 'journal_mode' in pragmas):
+        del conf['journal_mode']
+    conf.update(pragmas or {})
+    for k in conf:
+        if k not in creationPragmas + connectionPragmas + ("journal_mode",):
+            raise Exception("Unsupported pragma: %s" % k)
+    return conf
+
+def Collection(path, lock=True, server=False, log=False, readers=0,
+               tuning="desktop", pragmas=None):
+    """Open a new or existing collection. Path must be unicode.
+
+If READERS is set, a pool of that many read-only connections is opened as
+well; see _Collection.reader().
+
+TUNING selects one of the SQLite settings in tuningProfiles, and PRAGMAS is
+an optional dict of individual settings that override it, eg
+{'mmap_size': 0}. page_size and auto_vacuum only apply to new collections."""
     assert path.endswith(".anki2")
+    conf = tuningPragmas(tuning, pragmas)
     path = os.path.abspath(path)
     create = not os.path.exists(path)
     if create:
@@ -26,16 +81,20 @@ def Collection(path, lock=True, server=False, log=False):
     db = DB(path)
     db.setAutocommit(True)
     if create:
-        ver = _createDB(db)
+        ver = _createDB(db, conf)
     else:
         ver = _upgradeSchema(db)
-    db.execute("pragma temp_store = memory")
-    db.execute("pragma cache_size = 10000")
-    if not isWin:
-        db.execute("pragma journal_mode = wal")
+    db.setPragmas(dict((k, v) for k, v in conf.items()
+                       if k in connectionPragmas))
+    if 'journal_mode' in conf:
+        db.execute("pragma journal_mode = %s" % conf['journal_mode'])
     db.setAutocommit(False)
     # add db to col and do any remaining upgrades
     col = _Collection(db, server, log)
+    col.tuning = tuning
+    col.pragmas = dict((k, v) for k, v in conf.items()
+                       if k in connectionPragmas)
+    col.journalMode = conf.get('journal_mode')
     if ver < SCHEMA_VERSION:
         _upgrade(col, ver)
     elif ver > SCHEMA_VERSION:
@@ -50,6 +109,10 @@ def Collection(path, lock=True, server=False, log=False):
         col.save()
     if lock:
         col.lock()
+    if readers:
+        # readers can only see what has been committed
+        col.save()
+        col.openReaders(readers)
     return col
 
 def _upgradeSchema(db):
@@ -203,8 +266,11 @@ def _upgradeClozeModel(col, m):
 # Creating a new collection
 ######################################################################
 
-def _createDB(db):
-    db.execute("pragma page_size = 4096")
+def _createDB(db, conf=None):
+    conf = conf or {}
+    db.execute("pragma page_size = %d" % int(conf.get('page_size', 4096)))
+    if 'auto_vacuum' in conf:
+        db.execute("pragma auto_vacuum = %s" % conf['auto_vacuum'])
     db.execute("pragma legacy_file_format = 0")
     db.execute("vacuum")
     _addSchema(db)
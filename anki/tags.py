@@ -21,10 +21,13 @@ class TagManager:
 
     def __init__(self, col):
         self.col = col
+        # canonical tag names, while bulk edits are in progress
+        self._canon = None
 
     def load(self, json_):
         self.tags = json.loads(json_)
         self.changed = False
+        self.col.completion.reset("tags")
 
     def flush(self):
         if self.changed:
@@ -37,13 +40,14 @@ class TagManager:
 
     def register(self, tags, usn=None):
         "Given a list of tags, add any missing ones to tag registry."
-        found = False
+        found = []
         for t in tags:
             if t not in self.tags:
-                found = True
+                found.append(t)
                 self.tags[t] = self.col.usn() if usn is None else usn
                 self.changed = True
         if found:
+            self.col.completion.add("tags", found)
             runHook("newTag")
 
     def all(self):
@@ -52,14 +56,36 @@ class TagManager:
     def registerNotes(self, nids=None):
         "Add any missing tags from notes to the tags list."
         # when called without an argument, the old list is cleared first.
+        if self.col.indexes.enabled("tags"):
+            self._registerIndexed(nids)
+            return
+        if nids:
+            with self.col.db.boundIds(nids) as snids:
+                res = self.col.db.list(
+                    "select distinct tags from notes where id in "+snids)
+        else:
+            res = self.col.db.list("select distinct tags from notes")
+            self.registerAll(set(self.split(" ".join(res))))
+            return
+        self.register(set(self.split(" ".join(res))))
+
+    def _registerIndexed(self, nids):
+        # the tags are already split, and distinct ignoring case
+        sql = "select distinct tag collate binary from idx.notetags"
         if nids:
-            lim = " where id in " + ids2str(nids)
+            with self.col.db.boundIds(nids) as snids:
+                res = self.col.db.list(sql + " where nid in " + snids)
         else:
-            lim = ""
-            self.tags = {}
-            self.changed = True
-        self.register(set(self.split(
-            " ".join(self.col.db.list("select distinct tags from notes"+lim)))))
+            self.registerAll(self.col.db.list(sql))
+            return
+        self.register(res)
+
+    def registerAll(self, tags):
+        "Replace the tags list with TAGS."
+        self.tags = {}
+        self.changed = True
+        self.col.completion.reset("tags")
+        self.register(tags)
 
     def allItems(self):
         return list(self.tags.items())
@@ -68,16 +94,17 @@ class TagManager:
         self.changed = True
 
     def byDeck(self, did, children=False):
-        basequery = "select n.tags from cards c, notes n WHERE c.nid = n.id"
-        if not children:
-            query = basequery + " AND c.did=?"
-            res = self.col.db.list(query, did)
-            return list(set(self.split(" ".join(res))))
         dids = [did]
-        for name, id in self.col.decks.children(did):
-            dids.append(id)
-        query = basequery + " AND c.did IN " + ids2str(dids)
-        res = self.col.db.list(query)
+        if children:
+            for name, id in self.col.decks.children(did):
+                dids.append(id)
+        if self.col.indexes.enabled("tags"):
+            return self.col.db.list("""
+select distinct t.tag collate binary from cards c, idx.notetags t
+where c.nid = t.nid and c.did in """ + ids2str(dids))
+        res = self.col.db.list("""
+select n.tags from cards c, notes n WHERE c.nid = n.id
+AND c.did IN """ + ids2str(dids))
         return list(set(self.split(" ".join(res))))
 
     # Bulk addition/removal from notes
@@ -98,22 +125,45 @@ class TagManager:
         else:
             l = "tags "
             fn = self.remFromStr
-        lim = " or ".join(
-            [l+"like :_%d" % c for c, t in enumerate(newTags)])
-        res = self.col.db.all(
-            "select id, tags from notes where id in %s and (%s)" % (
-                ids2str(ids), lim),
-            **dict([("_%d" % x, '%% %s %%' % y.replace('*', '%'))
-                    for x, y in enumerate(newTags)]))
+        if self.col.indexes.enabled("tags"):
+            # notes having (or when adding, missing) any of the tags
+            l = "id not in " if add else "id in "
+            l += "(select nid from idx.notetags where tag "
+            lim = " or ".join(
+                [l+"like :_%d)" % c for c, t in enumerate(newTags)])
+            pats = dict([("_%d" % x, y.replace('*', '%'))
+                         for x, y in enumerate(newTags)])
+        else:
+            lim = " or ".join(
+                [l+"like :_%d" % c for c, t in enumerate(newTags)])
+            pats = dict([("_%d" % x, '%% %s %%' % y.replace('*', '%'))
+                         for x, y in enumerate(newTags)])
+        with self.col.db.boundIds(ids) as sids:
+            res = self.col.db.all(
+                "select id, tags from notes where id in %s and (%s)" % (
+                    sids, lim), **pats)
         # update tags
         nids = []
         def fix(row):
             nids.append(row[0])
             return {'id': row[0], 't': fn(tags, row[1]), 'n':intTime(),
                 'u':self.col.usn()}
-        self.col.db.executemany(
-            "update notes set tags=:t,mod=:n,usn=:u where id = :id",
-            [fix(row) for row in res])
+        # the registry doesn't change while the notes are updated
+        self._canon = self._canonMap()
+        try:
+            rows = [fix(row) for row in res]
+        finally:
+            self._canon = None
+        sql = "update notes set tags=:t,mod=:n,usn=:u where id = :id"
+        if not self.col.indexes.enabled("tags"):
+            self.col.db.executemany(sql, rows)
+            return
+        # the index is updated in one go rather than by its triggers
+        with self.col.indexes.paused("tags") as idx:
+            self.col.db.executemany(sql, rows)
+        idx.retag(self.col.db, [
+            (row[0], self.split(row[1]), self.split(r['t']))
+            for row, r in zip(res, rows)])
 
     def bulkRem(self, ids, tags):
         self.bulkAdd(ids, tags, False)
@@ -161,15 +211,18 @@ class TagManager:
 
     def canonify(self, tagList):
         "Strip duplicates, adjust case to match existing tags, and sort."
+        canon = self._canon or self._canonMap()
         strippedTags = []
         for t in tagList:
             s = re.sub("[\"']", "", t)
-            for existingTag in self.tags:
-                if s.lower() == existingTag.lower():
-                    s = existingTag
-            strippedTags.append(s)
+            strippedTags.append(canon.get(s.lower(), s))
         return sorted(set(strippedTags))
 
+    def _canonMap(self):
+        # lowercase -> registered tag; the last registered wins, as it did
+        # when each tag was compared with every registered one
+        return dict((t.lower(), t) for t in self.tags)
+
     def inList(self, tag, tags):
         "True if TAG is in TAGS. Ignore case."
         return tag.lower() in [t.lower() for t in tags]
@@ -1,7 +1,8 @@
 from anki.template.template import Template
 from anki.template.view import View
+from anki.template import compiled
 
 def render(template, context=None, **kwargs):
     context = context and context.copy() or {}
     context.update(kwargs)
-    return Template(template, context).render()
+    return compiled.render(template, context)
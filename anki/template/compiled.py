@@ -0,0 +1,200 @@
+import re
+from collections import OrderedDict
+
+from anki.template.template import Template, modifiers, get_or_attr, clozeReg
+from anki.utils import stripHTMLMedia
+
+"""
+Templates compiled once and reused for every card.
+
+Template.render() searches for the first section or tag, replaces every copy
+of it, and starts again from the top, so the output can depend on quirks
+like field text that looks like a tag. Rather than reimplement that, each
+step it would take is remembered:
+
+- Sections only keep or drop their contents, so the sections a template
+  visits depend only on whether earlier ones were kept. These decisions are
+  stored in a tree, and rendering walks it, only testing the fields.
+- The tags left over are split into literal text and tags once. Filling them
+  in gives the same result as the search-and-replace loop unless a field's
+  text could be read as part of a tag, in which case that loop is run
+  instead.
+"""
+
+# attributes of a newly created Template
+_proto = vars(Template(""))
+
+# number of compiled templates to keep
+cacheSize = 500
+_cache = OrderedDict()
+
+def render(template, context):
+    "Render TEMPLATE with CONTEXT, as Template(template, context).render()."
+    try:
+        compiled = _cache[template]
+        _cache.move_to_end(template)
+    except KeyError:
+        compiled = _cache[template] = CompiledTemplate(template)
+        while len(_cache) > cacheSize:
+            _cache.popitem(last=False)
+    return compiled.render(context)
+
+def clearCache():
+    "Called when note types are saved."
+    _cache.clear()
+
+class CompiledTemplate:
+
+    def __init__(self, template):
+        self.template = template
+        self._root = _Step(template)
+
+    def render(self, context):
+        step = self._root
+        while step.section:
+            keep = step.shown(context)
+            child = step.children.get(keep)
+            if child is None:
+                child = step.children[keep] = _Step(step.template.replace(
+                    step.section, step.inner if keep else ''))
+            step = child
+        if step.tags is None:
+            step.tags = _Tags(step.template)
+        return step.tags.render(context)
+
+class _Step:
+    "A template part way through Template.render_sections()."
+
+    __slots__ = ("template", "section", "name", "inverted", "inner",
+                 "cloze", "children", "tags")
+
+    def __init__(self, template):
+        self.template = template
+        self.section = None
+        self.tags = None
+        match = _proto['section_re'].search(template)
+        if match:
+            self.section, name, self.inner = match.group(0, 1, 2)
+            self.name = name.strip()
+            self.inverted = self.section[2] == "^"
+            m = re.match(r"c[qa]:(\d+):(.+)", self.name)
+            self.cloze = m and (clozeReg%m.group(1), m.group(2))
+            # keep -> next step
+            self.children = {}
+
+    def shown(self, context):
+        # as in Template.render_sections()
+        val = None
+        if self.cloze:
+            # get full field text
+            txt = get_or_attr(context, self.cloze[1], None)
+            m = re.search(self.cloze[0], txt)
+            if m:
+                val = m.group(1)
+        elif context.__class__ is dict:
+            val = context.get(self.name)
+        else:
+            val = get_or_attr(context, self.name, None)
+        if val:
+            val = stripHTMLMedia(val).strip()
+        return bool(val) != self.inverted
+
+class _Tags:
+    "A template with its sections expanded, split into text and tags."
+
+    def __init__(self, template):
+        self.template = template
+        # distinct tags in the order Template.render_tags() visits them,
+        # as (tag, type, name)
+        self.tags = []
+        # where they appear, in the order they appear
+        self.slots = []
+        self.texts = []
+        seen = {}
+        pos = 0
+        for m in _proto['tag_re'].finditer(template):
+            tag, type, name = m.group(0, 1, 2)
+            if tag not in seen:
+                seen[tag] = len(self.tags)
+                self.tags.append((tag, type, name.strip()))
+            self.texts.append(template[pos:m.start()])
+            self.slots.append(seen[tag])
+            pos = m.end()
+        self.texts.append(template[pos:])
+        # a format string with the text in place, for str.format()
+        fmt = [self.texts[0].replace("{", "{{").replace("}", "}}")]
+        for slot, text in zip(self.slots, self.texts[1:]):
+            fmt.append("{%d}" % slot)
+            fmt.append(text.replace("{", "{{").replace("}", "}}"))
+        self.format = "".join(fmt)
+        self.simple = self._simple()
+
+    def _simple(self):
+        "True if filling in the tags in place matches render_tags()."
+        # past its replacement limit, or changing delimiters
+        if len(self.tags) > 100:
+            return False
+        if any(type == "=" for tag, type, name in self.tags):
+            return False
+        # each tag is only found where it was split out, so replacing every
+        # copy of it replaces just those
+        found = [[] for t in self.tags]
+        pos = 0
+        for text, slot in zip(self.texts, self.slots):
+            pos += len(text)
+            found[slot].append(pos)
+            pos += len(self.tags[slot][0])
+        for (tag, type, name), starts in zip(self.tags, found):
+            pos = self.template.find(tag)
+            for start in starts:
+                if pos != start:
+                    return False
+                pos = self.template.find(tag, pos + len(tag))
+            if pos != -1:
+                return False
+        return True
+
+    def render(self, context):
+        if not self.simple:
+            return self._slowRender(context)
+        plain = context.__class__ is dict
+        tmpl = None
+        reps = []
+        for tag, type, name in self.tags:
+            try:
+                func = modifiers[type]
+            except KeyError:
+                return "{{invalid template}}"
+            rep = None
+            if func is _unescaped and plain:
+                # a field
+                rep = context.get(name)
+            if rep is None:
+                if tmpl is None:
+                    tmpl = self._template(context)
+                try:
+                    rep = func(tmpl, name, context)
+                except (SyntaxError, KeyError):
+                    return "{{invalid template}}"
+            # text that could join up with what's around it to form another
+            # tag needs the full search-and-replace
+            if (rep.__class__ is not str or "{{" in rep or
+                    rep[-1:] == "{" or rep[:1] == "}"):
+                return self._slowRender(context)
+            reps.append(rep)
+        return self.format.format(*reps)
+
+    def _template(self, context):
+        # modifiers are passed a Template, but it needn't compile its
+        # regexps again
+        tmpl = Template.__new__(Template)
+        tmpl.__dict__.update(_proto)
+        tmpl.template = self.template
+        tmpl.context = context
+        return tmpl
+
+    def _slowRender(self, context):
+        return Template(self.template, context).render_tags(
+            self.template, context)
+
+_unescaped = modifiers[None]
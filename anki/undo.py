@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+from anki.utils import json
+
+"""
+Multi-level undo and redo, by journaling what each step changes.
+
+A step is opened by a named save (an operation, eg "Change Deck") and lasts
+until the next save or step, or by answering a card (a review), which closes
+it again once the answer is written. While a step is open, temp triggers copy the first before-image of each row written to
+into a temp table per journaled table; rows inserted are recorded by id only.
+When it closes, the registries (note types, decks, deck options, tags, the
+collection conf and its scalar columns) are compared with their state when it
+opened, and the old JSON of any entry that changed is kept. Undoing a step
+writes back just those rows and entries, while journaling the current ones as
+a redo step, and the reverse for redo.
+
+Writes made outside a step can't be undone. If they touch a row or registry
+entry that a step in the history would restore, the history is dropped, as
+restoring it would clobber them; this is checked before the history is named
+or used. Conf keys that ordinary use keeps changing, like the next new card
+position, are the exception: a write to one outside a step just stops the
+history restoring it. Memory is bounded by keeping at most
+maxSteps steps, and dropping the oldest once more than maxRows rows are
+journaled; the latest step is always kept.
+"""
+
+# tables journaled, in the order changes to them are undone
+tables = ("cards", "notes", "revlog", "graves")
+
+class Step:
+
+    __slots__ = ("id", "name", "cid", "rows", "registry")
+
+    def __init__(self, id, name, cid=None):
+        self.id = id
+        self.name = name
+        # the card answered, for reviews
+        self.cid = cid
+        # rows journaled, counted on close
+        self.rows = 0
+        # (kind, key) -> encoded entry before the step, or None if added
+        self.registry = {}
+
+class UndoJournal:
+
+    # steps kept, counting redo steps
+    maxSteps = 30
+    # journaled rows kept, beyond the latest step
+    maxRows = 100000
+    # conf keys that writes outside steps may change without a clash
+    counters = ("nextPos", "curDeck", "activeDecks")
+
+    def __init__(self, col):
+        self.col = col
+        self._db = None
+        # table -> (journaled columns, whether the table has an id column)
+        self._cols = {}
+        self._nextId = 1
+        self.clear()
+
+    # Steps
+    ##########################################################################
+
+    def open(self, name, cid=None):
+        "Start a step called NAME. CID is the card, if a review."
+        self._install()
+        self.close()
+        self._settle()
+        self._dropRedo()
+        step = Step(self._nextId, name, cid)
+        self._nextId += 1
+        self._steps.append(step)
+        self._open = step
+        self._setState(step.id)
+
+    def close(self, keep=False):
+        """End the open step, if any. Unless KEEP, it's dropped if it changed
+nothing."""
+        step = self._open
+        if not step:
+            return
+        self._open = None
+        self._setState(None)
+        step.registry = self._diff()
+        step.rows = self._count(step.id)
+        if not step.rows and not step.registry and not keep:
+            self._steps.remove(step)
+        self._evict()
+
+    def clear(self):
+        "Forget all steps, eg after a rollback."
+        self._steps = []
+        self._redo = []
+        self._open = None
+        # kind -> {key: encoded entry}, as of the last step boundary
+        self._base = None
+        self._gens = None
+        if self._db is not None and self._db is self.col.db:
+            self._setState(None)
+            for t in tables:
+                self._write("delete from temp.undo_%s" % t)
+
+    def undoName(self):
+        self._settleIdle()
+        if self._steps:
+            return self._steps[-1].name
+
+    def redoName(self):
+        self._settleIdle()
+        if self._redo:
+            return self._redo[-1].name
+
+    def undo(self):
+        "Undo the latest step. Returns the card id for reviews."
+        self._install()
+        # the step named in the menu, even if it did nothing
+        self.close(keep=True)
+        self._settle()
+        if not self._steps:
+            return None
+        step = self._steps.pop()
+        self._redo.append(self._restore(step))
+        self._setState(None)
+        if step.cid:
+            self.col.sched.reps -= 1
+        return step.cid
+
+    def redo(self):
+        "Redo the step last undone."
+        self._install()
+        self.close(keep=True)
+        self._settle()
+        if not self._redo:
+            return None
+        step = self._redo.pop()
+        self._steps.append(self._restore(step))
+        self._setState(None)
+        if step.cid:
+            self.col.sched.reps += 1
+
+    def stats(self):
+        "Return the number of undo and redo steps, and of rows journaled."
+        return dict(undo=len(self._steps), redo=len(self._redo),
+                    rows=sum(s.rows for s in self._steps + self._redo))
+
+    # Restoring
+    ##########################################################################
+
+    def _restore(self, step):
+        "Write back STEP, journaling what it replaces as a new step."
+        new = Step(self._nextId, step.name, step.cid)
+        self._nextId += 1
+        db = self.col.db
+        self._setState(new.id)
+        for t in tables:
+            cols, hasId = self._cols[t]
+            db.execute("""
+delete from %s where rowid in
+(select _rid from temp.undo_%s where _step = ? and _op = 'i')""" % (t, t),
+                       step.id)
+            # rows still there are updated in place, which is much cheaper
+            # than removing them and adding them back
+            db.execute("""
+update %s set (%s) = (select %s from temp.undo_%s j
+where j._step = ? and j._rid = %s.rowid) where rowid in
+(select _rid from temp.undo_%s where _step = ? and _op = 'o')""" % (
+    t, ", ".join(cols), ", ".join(cols), t, t, t), step.id, step.id)
+            if hasId:
+                dest = src = ", ".join(cols)
+            else:
+                dest = "rowid, " + ", ".join(cols)
+                src = "_rid, " + ", ".join(cols)
+            db.execute("""
+insert into %s (%s) select %s from temp.undo_%s j
+where _step = ? and _op = 'o' and not exists
+(select 1 from %s where rowid = j._rid)""" % (t, dest, src, t, t), step.id)
+        self._setState(None)
+        self._drop([step])
+        new.registry = self._restoreRegistry(step.registry)
+        new.rows = self._count(new.id)
+        return new
+
+    def _restoreRegistry(self, images):
+        "Put back IMAGES, returning the entries they replace."
+        if self._base is None:
+            self._base = self._snapshot()
+        col = self.col
+        old = {}
+        kinds = set()
+        for (kind, key), enc in images.items():
+            entries = self._entries(kind)
+            old[(kind, key)] = (self._enc(entries[key])
+                                if key in entries else None)
+            kinds.add(kind)
+            if kind == "col":
+                setattr(col, key, self._dec(enc))
+            elif enc is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = self._dec(enc)
+            if enc is None:
+                self._base[kind].pop(key, None)
+            else:
+                self._base[kind][key] = enc
+        if "models" in kinds:
+            col.models.changed = True
+            col.models.gen += 1
+            col.completion.reset("models")
+            col.completion.reset("fields")
+        if "decks" in kinds or "dconf" in kinds:
+            col.decks.changed = True
+            col.decks.gen += 1
+            col.completion.reset("decks")
+        if "tags" in kinds:
+            col.tags.changed = True
+            col.completion.reset("tags")
+        if kinds:
+            col.setMod()
+        self._gens = self._currentGens()
+        return old
+
+    # Registries
+    ##########################################################################
+
+    def _entries(self, kind):
+        col = self.col
+        if kind == "models":
+            return col.models.models
+        elif kind == "decks":
+            return col.decks.decks
+        elif kind == "dconf":
+            return col.decks.dconf
+        elif kind == "tags":
+            return col.tags.tags
+        elif kind == "conf":
+            return col.conf
+        # columns of the col table that aren't registries
+        return dict(crt=col.crt, scm=col.scm, ls=col.ls, _usn=col._usn)
+
+    def _enc(self, val):
+        # tag registry entries are ints, so needn't be encoded
+        if val.__class__ is int:
+            return val
+        return json.dumps(val)
+
+    def _dec(self, enc):
+        if enc.__class__ is int:
+            return enc
+        return json.loads(enc)
+
+    def _currentGens(self):
+        return dict(models=self.col.models.gen, decks=self.col.decks.gen,
+                    dconf=self.col.decks.gen)
+
+    def _snapshot(self, kinds=("models", "decks", "dconf", "tags", "conf",
+                               "col")):
+        self._gens = self._currentGens()
+        return dict((kind, dict((k, self._enc(v))
+                                for k, v in self._entries(kind).items()))
+                    for kind in kinds)
+
+    def _diff(self):
+        """Return (kind, key) -> old encoded entry for the entries changed
+since the last boundary, and make the current ones the new baseline."""
+        if self._base is None:
+            self._base = self._snapshot()
+            return {}
+        gens = self._currentGens()
+        # note types and decks are only encoded again if saved since
+        kinds = [k for k in ("models", "decks", "dconf")
+                 if gens[k] != self._gens[k]] + ["tags", "conf", "col"]
+        cur = self._snapshot(kinds)
+        changed = {}
+        for kind in kinds:
+            old, new = self._base[kind], cur[kind]
+            for key, enc in new.items():
+                if old.get(key) != enc:
+                    changed[(kind, key)] = old.get(key)
+            for key in old.keys() - new.keys():
+                changed[(kind, key)] = old[key]
+            self._base[kind] = new
+        return changed
+
+    # Writes outside steps
+    ##########################################################################
+
+    def _settle(self):
+        """Check writes made since the last step. If they touched anything
+the history would restore, drop the history."""
+        if self._db is None or self._db is not self.col.db:
+            return
+        registry = self._diff()
+        if not self._steps and not self._redo:
+            return
+        steps = self._steps + self._redo
+        for key in registry:
+            if key[0] == "conf" and key[1] in self.counters:
+                # the new value stands
+                for s in steps:
+                    s.registry.pop(key, None)
+        clash = any(key in s.registry for s in steps for key in registry)
+        if not clash:
+            for t in tables:
+                if self.col.db.scalar("""
+select 1 from temp.undo_%s a, temp.undo_%s b where a._step = 0
+and b._rid = a._rid and b._step != 0 limit 1""" % (t, t)):
+                    clash = True
+                    break
+        for t in tables:
+            self._write("delete from temp.undo_%s where _step = 0" % t)
+        if clash:
+            self._drop(steps)
+            self._steps = []
+            self._redo = []
+
+    def _settleIdle(self):
+        # while a step is open, writes belong to it
+        if not self._open:
+            self._settle()
+
+    # Journal tables
+    ##########################################################################
+
+    def _install(self):
+        "Create the journal tables and triggers on a new connection."
+        db = self.col.db
+        if self._db is db:
+            return
+        self._db = None
+        self.clear()
+        mod = db.mod
+        # step is the open step's id; watch is set while there's history,
+        # so writes outside steps are noted (as step 0)
+        db.execute("create temp table if not exists undostate "
+                   "(step integer, watch integer)")
+        db.execute("delete from temp.undostate")
+        db.execute("insert into temp.undostate values (null, 0)")
+        for t in tables:
+            info = db.all("pragma main.table_info(%s)" % t)
+            cols = [r[1] for r in info]
+            hasId = any(r[1] == "id" and r[5] for r in info)
+            self._cols[t] = (cols, hasId)
+            db.execute("""
+create temp table if not exists undo_%s (_step integer not null, _op text,
+_rid integer not null, %s, primary key (_step, _rid))""" % (
+    t, ", ".join(cols)))
+            db.execute("create index if not exists temp.ix_undo_%s_rid "
+                       "on undo_%s (_rid)" % (t, t))
+            for name, event, when, body in self._triggers(t, cols, hasId):
+                db.execute("""
+create temp trigger if not exists undo_%s_%s %s on %s when %s begin %s end""" % (
+    t, name, event, t, when, body))
+        db.mod = mod
+        self._db = db
+
+    def _triggers(self, t, cols, hasId):
+        "Return (name, event, condition, body) for the triggers on table T."
+        def record(op, rid, vals=None, src="", cond="", insert=False):
+            # the first image of each row per step is kept. An insert's "or
+            # replace" would override an "or ignore" here, so for inserts
+            # existing entries are skipped explicitly, which is much slower;
+            # updates and deletes here never carry a conflict clause
+            step = "0" if op == "x" else "s.step"
+            sql = """
+insert %sinto undo_%s (_step, _op, _rid%s)
+select %s, '%s', %s%s from undostate s%s""" % (
+    "" if insert else "or ignore ", t,
+    vals and ", " + ", ".join(cols) or "", step, op, rid,
+    vals and ", " + ", ".join(vals % c for c in cols) or "", src)
+            if insert:
+                cond = """ and not exists
+(select 1 from undo_%s j where j._step = %s and j._rid = %s)""" % (
+    t, step, rid) + cond
+            if cond:
+                sql += " where" + cond[4:]
+            return sql + ";"
+        live = "(select step from undostate) is not null"
+        # writes outside a step are noted as step 0, if there's history
+        quiet = "(select step is null and watch from undostate)"
+        prev = record("o", "old.rowid", "old.%s")
+        return (
+            # "insert or replace" removes the old row without firing the
+            # delete trigger. new.rowid isn't set yet, but an id column is
+            ("rep", "before insert", live, record(
+                "o", "t.rowid", "t.%s", ", %s t" % t,
+                " and t.rowid = new.%s" % ("id" if hasId else "rowid"),
+                insert=True)),
+            ("ins", "after insert", live,
+             record("i", "new.rowid", insert=True)),
+            ("upd", "before update", live, prev),
+            # a changed id leaves a new row behind
+            ("updid", "before update", "new.rowid != old.rowid and " + live,
+             record("i", "new.rowid")),
+            ("del", "before delete", live, prev),
+            ("xins", "after insert", quiet,
+             record("x", "new.rowid", insert=True)),
+            ("xupd", "after update", quiet,
+             record("x", "old.rowid") + record("x", "new.rowid")),
+            ("xdel", "after delete", quiet, record("x", "old.rowid")))
+
+    def _setState(self, step):
+        if self._db is None:
+            return
+        watch = bool(self._steps or self._redo)
+        self._write("update temp.undostate set step = ?, watch = ?",
+                    step, watch)
+
+    def _count(self, step):
+        return sum(self.col.db.scalar(
+            "select count() from temp.undo_%s where _step = ?" % t, step)
+                   for t in tables)
+
+    def _drop(self, steps):
+        for step in steps:
+            for t in tables:
+                self._write("delete from temp.undo_%s where _step = ?" % t,
+                            step.id)
+
+    def _dropRedo(self):
+        self._drop(self._redo)
+        self._redo = []
+
+    def _evict(self):
+        "Drop the oldest steps while over the limits."
+        steps = self._steps + self._redo
+        rows = sum(s.rows for s in steps)
+        while len(self._steps) > 1 and (
+                len(steps) > self.maxSteps or rows > self.maxRows):
+            step = self._steps.pop(0)
+            steps.remove(step)
+            rows -= step.rows
+            self._drop([step])
+        self._setState(self._open and self._open.id)
+
+    def _write(self, sql, *args):
+        # bookkeeping doesn't count as a change to the collection
+        db = self.col.db
+        mod = db.mod
+        db.execute(sql, *args)
+        db.mod = mod
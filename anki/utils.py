@@ -143,6 +143,9 @@ def stripHTML(s):
 
 def stripHTMLMedia(s):
     "Strip HTML but keep media filenames"
+    if "<" not in s and "&" not in s:
+        # nothing to strip
+        return s
     s = reMedia.sub(" \\1 ", s)
     return stripHTML(s)
 
@@ -10,6 +10,7 @@ import unicodedata
 from operator import  itemgetter
 from anki.lang import ngettext
 import json
+import threading
 
 from aqt.qt import *
 import anki
@@ -32,6 +33,9 @@ from anki.sound import playFromText, clearAudioQueue, allSounds, play
 
 class DataModel(QAbstractTableModel):
 
+    # (cards, count) from the background count
+    countReady = pyqtSignal(object, object)
+
     def __init__(self, browser):
         QAbstractTableModel.__init__(self)
         self.browser = browser
@@ -41,11 +45,24 @@ class DataModel(QAbstractTableModel):
             "activeCols", ["noteFld", "template", "cardDue", "deck"])
         self.cards = []
         self.cardObjs = {}
+        self.countReady.connect(self._onCount)
+
+    # rows loaded at once when the view needs a card
+    cardBatch = 100
 
     def getCard(self, index):
-        id = self.cards[index.row()]
+        row = index.row()
+        id = self.cards[row]
         if not id in self.cardObjs:
-            self.cardObjs[id] = self.col.getCard(id)
+            # the view asks for neighbouring rows next
+            ids = [self.cards[i] for i in range(
+                row, min(row + self.cardBatch, self.cardCount()))]
+            for c in self.col.getCards(
+                    [i for i in ids if i not in self.cardObjs], notes=True):
+                self.cardObjs[c.id] = c
+            if id not in self.cardObjs:
+                # deleted since the search
+                self.cardObjs[id] = self.col.getCard(id)
         return self.cardObjs[id]
 
     def refreshNote(self, note):
@@ -63,7 +80,14 @@ class DataModel(QAbstractTableModel):
     def rowCount(self, parent):
         if parent and parent.isValid():
             return 0
-        return len(self.cards)
+        return self.cardCount()
+
+    def cardCount(self):
+        """The number of rows. Until the background count arrives, only the
+rows fetched so far are shown."""
+        if isinstance(self.cards, list) or self.cards.countKnown():
+            return len(self.cards)
+        return len(self.cards.loaded())
 
     def columnCount(self, parent):
         if parent and parent.isValid():
@@ -130,7 +154,8 @@ class DataModel(QAbstractTableModel):
         self.cards = []
         invalid = False
         try:
-            self.cards = self.col.findCards(txt, order=True)
+            # rows are fetched as the view needs them
+            self.cards = self.col.find.pagedCards(txt, order=True)
         except Exception as e:
             if str(e) == "invalidSearch":
                 self.cards = []
@@ -140,9 +165,45 @@ class DataModel(QAbstractTableModel):
         #print "fetch cards in %dms" % ((time.time() - t)*1000)
         self.endReset()
 
+        self._countCards()
+
         if invalid:
             showWarning(_("Invalid search - please check for typing mistakes."))
 
+    def _countCards(self):
+        "Count the matches off the main thread, then show the remaining rows."
+        cards = self.cards
+        if isinstance(cards, list) or cards.countKnown():
+            return
+        if not self.col.readPool or self.col.db.mod:
+            # the main connection can't be used from another thread, and
+            # pooled readers wouldn't see the changes not yet saved, so count
+            # here once the first rows have been drawn
+            self.browser.mw.progress.timer(
+                0, lambda: self._onCount(cards, None), False)
+            return
+        def count():
+            try:
+                with self.col.reader() as db:
+                    n = cards.countWith(db)
+            except Exception:
+                # eg an index enabled since the readers were opened
+                n = None
+            self.countReady.emit(cards, n)
+        threading.Thread(target=count, daemon=True).start()
+
+    def _onCount(self, cards, count):
+        if cards is not self.cards:
+            # searched again since
+            return
+        if count is None:
+            len(cards)
+        else:
+            cards.setCount(count)
+        self.layoutAboutToBeChanged.emit()
+        self.layoutChanged.emit()
+        self.browser.updateTitle()
+
 
     def reset(self):
         self.beginReset()
@@ -167,8 +228,18 @@ class DataModel(QAbstractTableModel):
 
     def _reverse(self):
         self.beginReset()
-        self.cards.reverse()
+        if self.cards:
+            # sortBackwards has already been changed, so searching again
+            # returns the cards in the opposite order
+            self.cards = self.col.find.pagedCards(self.cards.query, order=True)
         self.endReset()
+        self._countCards()
+
+    def loadedCards(self):
+        "Card ids fetched so far."
+        if isinstance(self.cards, list):
+            return self.cards
+        return self.cards.loaded()
 
     def saveSelection(self):
         cards = self.browser.selectedCards()
@@ -188,7 +259,9 @@ class DataModel(QAbstractTableModel):
         count = 0
         firstIdx = None
         focusedIdx = None
-        for row, id in enumerate(self.cards):
+        # cards past the ones fetched so far are not restored, as that would
+        # mean loading them all
+        for row, id in enumerate(self.loadedCards()):
             # if the id matches the focused card, note the index
             if self.focusedCard == id:
                 focusedIdx = self.index(row, 0)
@@ -288,19 +361,13 @@ class DataModel(QAbstractTableModel):
             return self.browser.mw.col.decks.name(c.did)
 
     def question(self, c):
-        return htmlToTextLine(c.q(browser=True))
+        return c.q(browser=True, textOnly=True)
 
     def answer(self, c):
-        if c.template().get('bafmt'):
-            # they have provided a template, use it verbatim
-            c.q(browser=True)
-            return htmlToTextLine(c.a())
-        # need to strip question from answer
-        q = self.question(c)
-        a = htmlToTextLine(c.a())
-        if a.startswith(q):
-            return a[len(q):].strip()
-        return a
+        # the text render leaves out the question, unless they have provided
+        # their own answer format
+        self.question(c)
+        return c.a(textOnly=True)
 
     def nextDue(self, c, index):
         if c.odid:
@@ -611,7 +678,7 @@ class Browser(QMainWindow):
 
     def updateTitle(self):
         selected = len(self.form.tableView.selectionModel().selectedRows())
-        cur = len(self.model.cards)
+        cur = self.model.cardCount()
         self.setWindowTitle(ngettext("Browse (%(cur)d card shown; %(sel)s)",
                                      "Browse (%(cur)d cards shown; %(sel)s)",
                                  cur) % {
@@ -876,7 +943,8 @@ by clicking on one on the left."""))
     def _favTree(self, root):
         saved = self.col.conf.get('savedFilters', {})
         for name, filt in sorted(saved.items()):
-            item = self.CallbackItem(root, name, lambda s=filt: self.setFilter(s))
+            item = self.CallbackItem(
+                root, name, lambda n=name, s=filt: self._openSavedFilter(n, s))
             item.setIcon(0, QIcon(":/icons/heart.svg"))
 
     def _userTagTree(self, root):
@@ -1078,8 +1146,15 @@ by clicking on one on the left."""))
 
         ml.addSeparator()
 
-        if self._currentFilterIsSaved():
+        name = self._currentFilterIsSaved()
+        if name:
             ml.addItem(_("Remove Current Filter..."), self._onRemoveFilter)
+            if name in self.col.find.materialized():
+                ml.addItem(_("Stop Caching Current Filter"),
+                           lambda: self._onMaterializeFilter(name, False))
+            else:
+                ml.addItem(_("Cache Current Filter"),
+                           lambda: self._onMaterializeFilter(name, True))
         else:
             ml.addItem(_("Save Current Filter..."), self._onSaveFilter)
 
@@ -1089,10 +1164,17 @@ by clicking on one on the left."""))
 
         ml.addSeparator()
         for name, filt in sorted(saved.items()):
-            ml.addItem(name, self._filterFunc(filt))
+            ml.addItem(
+                name, lambda *, n=name, s=filt: self._openSavedFilter(n, s))
 
         return ml
 
+    def _openSavedFilter(self, name, filt):
+        # a cached filter left stale by changes is refilled when opened
+        if name in self.col.find.materialized():
+            self.col.find.refreshMaterialized(name)
+        self.setFilter(filt)
+
     def _onSaveFilter(self):
         name = getOnlyText(_("Please give your filter a name:"))
         if not name:
@@ -1107,9 +1189,17 @@ by clicking on one on the left."""))
         if not askUser(_("Remove %s from your saved searches?") % name):
             return
         del self.col.conf['savedFilters'][name]
+        self.col.find.dematerialize(name)
         self.col.setMod()
         self.maybeRefreshSidebar()
 
+    def _onMaterializeFilter(self, name, on):
+        "Store the filter's matches so it opens quickly on big collections."
+        if on:
+            self.col.find.materialize(name, self.col.conf['savedFilters'][name])
+        else:
+            self.col.find.dematerialize(name)
+
     # returns name if found
     def _currentFilterIsSaved(self):
         filt = self.form.searchEdit.lineEdit().text()
@@ -1458,8 +1548,8 @@ where id in %s""" % ids2str(sf))
             newRow = min(selectedRows) - 1
         self.col.remNotes(nids)
         self.search()
-        if len(self.model.cards):
-            newRow = min(newRow, len(self.model.cards) - 1)
+        if self.model.cards:
+            newRow = min(newRow, self.model.cardCount() - 1)
             newRow = max(newRow, 0)
             self.model.focusedCard = self.model.cards[newRow]
         self.model.endReset()
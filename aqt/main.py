@@ -14,6 +14,7 @@ from threading import Thread
 from send2trash import send2trash
 from aqt.qt import *
 from anki import Collection
+from anki.cards import Card
 from anki.utils import  isWin, isMac, intTime, splitFields, ids2str, \
         devMode
 from anki.hooks import runHook, addHook, runFilter
@@ -347,7 +348,8 @@ Debug info:
     def _loadCollection(self):
         cpath = self.pm.collectionPath()
 
-        self.col = Collection(cpath, log=True)
+        # a reader lets the browser count search results in the background
+        self.col = Collection(cpath, log=True, readers=1)
 
         self.setEnabled(True)
         self.progress.setupDB(self.col.db)
@@ -1051,7 +1053,13 @@ will be lost. Continue?"""))
     def onCheckDB(self):
         "True if no problems"
         self.progress.start(immediate=True)
-        ret, ok = self.col.fixIntegrity()
+        def onProgress(phase, cnt):
+            if phase == "notes" and cnt:
+                self.progress.update(label=ngettext(
+                    "Checked %d note...", "Checked %d notes...", cnt) % cnt)
+            elif phase == "optimize":
+                self.progress.update(label=_("Optimizing..."))
+        ret, ok = self.col.fixIntegrity(progress=onProgress)
         self.progress.finish()
         if not ok:
             showText(ret)
@@ -1140,7 +1148,10 @@ will be lost. Continue?"""))
 
     def onEmptyCards(self):
         self.progress.start(immediate=True)
-        cids = self.col.emptyCids()
+        def onProgress(cnt):
+            self.progress.update(label=ngettext(
+                "Checked %d note...", "Checked %d notes...", cnt) % cnt)
+        cids = self.col.emptyCids(progress=onProgress)
         if not cids:
             self.progress.finish()
             tooltip(_("No empty cards."))
@@ -1194,11 +1205,23 @@ will be lost. Continue?"""))
             sys.stderr = self._oldStderr
             sys.stdout = self._oldStdout
 
+    def _cardAttrs(self, card):
+        d = dict((k, getattr(card, k, None)) for k in Card.__slots__
+                 if k != "__dict__")
+        d.update(card.__dict__)
+        return d
+
     def _debugCard(self):
-        return self.reviewer.card.__dict__
+        return self._cardAttrs(self.reviewer.card)
 
     def _debugBrowserCard(self):
-        return aqt.dialogs._dialogs['Browser'][1].card.__dict__
+        return self._cardAttrs(aqt.dialogs._dialogs['Browser'][1].card)
+
+    def _debugExplain(self, query=None):
+        "Explain QUERY, or the browser's current search if not given."
+        if query is None:
+            query = aqt.dialogs._dialogs['Browser'][1]._lastSearchTxt
+        return self.col.find.explain(query, order=True)
 
     def onDebugPrint(self, frm):
         frm.text.setPlainText("pp(%s)" % frm.text.toPlainText())
@@ -1209,6 +1232,7 @@ will be lost. Continue?"""))
         text = frm.text.toPlainText()
         card = self._debugCard
         bcard = self._debugBrowserCard
+        explain = self._debugExplain
         mw = self
         pp = pprint.pprint
         self._captureOutput(True)
@@ -8,6 +8,9 @@ class TagEdit(QLineEdit):
 
     lostFocus = pyqtSignal()
 
+    # number of completions shown
+    completionLimit = 50
+
     # 0 = tags, 1 = decks
     def __init__(self, parent, type=0):
         QLineEdit.__init__(self, parent)
@@ -23,13 +26,25 @@ class TagEdit(QLineEdit):
         self.setCompleter(self.completer)
 
     def setCol(self, col):
-        "Set the current col, updating list of available tags."
+        "Set the current col. Completions are looked up as you type."
         self.col = col
+        self.model.setStringList([])
+
+    def updateCompletions(self):
+        "Fill the model with the names matching the word being typed."
+        if not self.col:
+            return
         if self.type == 0:
-            l = sorted(self.col.tags.all())
+            # the tag under the cursor
+            text = self.text()
+            p = self.cursorPosition()
+            prefix = text[text.rfind(" ", 0, p) + 1:p]
+            kind = "tags"
         else:
-            l = sorted(self.col.decks.allNames())
-        self.model.setStringList(l)
+            prefix = self.text()
+            kind = "decks"
+        self.model.setStringList(self.col.completion.complete(
+            kind, prefix, self.completionLimit))
 
     def focusInEvent(self, evt):
         QLineEdit.focusInEvent(self, evt)
@@ -70,6 +85,7 @@ class TagEdit(QLineEdit):
             self.showCompleter()
 
     def showCompleter(self):
+        self.updateCompletions()
         self.completer.setCompletionPrefix(self.text())
         self.completer.complete()
 
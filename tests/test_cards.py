@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from tests.shared import getEmptyCol
+from tests.shared import getEmptyCol, aopen
 
 def test_previewCards():
     deck = getEmptyCol()
@@ -75,6 +75,52 @@ def test_genrem():
     f.flush()
     assert len(f.cards()) == 2
 
+def test_cardgen():
+    d = getEmptyCol()
+    m = d.models.byName("Basic (optional reversed card)")
+    d.models.setCurrent(m)
+    for i in range(10):
+        f = d.newNote()
+        f['Front'] = str(i)
+        f['Back'] = str(i) if i % 2 else ""
+        f['Add Reverse'] = "y"
+        d.addNote(f)
+    assert d.cardCount() == 15
+    gen = d.cardgen
+    gen.batchSize = 3
+    assert not d.emptyCids()
+    assert len(gen._avail) == 10
+    # an edit in the same second is still picked up
+    f['Back'] = ""
+    f.flush()
+    cid = d.db.scalar("select id from cards where nid = ? and ord = 1", f.id)
+    assert d.emptyCids() == [cid]
+    # as are missing cards, which are generated
+    d.db.execute("delete from cards where id = ?", cid)
+    f['Back'] = "back"
+    f.flush()
+    d.db.execute("delete from cards where id = ?", f.cards()[1].id)
+    res = list(gen.scan())
+    assert [len(nids) for nids, missing, empty in res] == [3, 3, 3, 1]
+    assert res[-1][1] == [(f.id, 1)]
+    assert not d.emptyCids()
+    assert len(f.cards()) == 2
+    # a template change recomputes all of the note type's notes
+    m['tmpls'][1]['qfmt'] = "{{Front}}"
+    d.models.save(m)
+    assert not d.emptyCids()
+    assert d.cardCount() == 20
+    # the results are the same across worker processes
+    gen.reset()
+    gen.chunkSize = 2
+    m['tmpls'][1]['qfmt'] = "{{Back}}"
+    d.models.save(m)
+    empty = sorted(d.db.list(
+        "select id from cards where ord = 1 and nid in "
+        "(select id from notes where flds like '%\x1f\x1fy')"))
+    assert sorted(gen.generate(workers=2)) == empty
+    assert len(empty) == 5
+
 def test_gendeck():
     d = getEmptyCol()
     cloze = d.models.byName("Cloze")
@@ -107,3 +153,155 @@ def test_gendeck():
 
 
 
+
+def test_getCards():
+    deck = getEmptyCol()
+    m = deck.models.byName("Basic (and reversed card)")
+    deck.models.setCurrent(m)
+    nids = []
+    for i in range(3):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        f['Back'] = "b"
+        deck.addNote(f)
+        nids.append(f.id)
+    cids = deck.db.list("select id from cards order by id desc")
+    cards = deck.getCards(cids + [12345])
+    assert [c.id for c in cards] == cids
+    for c in cards:
+        single = deck.getCard(c.id)
+        assert repr(c) == repr(single)
+        assert c.q() == single.q()
+    # notes can be loaded with them
+    cards = deck.getCards(cids, notes=True)
+    assert all(c._note and c._note.id == c.nid for c in cards)
+    notes = deck.getNotes(list(reversed(nids)))
+    assert [n.id for n in notes] == list(reversed(nids))
+    assert notes[2]['Front'] == "0" and notes[0].tags == []
+    # notes of a model share one field map
+    assert notes[0]._fmap is notes[1]._fmap
+    assert [c.ord for c in notes[0].cards()] == [0, 1]
+    # add-ons can still set their own attributes
+    cards[0].myAddon = 1
+    notes[0].myAddon = 2
+    assert (cards[0].myAddon, notes[0].myAddon) == (1, 2)
+
+def test_qaCache():
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = "one"
+    f['Back'] = "two"
+    d.addNote(f)
+    cache = d.qaCache
+    cid = f.cards()[0].id
+    assert "one" in d.getCard(cid).q()
+    assert "one" in d.getCard(cid).q()
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    # edits to the note, deck or template all show up straight away
+    f['Front'] = "uno"
+    f.flush()
+    assert "uno" in d.getCard(cid).q()
+    m = f.model()
+    m['tmpls'][0]['qfmt'] = "{{Deck}}: {{Front}}"
+    d.models.save(m)
+    assert "Default: uno" in d.getCard(cid).q()
+    d.decks.rename(d.decks.get(1), "Spanish")
+    assert "Spanish: uno" in d.getCard(cid).q()
+    assert cache.stats()['misses'] == 4
+    # entries are limited
+    cache.cacheSize = 2
+    for i in range(3):
+        f['Front'] = str(i)
+        f.flush()
+        d.getCard(cid).q()
+    assert cache.stats()['size'] == 2
+    # and can be saved across sessions
+    assert d.indexes.enable("qa")
+    cache.clear()
+    assert "Spanish: 2" in d.getCard(cid).q()
+    assert d.db.scalar("select count() from idx.qa") == 1
+    path = d.path
+    d.close()
+    d = aopen(path)
+    assert "Spanish: 2" in d.getCard(cid).q()
+    assert d.qaCache.stats()['hits'] == 1
+    # removed cards are dropped
+    d.remCards([cid])
+    assert not d.db.scalar("select count() from idx.qa")
+
+def test_qaCacheFilters():
+    from anki.hooks import addHook, remHook, skipCache
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = "one"
+    d.addNote(f)
+    cid = f.cards()[0].id
+    assert d.indexes.enable("qa")
+    assert d.getCard(cid).q().endswith("one")
+    # adding or removing a filter starts again, even for saved entries
+    def mark(html, type, fields, model, data, col):
+        return html + "<!--mark-->"
+    addHook("mungeQA", mark)
+    try:
+        assert d.getCard(cid).q().endswith("<!--mark-->")
+        d.qaCache._cache.clear()
+        assert d.getCard(cid).q().endswith("<!--mark-->")
+    finally:
+        remHook("mungeQA", mark)
+    assert d.getCard(cid).q().endswith("one")
+    # filters can ask for a render not to be kept
+    calls = []
+    def volatile(html, type, fields, model, data, col):
+        calls.append(type)
+        skipCache()
+        return html
+    addHook("mungeQA", volatile)
+    try:
+        d.getCard(cid).q()
+        d.getCard(cid).q()
+    finally:
+        remHook("mungeQA", volatile)
+    assert calls == ["q", "a"] * 2
+    # saving entries doesn't count as a change to search results
+    d.db.execute("update notes set flds = ? where id = ?", "two\x1f", f.id)
+    changes = d.db.changes
+    assert d.getCard(cid).q().endswith("two")
+    assert d.db.changes == changes
+
+def test_textOnly():
+    from anki.hooks import addHook, remHook
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = "<b>one</b>&nbsp;[latex]x^2[/latex]<br>[sound:a.mp3]"
+    f['Back'] = "<div>two</div><img src='b.jpg'>"
+    d.addNote(f)
+    munged = []
+    def munge(html, type, fields, model, data, col):
+        munged.append(type)
+        return html
+    addHook("mungeQA", munge)
+    try:
+        c = d.getCard(f.cards()[0].id)
+        assert c.q(textOnly=True) == "one [latex]x^2[/latex]"
+        # the answer's text leaves out the question
+        assert c.a(textOnly=True) == "two b.jpg"
+        # text renders don't munge, and are kept apart from full ones
+        assert not munged
+        assert "<b>one</b>" in c.q()
+        assert munged == ["q", "a"]
+        assert d.renderQA([c.id], textOnly=True) == [
+            dict(id=c.id, q=c.q(textOnly=True), a=c.a(textOnly=True))]
+    finally:
+        remHook("mungeQA", munge)
+    # the browser's own answer format is kept verbatim
+    m = d.models.current()
+    m['tmpls'][0]['bqfmt'] = "{{Front}}"
+    m['tmpls'][0]['bafmt'] = "{{Front}} -> {{Back}}"
+    d.models.save(m)
+    f = d.newNote()
+    f['Front'] = "foo"; f['Back'] = "bar"
+    d.addNote(f)
+    c = f.cards()[0]
+    assert c.q(browser=True, textOnly=True) == "foo"
+    assert c.a(textOnly=True) == "foo -> bar"
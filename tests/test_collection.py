@@ -78,6 +78,54 @@ def test_noteAddDelete():
     f2['Front'] = " "
     assert f2.dupeOrEmpty()
 
+def test_addNotes():
+    one = getEmptyCol()
+    bulk = getEmptyCol()
+    for deck in one, bulk:
+        deck.models.setCurrent(deck.models.byName("Basic (optional reversed card)"))
+    def make(deck):
+        for front, back, tags in (("a", "", "x"), ("<b>b</b>", "y", "x Y"),
+                                  ("", "", "empty"), ("c", "z", "")):
+            f = deck.newNote()
+            f['Front'] = front
+            f['Back'] = "back"
+            f['Add Reverse'] = back
+            f.tags = deck.tags.split(tags)
+            yield f
+    # one at a time, as new notes share ids until they're flushed
+    added = sum(one.addNote(f) for f in make(one))
+    notes = list(make(bulk))
+    assert bulk.addNotes(notes) == added == 5
+    def dump(deck):
+        return (deck.db.all("""
+select flds, sfld, csum, tags from notes order by id"""),
+                deck.db.all("""
+select n.flds, c.ord, c.did, c.due, c.type, c.queue from cards c, notes n
+where c.nid = n.id order by n.id, c.ord"""),
+                sorted(deck.tags.all()))
+    assert dump(bulk) == dump(one)
+    # ids are allocated in a range, with no clashes
+    nids = [f.id for f in notes if f['Front']]
+    assert nids == list(range(nids[0], nids[0] + 3))
+    assert bulk.noteCount() == 3 and "empty" not in bulk.tags.all()
+    assert bulk.addNotes([]) == 0
+    # updating
+    notes = bulk.getNotes(nids)
+    notes[0]['Front'] = "<i>new</i>"
+    notes[1]['Add Reverse'] = ""
+    notes[2].tags.append("new")
+    assert bulk.updateNotes(notes) == 3
+    assert bulk.updateNotes(notes) == 0
+    assert bulk.db.scalar(
+        "select sfld from notes where id = ?", nids[0]) == "new"
+    assert bulk.findNotes("tag:new") == [nids[2]]
+    assert "new" in bulk.tags.all()
+    # missing cards are generated; empty ones are left for the user to remove
+    notes[0]['Add Reverse'] = "y"
+    bulk.updateNotes(notes)
+    assert len(notes[0].cards()) == 2
+    assert len(notes[1].cards()) == 2
+
 def test_fieldChecksum():
     deck = getEmptyCol()
     f = deck.newNote()
@@ -137,3 +185,127 @@ def test_furigana():
     m['tmpls'][0]['qfmt'] = '{{kana:}}'
     mm.save(m)
     c.q(reload=True)
+
+def test_tuning():
+    from tests.shared import getEmptyDeckWith
+    deck = getEmptyDeckWith(tuning="server", pragmas=dict(page_size=8192))
+    assert deck.tuning == "server"
+    assert deck.db.scalar("pragma cache_size") == -256*1024
+    assert deck.db.scalar("pragma synchronous") == 1
+    assert deck.db.scalar("pragma page_size") == 8192
+    deck.close()
+    deck = getEmptyDeckWith(tuning="low-memory", pragmas=dict(cache_size=500))
+    assert deck.db.scalar("pragma cache_size") == 500
+    assert deck.db.scalar("pragma temp_store") == 1
+    deck.close()
+    assertException(Exception, lambda: getEmptyDeckWith(tuning="foo"))
+    assertException(Exception,
+                    lambda: getEmptyDeckWith(pragmas=dict(foo=1)))
+
+def test_renderQAIter():
+    import threading
+    from anki import hooks, latex, render
+    from anki.hooks import addHook, remHook, setWorkerUnsafe
+    from anki.render import Renderer
+    deck = getEmptyCol()
+    for i in range(30):
+        n = deck.newNote()
+        n['Front'] = "front %d" % i
+        n['Back'] = "back %d" % i
+        deck.addNote(n)
+    # filters added at runtime run in the workers
+    def safe(html, type, fields, model, data, col):
+        return html + "<!--safe %s %s-->" % (type, fields['Front'])
+    # while one that needs the collection is registered, rendering stays here
+    def mark(html, type, fields, model, data, col):
+        assert col is deck
+        return html + "<!--%s-->" % type
+    setWorkerUnsafe(mark)
+    old = Renderer.batchSize
+    Renderer.batchSize = 7
+    Pool = render.ProcessPoolExecutor
+    # LaTeX's filter would keep everything in this process
+    remHook("mungeQA", latex.mungeQA)
+    try:
+        addHook("mungeQA", safe)
+        serial = deck.renderQA(type="all")
+        assert len(serial) == 30
+        assert "<!--safe q front 0-->" in serial[0]['a']
+        assert list(deck.renderQAIter(type="all", workers=2)) == serial
+        # forking while another thread runs isn't safe
+        pools = []
+        def pool(*args, **kwargs):
+            pools.append(args)
+            return Pool(*args, **kwargs)
+        render.ProcessPoolExecutor = pool
+        done = threading.Event()
+        t = threading.Thread(target=done.wait)
+        t.start()
+        try:
+            assert list(deck.renderQAIter(type="all", workers=2)) == serial
+            assert not pools
+        finally:
+            done.set()
+            t.join()
+        assert list(deck.renderQAIter(type="all", workers=2)) == serial
+        assert pools
+        addHook("mungeQA", mark)
+        serial = deck.renderQA(type="all")
+        assert "<!--q-->\n\n<hr id=answer>" in serial[0]['a']
+        assert list(deck.renderQAIter(type="all", workers=2)) == serial
+    finally:
+        Renderer.batchSize = old
+        render.ProcessPoolExecutor = Pool
+        remHook("mungeQA", safe)
+        remHook("mungeQA", mark)
+        hooks._workerUnsafe.discard(mark)
+        addHook("mungeQA", latex.mungeQA)
+    cids = [d['id'] for d in serial[:5]]
+    assert list(deck.renderQAIter(cids)) == deck.renderQA(cids)
+
+def test_fixIntegrity():
+    deck = getEmptyCol()
+    for i in range(5):
+        n = deck.newNote()
+        n['Front'] = "front %d" % i
+        n.tags = ["tag%d" % i]
+        deck.addNote(n)
+    assert deck.fixIntegrity(optimize=False)[1]
+    nids = deck.db.list("select id from notes order by id")
+    cids = deck.db.list("select id from cards order by id")
+    # a card with a missing template, a note with a bad field count, a
+    # card without a note, a note without cards, and stale caches
+    deck.db.execute("update cards set ord = 5 where id = ?", cids[0])
+    deck.db.execute("update notes set flds = 'x' where id = ?", nids[1])
+    deck.db.execute("update cards set nid = 1 where id = ?", cids[2])
+    deck.db.execute("update cards set odue = 5, queue = 2, due = 200000, "
+                    "ivl = 2.5 where id = ?", cids[3])
+    deck.db.execute("update notes set sfld = 'stale' where id = ?", nids[4])
+    deck.tags.registerAll([])
+    phases = []
+    report, ok = deck.fixIntegrity(
+        progress=lambda phase, cnt: phases.append(phase), optimize=False)
+    assert not ok
+    assert "Deleted 1 card with missing template." in report
+    assert "Deleted 1 note with wrong field count." in report
+    assert "Deleted 1 card with missing note." in report
+    assert "Deleted 1 note with no cards." in report
+    assert "Fixed 1 card with invalid properties." in report
+    assert "Reviews had incorrect due date." in report
+    assert deck.noteCount() == 2
+    c = deck.getCard(cids[3])
+    assert (c.odue, c.due, c.ivl) == (0, deck.sched.today, 1)
+    assert deck.db.scalar("select sfld from notes where id = ?",
+                          nids[4]) == "front 4"
+    assert sorted(deck.tags.all()) == ["tag3", "tag4"]
+    assert phases[0] == "integrity" and "optimize" not in phases
+    assert [p for p, t in deck.dbcheck.timings] == [
+        "integrity", "models", "notes", "fix"]
+    # and a clean collection stays so
+    assert deck.fixIntegrity()[1]
+    # field caches checked in worker processes
+    deck.db.execute("update notes set sfld = 'stale'")
+    deck.dbcheck.chunkSize = 1
+    assert deck.fixIntegrity(optimize=False, workers=2)[1]
+    assert deck.db.list("select sfld from notes order by id") == [
+        "front 3", "front 4"]
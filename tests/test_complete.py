@@ -0,0 +1,63 @@
+# coding: utf-8
+
+from anki.complete import PrefixIndex
+from tests.shared import getEmptyCol
+
+def test_prefixIndex():
+    idx = PrefixIndex(["beta", "Alpha", "alphabet", "ALPHA", "gamma"])
+    assert len(idx) == 5
+    assert idx.complete("al") == ["ALPHA", "Alpha", "alphabet"]
+    assert idx.complete("AL", limit=1) == ["ALPHA"]
+    assert idx.complete("") == ["ALPHA", "Alpha", "alphabet", "beta", "gamma"]
+    assert idx.complete("delta") == []
+    idx.add("alpha")
+    idx.add("alpha")
+    assert idx.complete("alpha") == ["ALPHA", "Alpha", "alpha", "alphabet"]
+    idx.remove("Alpha")
+    idx.remove("missing")
+    assert "Alpha" not in idx and "alpha" in idx
+    assert idx.complete("alpha") == ["ALPHA", "alpha", "alphabet"]
+
+def test_tags():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = "1"
+    f.tags = ["animal", "animal::dog"]
+    deck.addNote(f)
+    assert deck.completion.complete("tags", "ANI") == ["animal", "animal::dog"]
+    # new tags are added as they're registered
+    f = deck.newNote()
+    f['Front'] = "2"
+    f.tags = ["Anise"]
+    deck.addNote(f)
+    assert deck.completion.complete("tags", "ani") == [
+        "animal", "animal::dog", "Anise"]
+    # and unused ones go when the registry is rebuilt
+    deck.remNotes([f.id])
+    deck.tags.registerNotes()
+    assert deck.completion.complete("tags", "ani") == ["animal", "animal::dog"]
+
+def test_decks():
+    deck = getEmptyCol()
+    did = deck.decks.id("Spanish::Verbs")
+    assert deck.completion.complete("decks", "sp") == [
+        "Spanish", "Spanish::Verbs"]
+    deck.decks.id("Sport")
+    assert deck.completion.complete("decks", "sp") == [
+        "Spanish", "Spanish::Verbs", "Sport"]
+    deck.decks.rename(deck.decks.get(deck.decks.id("Spanish")), "French")
+    assert deck.completion.complete("decks", "sp") == ["Sport"]
+    assert deck.completion.complete("decks", "fr") == [
+        "French", "French::Verbs"]
+    deck.decks.rem(did)
+    assert deck.completion.complete("decks", "fr") == ["French"]
+
+def test_models():
+    deck = getEmptyCol()
+    assert deck.completion.complete("fields", "qu") == []
+    m = deck.models.current()
+    deck.models.renameField(m, m['flds'][0], "Question")
+    assert deck.completion.complete("fields", "qu") == ["Question"]
+    m['name'] = "Vocab"
+    deck.models.save(m)
+    assert deck.completion.complete("models", "VOC") == ["Vocab"]
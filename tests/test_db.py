@@ -0,0 +1,149 @@
+# coding: utf-8
+
+import os, tempfile, json
+
+from tests.shared import getEmptyCol
+
+def test_profile():
+    deck = getEmptyCol()
+    assert deck.db.profile() is None
+    deck.db.startProfile(slowMs=0)
+    f = deck.newNote()
+    f['Front'] = "one"
+    deck.addNote(f)
+    deck.db.list("select id from cards where id in (1,2,3)")
+    deck.db.list("select id from cards where id in (4,5)")
+    deck.db.scalar("select 1 from notes where flds = 'foo'")
+    rep = deck.db.profile()
+    shapes = dict((q['sql'], q) for q in rep['queries'])
+    # literals and id lists are grouped together
+    q = shapes["select id from cards where id in (...)"]
+    assert q['calls'] == 2
+    assert sum(q['hist']) == 2
+    assert "select ? from notes where flds = ?" in shapes
+    # everything is slow with a zero threshold, and plans are captured
+    assert rep['slow']
+    assert any(s['plan'] for s in rep['slow']
+               if s['sql'].startswith("select"))
+    assert all(s['caller'] for s in rep['slow'])
+    # json dump
+    (fd, path) = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    deck.db.dumpProfile(path)
+    assert json.load(open(path))['queries']
+    os.unlink(path)
+    assert deck.db.stopProfile()
+    assert deck.db.profile() is None
+
+def test_boundIds():
+    deck = getEmptyCol()
+    for i in range(5):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        deck.addNote(f)
+    cids = deck.db.list("select id from cards order by id")
+    # small sets are inlined
+    with deck.db.boundIds(cids[:2]) as s:
+        assert s == "(%d,%d)" % tuple(cids[:2])
+    # force the temp table path
+    deck.db.bindThreshold = 0
+    with deck.db.boundIds(cids[:3]) as s:
+        assert "temp.ids" in s
+        assert deck.db.list(
+            "select id from cards where id in %s order by id" % s) == cids[:3]
+        # nested sets don't clash
+        with deck.db.boundIds(cids[3:]) as s2:
+            assert s2 != s
+            assert len(deck.db.list(
+                "select id from cards where id in " + s2)) == 2
+        assert len(deck.db.list("select id from cards where id in " + s)) == 3
+    assert not deck.db.scalar("select count() from temp.ids1")
+    # callers using the table behave as before
+    deck.remCards(cids[:2])
+    assert deck.cardCount() == 3
+    assert deck.noteCount() == 3
+    assert len(deck.renderQA(cids[2:], "card")) == 3
+
+def test_readers():
+    import threading
+    from anki.find import Finder
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = "one"
+    deck.addNote(f)
+    deck.save()
+    deck.openReaders(2)
+    assert deck.readPool
+    # uncommitted changes aren't visible to readers
+    f = deck.newNote()
+    f['Front'] = "two"
+    deck.addNote(f)
+    with deck.reader() as db:
+        assert db is not deck.db
+        assert db.scalar("select count() from cards") == 1
+    deck.save()
+    # readers hold a snapshot while the writer continues
+    with deck.reader() as db:
+        assert db.scalar("select count() from cards") == 2
+        f = deck.newNote()
+        f['Front'] = "three"
+        deck.addNote(f)
+        deck.save()
+        assert db.scalar("select count() from cards") == 2
+    # searches, stats and bound ids from a worker thread
+    res = {}
+    def work():
+        with deck.reader() as db:
+            db.bindThreshold = 0
+            res['cards'] = Finder(deck, db).findCards("tw*")
+            res['re'] = Finder(deck, db).findCards("front:re:^tw")
+            res['stats'] = deck.stats(db).report()
+            with db.boundIds([1, 2]) as s:
+                res['bound'] = db.list("select id from cards where id in "+s)
+    t = threading.Thread(target=work)
+    t.start(); t.join()
+    assert len(res['cards']) == 1
+    assert res['re'] == res['cards']
+    assert res['stats']
+    assert res['bound'] == []
+    deck.close()
+    assert not deck.readPool
+    # reopening opens them again
+    deck.reopen()
+    assert deck.readPool
+    with deck.reader() as db:
+        assert db.scalar("select count() from cards") == 3
+    deck.closeReaders()
+    deck.close()
+    deck.reopen()
+    assert not deck.readPool
+
+def test_iterate():
+    deck = getEmptyCol()
+    for i in range(25):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        deck.addNote(f)
+    rows = list(deck.db.iterate("select id from notes order by id", batch=7))
+    assert rows == deck.db.all("select id from notes order by id")
+    assert list(deck.db.iterate(
+        "select id from notes where id = ?", rows[3][0])) == [rows[3]]
+    assert not list(deck.db.iterate("select id from notes where 0"))
+
+def test_changes():
+    deck = getEmptyCol()
+    db = deck.db
+    n = db.changes
+    db.scalar("select count() from notes")
+    assert db.changes == n
+    db.execute("update col set mod = mod")
+    assert db.changes > n
+    n = db.changes
+    deck.save()
+    assert db.changes > n
+    # unique across connections, so a reopened collection doesn't reuse
+    # old values
+    n = db.changes
+    deck.close()
+    deck.reopen()
+    assert deck.db.changes > n
@@ -112,14 +112,24 @@ def test_export_anki_due():
     deck2.sched.reset()
     assert c.due - deck2.sched.today == 1
 
-# @nose.with_setup(setup1)
-# def test_export_textcard():
-#     e = TextCardExporter(deck)
-#     f = unicode(tempfile.mkstemp(prefix="ankitest")[1])
-#     os.unlink(f)
-#     e.exportInto(f)
-#     e.includeTags = True
-#     e.exportInto(f)
+def test_export_textcard():
+    deck = getEmptyCol()
+    m = deck.models.current()
+    # text before the question in the answer
+    m['tmpls'][0]['afmt'] = (
+        "<i>Answer to:</i> {{FrontSide}}\n\n<hr id=answer>\n\n{{Back}}")
+    deck.models.save(m)
+    f = deck.newNote()
+    f['Front'] = "foo"; f['Back'] = "<b>bar</b>"
+    deck.addNote(f)
+    e = TextCardExporter(deck)
+    fd, path = tempfile.mkstemp(prefix="ankitest")
+    os.close(fd)
+    os.unlink(path)
+    e.exportInto(path)
+    with open(path, encoding="utf8") as file:
+        assert file.read() == "foo\tbar\n"
+    os.unlink(path)
 
 @nose.with_setup(setup1)
 def test_export_textnote():
@@ -1,7 +1,9 @@
 # coding: utf-8
+import sqlite3
+
 from nose.tools import assert_raises
 
-from anki.find import Finder
+from anki.find import Finder, findDupes
 from tests.shared import getEmptyCol
 
 def test_parse():
@@ -20,6 +22,418 @@ def test_parse():
     assert f._tokenize("embedded'string") == ["embedded'string"]
     assert f._tokenize("deck:'two words'") == ["deck:two words"]
 
+def test_parseTree():
+    f = Finder(None)
+    assert f._parse("dog") == ('text', 'dog')
+    assert f._parse("a or b c") == (
+        'or', [('text', 'a'), ('and', [('text', 'b'), ('text', 'c')])])
+    assert f._parse("-(Tag:x or y)") == ('not', ('group', (
+        'or', [('cmd', 'tag', 'x'), ('text', 'y')])))
+    assert f._parse("") is None
+    # unbalanced groups
+    with assert_raises(Exception):
+        f._parse("(a")
+    with assert_raises(Exception):
+        f._parse("a)")
+
+def test_searchCache():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = 'dog'
+    deck.addNote(f)
+    assert len(deck.findCards("deck:def* dog")) == 1
+    assert len(deck.find._compiled) == 1
+    # repeated searches reuse the compiled sql
+    deck.findCards("deck:def* dog")
+    assert len(deck.find._compiled) == 1
+    # but deck changes invalidate it
+    did = deck.decks.id("default2")
+    deck.decks.setDeck([f.cards()[0].id], did)
+    assert len(deck.findCards("deck:def* dog")) == 1
+    assert len(deck.find._compiled) == 2
+    # field searches are filtered in sqlite, so can be cached too
+    deck.findCards("front:dog")
+    assert len(deck.find._compiled) == 3
+    # unbalanced groups return nothing, as before
+    assert deck.findCards("(dog") == []
+
+def test_resultCache():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = 'dog'
+    deck.addNote(f)
+    cid = f.cards()[0].id
+    assert deck.findCards("dog", order=True) == [cid]
+    stats = deck.find.cacheStats()
+    assert deck.findCards("dog", order=True) == [cid]
+    assert deck.find.cacheStats()['hits'] == stats['hits'] + 1
+    # a different order or sort setting is a different result
+    assert deck.findCards("dog") == [cid]
+    deck.conf['sortBackwards'] = True
+    assert deck.findCards("dog", order=True) == [cid]
+    assert deck.find.cacheStats()['hits'] == stats['hits'] + 1
+    # writes invalidate it
+    f = deck.newNote()
+    f['Front'] = 'dog'
+    deck.addNote(f)
+    assert len(deck.findCards("dog", order=True)) == 2
+    assert len(deck.findNotes("dog")) == 2
+    deck.remNotes([f.id])
+    assert len(deck.findNotes("dog")) == 1
+    # returned lists can be modified safely
+    deck.findCards("dog").append(1)
+    assert deck.findCards("dog") == [cid]
+    # a write committed while the query runs doesn't leave its result
+    # cached under the newer counter
+    db = deck.find.db
+    old = db.list
+    def list(*args):
+        res = old(*args)
+        deck.db._changed()
+        return res
+    db.list = list
+    try:
+        deck.findCards("cat")
+    finally:
+        del db.list
+    misses = deck.find.cacheStats()['misses']
+    deck.findCards("cat")
+    assert deck.find.cacheStats()['misses'] == misses + 1
+    # results from before a write aren't kept
+    assert deck.find.cacheStats()['size']
+    f = deck.newNote()
+    f['Front'] = 'cat'
+    deck.addNote(f)
+    deck.findCards("dog")
+    assert deck.find.cacheStats()['size'] == 1
+    # nor are large ones
+    deck.find.resultCacheMaxIds = 0
+    deck.findCards("dog", order=True)
+    assert deck.find.cacheStats()['size'] == 1
+
+def test_pagedCards():
+    deck = getEmptyCol()
+    m = deck.models.byName("Basic (and reversed card)")
+    deck.models.setCurrent(m)
+    for i, front in enumerate(("b", "B", "a", "10", "c", "b", "d")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = str(i)
+        deck.addNote(f)
+    for sort in ("noteCrt", "noteFld", "cardDue", "cardMod"):
+        deck.conf['sortType'] = sort
+        for back in (False, True):
+            deck.conf['sortBackwards'] = back
+            full = deck.findCards("", order=True)
+            ids = []
+            cursor = None
+            while True:
+                page, cursor = deck.find.findCardsPage(
+                    "", order=True, after=cursor, limit=3)
+                ids.extend(page)
+                if cursor is None:
+                    break
+            if sort == "noteCrt":
+                assert ids == full
+            else:
+                # ties may come back in a different order
+                assert sorted(ids) == sorted(full)
+    # unordered and custom orders
+    p = deck.find.pagedCards("b", pageSize=2)
+    assert list(p) == sorted(deck.findCards("b"))
+    p = deck.find.pagedCards("-b", order="c.id desc", pageSize=3)
+    assert list(p) == sorted(deck.findCards("-b"), reverse=True)
+    # rows are fetched as needed, and the total is counted separately
+    p = deck.find.pagedCards("", order=True, pageSize=4)
+    assert len(p.loaded()) == 4
+    assert len(p) == 14
+    assert len(p.loaded()) == 4
+    assert p[5] == full[5] and p[-1] == full[-1]
+    assert p.index(full[9]) == 9
+    assert len(p.loaded()) == 14
+    # slices only count when they need the end
+    p = deck.find.pagedCards("", order=True, pageSize=4)
+    assert p[2:6] == full[2:6] and p[:3] == full[:3]
+    assert not p.countKnown()
+    assert p[::3] == full[::3] and p[-3:] == full[-3:]
+    assert p.countKnown()
+    # the count can come from another connection
+    p = deck.find.pagedCards("", order=True, pageSize=4)
+    p.setCount(p.countWith(deck.db))
+    assert p.countKnown() and len(p) == 14 and len(p.loaded()) == 4
+    # invalid searches
+    assert not deck.find.pagedCards("(b")
+    with assert_raises(Exception):
+        deck.find.pagedCards("card:foo")
+
+def test_explain():
+    deck = getEmptyCol()
+    for front in ("dog", "cat", "dogs"):
+        f = deck.newNote()
+        f['Front'] = front
+        deck.addNote(f)
+    res = deck.find.explain("dog* -front:dogs")
+    assert res['rows'] == 1
+    assert res['args'][:2] == ["%dog%%", "%dog%%"]
+    assert "regexp" in res['sql']
+    assert "like" in res['sql'] and res['plan']
+    assert set(res['timings']) == set(["parse", "build", "sql"])
+    # one entry per term, with its own count
+    assert [c['clause'] for c in res['clauses']] == [
+        ('text', 'dog*'), ('cmd', 'front', 'dogs')]
+    assert [c['rows'] for c in res['clauses']] == [2, 1]
+    # errors are reported rather than raised
+    assert deck.find.explain("(dog")['error'] == "syntax"
+    assert deck.find.explain("card:foo")['error'] == "invalidSearch"
+    # nothing was cached
+    assert not deck.find._compiled and not deck.find._results
+
+def test_textIndex():
+    deck = getEmptyCol()
+    if not deck.indexes.indexes['text'].supported():
+        return
+    for front in ("hello<b>world</b>", "dog", "Cats and dogs", "50%"):
+        f = deck.newNote()
+        f['Front'] = front
+        deck.addNote(f)
+    queries = ("dog", "helloworld", "DOGS", "do", "c*s", "-dog", "d_g",
+               "50\\%", "cat or world", "nothing")
+    expected = [sorted(deck.findCards(q)) for q in queries]
+    assert deck.indexes.enable("text")
+    assert "notes_fts" in deck.find._compile("dog")[0]
+    # short terms fall back to like
+    assert "notes_fts" not in deck.find._compile("do")[0]
+    assert [sorted(deck.findCards(q)) for q in queries] == expected
+    # changes are tracked
+    f['Front'] = "a bird"
+    f.flush()
+    assert deck.findCards("bird") == [f.cards()[0].id]
+    assert not deck.findCards("50%")
+    deck.remNotes([f.id])
+    assert not deck.findCards("bird")
+    # the index is kept after closing
+    deck.close()
+    deck.reopen()
+    assert deck.indexes.enabled("text")
+    assert len(deck.findCards("dog")) == 2
+    # and rebuilt if the collection was changed elsewhere
+    deck.close()
+    db = sqlite3.connect(deck.path)
+    db.execute("update notes set flds = 'zebra', sfld = 'zebra'")
+    db.execute("update col set mod = mod + 1")
+    db.commit()
+    db.close()
+    deck.reopen()
+    assert len(deck.findCards("zebra")) == 3
+    assert not deck.findCards("dog")
+    deck.indexes.disable("text")
+    assert "notes_fts" not in deck.find._compile("zebra")[0]
+    assert len(deck.findCards("zebra")) == 3
+
+def test_fieldIndex():
+    deck = getEmptyCol()
+    for front, back in (("dog", "cat"), ("Dog", "<b>cat</b>"),
+                        ("goats are fun", "sheep"), ("a_b", "50%"),
+                        ("axb", "5*")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    queries = ("front:dog", "front:do", "front:do*", "back:cat",
+               "-back:cat", "front:a_b", "front:a\\_b", "front:a\\_c",
+               "back:50\\%", "back:5\\*", "back:5*", "front:*are*",
+               "front:* dog", "back:*")
+    expected = [sorted(deck.findCards(q)) for q in queries]
+    # escaped wildcards match literally
+    assert [len(r) for r in expected[5:11]] == [2, 1, 0, 1, 1, 2]
+    dupes = findDupes(deck, "back")
+    assert deck.indexes.enable("fields")
+    assert "idx.fields" in deck.find._compile("front:dog")[0]
+    assert [sorted(deck.findCards(q)) for q in queries] == expected
+    assert findDupes(deck, "back") == dupes
+    assert len(dupes) == 1
+    # field searches can now be cached
+    assert ('front:do*', deck.find._cacheKey()) in deck.find._compiled
+    # changes are tracked
+    f['Back'] = "cat"
+    f.flush()
+    assert len(deck.findCards("back:cat")) == 2
+    assert len(findDupes(deck, "back")[0][1]) == 3
+    m = deck.models.current()
+    deck.models.moveField(m, m['flds'][1], 0)
+    assert len(deck.findCards("back:cat")) == 2
+    assert len(deck.findCards("dupe:%s,cat" % m['id'])) == 3
+    deck.remNotes([f.id])
+    assert len(deck.findCards("back:cat")) == 1
+    assert len(deck.findCards("dupe:%s,cat" % m['id'])) == 2
+
+def test_tagIndex():
+    deck = getEmptyCol()
+    for tags in ("monkey animal_1 * %", "sheep goat animal11", "Sheep",
+                 ""):
+        f = deck.newNote()
+        f['Front'] = tags or "none"
+        f.tags = deck.tags.split(tags)
+        deck.addNote(f)
+    queries = ("tag:*", "tag:\\*", "tag:%", "tag:\\%", "tag:animal_1",
+               "tag:animal\\_1", "tag:sheep", "tag:shee*", "tag:*mal*",
+               "-tag:sheep", "tag:none", "tag:donkey", "tag:*oat",
+               # these match across adjacent tags, as they always have
+               "tag:animal11*she*", "tag:goat_sheep", "tag:animal_1*mon*")
+    expected = [sorted(deck.findCards(q)) for q in queries]
+    assert [len(r) for r in expected[-3:]] == [1, 1, 1]
+    assert deck.indexes.enable("tags")
+    assert "notetags" in deck.find._compile("tag:sheep")[0]
+    assert "notetags" in deck.find._compile("tag:*oat")[0]
+    assert "notetags" not in deck.find._compile("tag:animal11*she*")[0]
+    assert [sorted(deck.findCards(q)) for q in queries] == expected
+    # bulk changes
+    nids = deck.db.list("select id from notes")
+    deck.tags.bulkAdd(nids, "foo sheep")
+    assert len(deck.findCards("tag:foo")) == 4
+    assert len(deck.findCards("tag:sheep")) == 4
+    deck.tags.bulkRem(nids, "anim*")
+    assert not deck.findCards("tag:animal*")
+    # which update the index in one go, as a rebuild would
+    sql = "select nid, tag collate binary from idx.notetags order by 1, 2"
+    rows = deck.db.all(sql)
+    deck.indexes.rebuild()
+    assert deck.db.all(sql) == rows
+    f = deck.getNote(nids[0])
+    f.tags = ["bar"]
+    f.flush()
+    assert deck.findCards("tag:bar") == [c.id for c in f.cards()]
+    # registry rebuild and deck listing match the unindexed versions
+    deck.tags.registerNotes()
+    tags = sorted(deck.tags.all())
+    assert "goat" in tags and "animal11" not in tags
+    assert sorted(deck.tags.byDeck(1)) == tags
+    deck.indexes.disable("tags")
+    deck.tags.registerNotes()
+    assert sorted(deck.tags.all()) == tags
+    assert sorted(deck.tags.byDeck(1)) == tags
+
+def test_ratedIndex():
+    deck = getEmptyCol()
+    for i in range(3):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        deck.addNote(f)
+    cids = sorted(deck.db.list("select id from cards"))
+    def log(cid, days, ease):
+        id = (deck.sched.dayCutoff - 86400*days + 3600)*1000 + cid % 1000
+        deck.db.execute(
+            "insert into revlog values (?,?,0,?,0,0,0,0,0)", id, cid, ease)
+    log(cids[0], 100, 1)
+    log(cids[1], 10, 3)
+    queries = ("rated:1", "rated:20", "rated:20:3", "rated:20:1",
+               "rated:200", "rated:200:1")
+    expected = [sorted(deck.findCards(q)) for q in queries]
+    # the unindexed search is capped at 31 days
+    assert expected[4] == [cids[1]]
+    assert deck.indexes.enable("rated")
+    assert "idx.rated" in deck.find._compile("rated:20")[0]
+    assert [sorted(deck.findCards(q)) for q in queries[:4]] == expected[:4]
+    assert sorted(deck.findCards("rated:200")) == cids[:2]
+    assert deck.findCards("rated:200:1") == [cids[0]]
+    # answering cards updates the index
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.findCards("rated:1") == [c.id]
+    assert deck.findCards("rated:1:3") == [c.id]
+    assert not deck.findCards("rated:1:1")
+    # removing log entries recomputes the card
+    deck.db.execute("delete from revlog where cid = ?", cids[0])
+    assert not deck.findCards("rated:200:1")
+    log(cids[2], 50, 4)
+    assert deck.findCards("rated:60:4") == [cids[2]]
+    deck.db.execute("update revlog set ease = 2 where cid = ?", cids[2])
+    assert not deck.findCards("rated:60:4")
+    assert deck.findCards("rated:60:2") == [cids[2]]
+
+def test_materialize():
+    deck = getEmptyCol()
+    for i, tags in enumerate(("foo", "foo bar", "bar")):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        f.tags = tags.split()
+        deck.addNote(f)
+    cids = sorted(deck.db.list("select id from cards"))
+    assert not deck.find.materialize("bad", "card:foo")
+    queries = dict(foo="tag:foo", notbar="-tag:bar front:*",
+                   rated="rated:1", deck="deck:default is:new")
+    for name, query in queries.items():
+        assert deck.find.materialize(name, query)
+    assert deck.find.materialized() == queries
+    def check():
+        # changes are applied on save, and the rest refilled on refresh
+        deck.save()
+        deck.find.refreshMaterialized()
+        for name, query in queries.items():
+            res = sorted(deck.findCards(query))
+            assert "idx.savedcards" in deck.find._compile(query)[0]
+            deck.find.dematerialize(name)
+            assert res == sorted(deck.findCards(query))
+            deck.find.materialize(name, query)
+        return sorted(deck.findCards("tag:foo"))
+    assert check() == cids[:2]
+    # changes are applied card by card
+    n = deck.getCard(cids[2]).note()
+    n.tags = ["foo"]
+    n.flush()
+    # before then, searches read the table and the changed cards, without
+    # writing anything
+    changes = deck.db.changes
+    assert sorted(deck.findCards("tag:foo")) == cids
+    assert "idx.saveddirty" in deck.find._compile("tag:foo")[0]
+    assert deck.db.changes == changes
+    deck.save()
+    assert deck.db.scalar("select stale from idx.saved where name='foo'") == 0
+    assert not deck.db.scalar("select count() from idx.saveddirty")
+    assert check() == cids
+    deck.remCards([cids[0]])
+    assert sorted(deck.findCards("tag:foo")) == cids[1:]
+    # searches depending on other tables are refilled, when opened rather
+    # than on save
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.findCards("rated:1") == [c.id]
+    deck.save()
+    stale = "select stale from idx.saved where name = ?"
+    assert deck.db.scalar(stale, "rated")
+    assert not deck.db.scalar(stale, "deck")
+    deck.find.refreshMaterialized("rated")
+    assert not deck.db.scalar(stale, "rated")
+    assert "idx.savedcards" in deck.find._compile("rated:1")[0]
+    assert deck.findCards("rated:1") == [c.id]
+    assert deck.findCards("deck:default is:new") == [
+        cid for cid in cids[1:] if cid != c.id]
+    # as are searches whose meaning changes
+    deck.decks.rename(deck.decks.get(1), "renamed")
+    with assert_raises(Exception):
+        deck.findCards("deck:default is:new")
+    deck.decks.rename(deck.decks.get(1), "Default")
+    assert deck.findCards("deck:default is:new") == [
+        cid for cid in cids[1:] if cid != c.id]
+    did = deck.decks.id("other")
+    deck.decks.setDeck([cids[1]], did)
+    assert deck.find.materialize("cur", "deck:current")
+    assert cids[1] not in deck.findCards("deck:current")
+    deck.decks.select(did)
+    assert deck.findCards("deck:current") == [cids[1]]
+    deck.find.dematerialize("cur")
+    # changes made elsewhere mark everything stale
+    deck.indexes.rebuild()
+    assert not deck.db.scalar("select count() from idx.saved where not stale")
+    check()
+    # removing the last one stops tracking changes
+    for name in queries:
+        deck.find.dematerialize(name)
+    assert not deck.indexes.enabled("saved")
+    assert sorted(deck.findCards("tag:foo")) == cids[1:]
+
 def test_findCards():
     deck = getEmptyCol()
     f = deck.newNote()
@@ -251,6 +665,48 @@ def test_findReplace():
     f.load(); assert f['Back'] != "reg"
     assert deck.findReplace(nids, "B.r", "reg", regex=True) == 1
     f.load(); assert f['Back'] == "reg"
+    # anchors match each field, not the note as a whole
+    assert deck.findReplace(nids, "^reg$", "bar", regex=True) == 1
+    f.load(); assert f['Back'] == "bar"
+    assert deck.findReplace(nids, "^ba", "Ba", regex=True,
+                            field="Back") == 1
+    f.load(); assert f['Back'] == "Bar"
+
+def test_regexSearch():
+    deck = getEmptyCol()
+    for front, back in (("dog", "Cat"), ("dogs", "cattle"), ("a_b", "c"),
+                        ("<b>frog</b>", "x")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    def fronts(q):
+        return sorted(deck.getCard(c).note()['Front']
+                      for c in deck.findCards(q))
+    assert fronts("re:^dogs?") == ["dog", "dogs"]
+    assert fronts("re:cat$") == ["dog"]
+    # each field is matched separately
+    assert fronts('"re:^c$"') == ["a_b"]
+    assert fronts("front:re:og") == ["<b>frog</b>", "dog", "dogs"]
+    assert fronts("front:re:^d.g$") == ["dog"]
+    assert fronts("back:re:^cat") == ["dog", "dogs"]
+    assert fronts("-front:re:o") == ["a_b"]
+    # invalid regexes are invalid searches
+    with assert_raises(Exception):
+        deck.findCards('"re:a("')
+    with assert_raises(Exception):
+        deck.findCards("front:re:[")
+    # like before, _ matches any character in field searches
+    assert fronts("front:a_b") == ["a_b"]
+    assert fronts("front:d_g") == ["dog"]
+    # the same with the field index
+    if deck.indexes.enable("fields"):
+        assert fronts("front:re:^d.g$") == ["dog"]
+        assert fronts("back:re:^cat") == ["dog", "dogs"]
+    # dupes
+    deck.indexes.disable("fields")
+    m = deck.models.current()
+    assert fronts("dupe:%s,frog" % m['id']) == ["<b>frog</b>"]
 
 def test_findDupes():
     deck = getEmptyCol()
@@ -161,6 +161,24 @@ def test_csv():
     assert deck.cardCount() == 11
     deck.close()
 
+def test_csvFieldIndex():
+    # duplicates are looked up in the index instead
+    deck = getEmptyCol()
+    assert deck.indexes.enable("fields")
+    file = str(os.path.join(testDir, "support/text-2fields.txt"))
+    i = TextImporter(deck, file)
+    i.initMapping()
+    i.run()
+    assert len(i.log) == 5
+    assert i.total == 5
+    i.run()
+    assert len(i.log) == 10
+    assert i.total == 5
+    i.importMode = 1
+    i.run()
+    assert i.total == 0
+    deck.close()
+
 def test_csv2():
     deck = getEmptyCol()
     mm = deck.models
@@ -305,6 +305,26 @@ def test_templates():
     assert anki.template.render("{{#Bar}}{{#Foo}}{{Foo}}{{/Foo}}{{/Bar}}", d) == "x"
     assert anki.template.render("{{#Baz}}{{#Foo}}{{Foo}}{{/Foo}}{{/Baz}}", d) == ""
 
+def test_compiledTemplates():
+    from anki.template import Template
+    # rendering matches the search-and-replace renderer, quirks included
+    templates = (
+        "{{Foo}} {{Foo}} {{{Bar}}} {{text:Foo}} {{!note}}",
+        "{{^Baz}}none{{/Baz}}{{#Foo}}[{{Bar}}]{{/Foo}}",
+        "{{#Foo}}a{{/Foo}}{{#Foo}}a{{/Foo}}{{#Bar}}{{#Bar}}b{{/Bar}}{{/Bar}}",
+        "{{#cq:1:Foo}}cloze{{/cq:1:Foo}}{{cq-1:Foo}}|{{ca-1:Foo}}",
+        "{{Unknown}} {{#Foo}} {{&Foo}}",
+        "{{=<% %>=}}<%Foo%>",
+        "{{Foo}}{{Bar}}")
+    values = ("", "x", "<br>", "{{c1::a::hint}} {{c2::b}}", "{{Bar}}", "a{",
+              "}b", "{x}")
+    for tmpl in templates:
+        for foo in values:
+            for bar in values:
+                d = dict(Foo=foo, Bar=bar)
+                assert (anki.template.render(tmpl, d) ==
+                        Template(tmpl, dict(d)).render())
+
 def test_availOrds():
     d = getEmptyCol()
     m = d.models.current(); mm = d.models
@@ -77,13 +77,162 @@ def test_review():
     d.undo()
     d.reset()
     assert d.sched.counts() == (2, 0, 0)
-    # performing a normal op will clear the review queue
+    # performing a normal op is undone first, then the review
     c = d.sched.getCard()
     d.sched.answerCard(c, 3)
     assert d.undoName() == "Review"
     d.save("foo")
     assert d.undoName() == "foo"
     d.undo()
+    assert d.undoName() == "Review"
+    d.undo()
+    assert not d.undoName()
+
+
+
+def test_multiLevel():
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = "one"
+    d.addNote(f)
+    cid = f.cards()[0].id
+    did = d.decks.id("new deck")
+    # a bulk op, a note edit and a registry change
+    d.save("Change Deck")
+    d.db.execute("update cards set did = ? where id = ?", did, cid)
+    d.save("Edit")
+    f['Front'] = "two"
+    f.flush()
+    d.save("Rename Deck")
+    d.decks.rename(d.decks.get(did), "renamed")
+    d.save("Delete")
+    d.remNotes([f.id])
+    assert not d.cardCount()
+    # each is undone in turn, restoring only what it changed
+    assert d.undoName() == "Delete"
+    d.undo()
+    assert d.getCard(cid).did == did
+    assert d.getNote(f.id)['Front'] == "two"
+    assert not d.db.scalar("select count() from graves")
+    d.undo()
+    assert d.decks.name(did) == "new deck"
+    assert not d.decks.byName("renamed")
+    d.undo()
+    assert d.getNote(f.id)['Front'] == "one"
+    d.undo()
+    assert d.getCard(cid).did == 1
+    assert d.undoName() is None
+    # and can be redone
+    assert d.redoName() == "Change Deck"
+    d.redo()
+    d.redo()
+    assert d.getCard(cid).did == did
+    assert d.getNote(f.id)['Front'] == "two"
+    assert d.redoName() == "Rename Deck"
+    d.redo()
+    assert d.decks.byName("renamed")
+    # starting a new step drops the redo history
+    d.save("foo")
+    assert d.redoName() is None
+    d.conf['foo'] = 1
+    d.undo()
+    assert 'foo' not in d.conf
+    # and it survives a save
+    d.save()
+    d.undo()
+    assert d.decks.name(did) == "new deck"
+
+def test_undoOutsideSteps():
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = "one"
+    d.addNote(f)
+    d.save("Edit")
+    f['Front'] = "two"
+    f.flush()
+    d.save()
+    # unrelated writes leave the history alone
+    f2 = d.newNote()
+    f2['Front'] = "three"
+    d.addNote(f2)
+    assert d.undoName() == "Edit"
+    d.undo()
+    assert d.getNote(f.id)['Front'] == "one"
+    assert d.getNote(f2.id)['Front'] == "three"
+    d.redo()
+    # but writing to a row it would restore drops it
+    f['Front'] = "four"
+    f.flush()
+    d.undo()
+    assert d.getNote(f.id)['Front'] == "four"
     assert not d.undoName()
 
+def test_undoAfterAdd():
+    d = getEmptyCol()
+    d.save("Add")
+    f = d.newNote()
+    f['Front'] = "one"
+    d.addNote(f)
+    d.save()
+    # adding outside a step moves nextPos on, which doesn't clash
+    f2 = d.newNote()
+    f2['Front'] = "two"
+    d.addNote(f2)
+    d.save()
+    assert d.undoName() == "Add"
+    d.undo()
+    assert d.noteCount() == 1
+    assert d.getNote(f2.id)['Front'] == "two"
+    assert d.conf['nextPos'] == 3
+    # a clash is noticed before the menu is updated
+    d.redo()
+    assert d.undoName() == "Add"
+    f = d.getNote(f.id)
+    f['Front'] = "three"
+    f.flush()
+    assert d.undoName() is None
+
+def test_undoReviewThenEdit():
+    d = getEmptyCol()
+    for front in ("one", "two"):
+        f = d.newNote()
+        f['Front'] = front
+        d.addNote(f)
+    d.save()
+    d.reset()
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    # editing another note without a checkpoint, as Edit Current does
+    other = [n for n in d.findNotes("") if n != c.nid][0]
+    f = d.getNote(other)
+    f['Front'] = "edited"
+    f.flush()
+    assert d.undoName() == "Review"
+    assert d.undo() == c.id
+    c.load()
+    assert c.queue == 0
+    assert d.getNote(other)['Front'] == "edited"
 
+def test_undoLimits():
+    d = getEmptyCol()
+    j = d.undoJournal
+    j.maxSteps = 5
+    for i in range(10):
+        d.save("op%d" % i)
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    d.save()
+    assert j.stats()['undo'] == 5
+    assert d.undoName() == "op9"
+    # a large step drops the rest
+    j.maxRows = 10
+    d.save("bulk")
+    for i in range(20):
+        f = d.newNote()
+        f['Front'] = "bulk%d" % i
+        d.addNote(f)
+    d.save()
+    assert j.stats()['undo'] == 1
+    d.undo()
+    assert d.noteCount() == 10
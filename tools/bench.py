@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Usage:
+# tools/bench.py             # run all benchmarks
+# tools/bench.py ids         # run only the 'ids' benchmark
+# notes=200000 tools/bench.py  # change the synthetic collection size
+#
+# Builds a throwaway collection filled with synthetic notes, and prints the
+# time taken by each step.
+
+import os, sys, time, tempfile, random, sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import Collection
+from anki.storage import tuningProfiles
+from anki.utils import ids2str, intTime, guid64, joinFields, fieldChecksum, \
+    timestampID
+
+def timed(label, fn, *args):
+    t = time.time()
+    res = fn(*args)
+    print("%-40s %8.1fms" % (label, (time.time() - t)*1000))
+    return res
+
+def buildCol(count, path=None, **kwargs):
+    "Create a collection with COUNT basic notes, one card each."
+    if not path:
+        (fd, path) = tempfile.mkstemp(suffix=".anki2")
+        os.close(fd)
+        os.unlink(path)
+    col = Collection(path, **kwargs)
+    m = col.models.byName("Basic")
+    now = intTime()
+    base = intTime(1000)
+    notes = []
+    cards = []
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta"]
+    for i in range(count):
+        front = "%s %d" % (random.choice(words), i)
+        back = "%s %s" % (random.choice(words), random.choice(words))
+        notes.append((base+i, guid64(), m['id'], now, -1,
+                      " tag%d " % (i % 50), joinFields([front, back]), front,
+                      fieldChecksum(front), 0, ""))
+        type = random.choice((0, 2))
+        cards.append((base+i, base+i, 1, 0, now, -1, type, type,
+                      i if type == 0 else random.randint(0, 365),
+                      0, 2500, 0, 0, 0, 0, 0, 0, ""))
+    col.db.executemany(
+        "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)", notes)
+    col.db.executemany(
+        "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", cards)
+    col.tags.registerNotes()
+    col.save()
+    return col
+
+# Benchmarks
+##########################################################################
+
+def benchIds(col):
+    "Literal IN lists vs ids bound through the temp table."
+    cids = col.db.list("select id from cards")
+    def literal():
+        return col.db.list(
+            "select nid from cards where id in " + ids2str(cids))
+    def bound():
+        with col.db.boundIds(cids) as scids:
+            return col.db.list("select nid from cards where id in " + scids)
+    timed("ids: select, literal (%d)" % len(cids), literal)
+    timed("ids: select, bound (%d)" % len(cids), bound)
+    timed("ids: updateFieldCache", col.updateFieldCache,
+          col.db.list("select id from notes"))
+    timed("ids: renderQA", col.renderQA, cids[:5000])
+
+def copyCol(col, **kwargs):
+    "Open a copy of COL's committed state, passing KWARGS to Collection()."
+    (fd, path) = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    # col holds a write lock, so read through a separate connection
+    src = sqlite3.connect(col.path)
+    dst = sqlite3.connect(path)
+    src.backup(dst)
+    src.close()
+    dst.close()
+    return Collection(path, **kwargs)
+
+def benchTuning(col):
+    "Review, search and sync workloads under each tuning profile."
+    col.save()
+    for name in sorted(tuningProfiles):
+        c = copyCol(col, tuning=name)
+        def review():
+            c.sched.reset()
+            for i in range(200):
+                card = c.sched.getCard()
+                if not card:
+                    break
+                c.sched.answerCard(card, 3)
+            c.save()
+        def search():
+            for q in ("alpha", "tag:tag1*", "is:due", "front:beta*",
+                      "-is:new alpha or gamma"):
+                c.findCards(q, order=True)
+        def sync():
+            # roughly what a full sync does: gather changes and bump usns
+            for t in "notes", "cards":
+                c.db.all("select * from %s where usn = -1" % t)
+                c.db.execute("update %s set usn = 1 where usn = -1" % t)
+            c.save()
+        timed("tuning %s: review" % name, review)
+        timed("tuning %s: search" % name, search)
+        timed("tuning %s: sync" % name, sync)
+        path = c.path
+        c.close()
+        os.unlink(path)
+
+def benchText(col):
+    "Unqualified text searches with and without the trigram index."
+    # the index only helps terms that match few notes
+    queries = ("12345", "alpha 4242", "gam*a 777", "9999*")
+    def search():
+        for q in queries:
+            col.findCards(q)
+    timed("text: search, like", search)
+    if not timed("text: build index", col.indexes.enable, "text"):
+        print("text: sqlite lacks fts5 trigram support")
+        return
+    timed("text: search, indexed", search)
+    col.indexes.disable("text")
+
+def benchFields(col):
+    "Field searches and duplicate finding with and without the field index."
+    from anki.find import findDupes
+    queries = ("front:alpha*", "front:beta 123", "back:*zeta")
+    def search():
+        for q in queries:
+            col.findCards(q)
+    timed("fields: search, scan", search)
+    timed("fields: findDupes, scan", findDupes, col, "Back")
+    timed("fields: build index", col.indexes.enable, "fields")
+    timed("fields: search, indexed", search)
+    timed("fields: findDupes, indexed", findDupes, col, "Back")
+    col.indexes.disable("fields")
+
+def benchRegex(col):
+    "Regex searches, and find and replace that matches few notes."
+    nids = col.db.list("select id from notes")
+    for q in ("re:^alpha 1\\d$", "front:re:^zeta 9+$", "back:re:a\\b"):
+        timed("regex: %s" % q, col.findCards, q)
+    timed("regex: findReplace", col.findReplace, nids, "^eta 12345$",
+          "eta", True)
+
+def benchSaved(col):
+    "Opening saved searches with and without materializing them."
+    queries = ("tag:tag7 -is:suspended", "front:alpha* is:review",
+               "-tag:tag1 prop:ivl>100")
+    def open():
+        for q in queries:
+            col.find.pagedCards(q, order=True)
+            col.find._results.clear()
+    timed("saved: open, plain", open)
+    for c, q in enumerate(queries):
+        col.find.materialize("q%d" % c, q)
+    timed("saved: first open, materialized", open)
+    timed("saved: open, materialized", open)
+    nids = col.db.list("select id from notes limit 100")
+    col.tags.bulkAdd(nids, "tag7")
+    timed("saved: open after editing 100 notes", open)
+    timed("saved: save, updating them", col.save)
+    timed("saved: open after saving", open)
+    for c in range(len(queries)):
+        col.find.dematerialize("q%d" % c)
+
+def benchLoad(col):
+    "Loading card and note objects one at a time vs in bulk."
+    import tracemalloc
+    cids = col.db.list("select id from cards")
+    nids = col.db.list("select id from notes")
+    def run(label, fn):
+        timed("load: %s" % label, fn)
+        # separately, as tracing slows things down
+        tracemalloc.start()
+        fn()
+        print("%-40s %8.1fMB" % ("load: %s, peak memory" % label,
+                                 tracemalloc.get_traced_memory()[1]/1e6))
+        tracemalloc.stop()
+    run("getCard each", lambda: [col.getCard(id) for id in cids])
+    run("getCards", lambda: col.getCards(cids))
+    run("getNote each", lambda: [col.getNote(id) for id in nids])
+    run("getNotes", lambda: col.getNotes(nids))
+
+def benchAdd(col):
+    "Notes per second added and updated one at a time vs in bulk."
+    count = 5000
+    def make(label):
+        notes = []
+        for i in range(count):
+            f = col.newNote()
+            f['Front'] = "%s %d" % (label, i)
+            f['Back'] = "back"
+            f.tags = ["bench"]
+            notes.append(f)
+        return notes
+    def rate(label, fn, notes):
+        t = time.time()
+        fn(notes)
+        print("%-40s %8.0f notes/s" % (label, count/(time.time() - t)))
+    def each(notes):
+        for f in notes:
+            # new notes share ids until flushed
+            f.id = timestampID(col.db, "notes")
+            col.addNote(f)
+    rate("add: addNote each", each, make("each"))
+    notes = make("bulk")
+    rate("add: addNotes", col.addNotes, notes)
+    for f in notes:
+        f['Back'] = "changed"
+    def flush(notes):
+        for f in notes:
+            f.flush()
+    rate("add: flush each", flush, notes)
+    for f in notes:
+        f['Back'] = "changed again"
+    rate("add: updateNotes", col.updateNotes, notes)
+    col.remNotes(col.findNotes("tag:bench"))
+
+def benchEmpty(col):
+    "Checking for empty cards per note type vs with the streaming engine."
+    def perModel():
+        rem = []
+        for m in col.models.all():
+            rem += col.genCards(col.models.nids(m))
+        return rem
+    timed("empty: genCards per note type", perModel)
+    gen = col.cardgen
+    timed("empty: engine, first run", gen.generate)
+    timed("empty: engine, unchanged notes", gen.generate)
+    nids = col.db.list("select id from notes limit 1000")
+    col.db.execute("update notes set mod = mod + 1 where id in %s" %
+                   ids2str(nids))
+    timed("empty: engine, 1000 notes edited", gen.generate)
+    for workers in (2, 4):
+        gen.reset()
+        timed("empty: engine, %d workers" % workers, gen.generate,
+              None, workers)
+
+def benchQA(col):
+    "Repainting the browser's question column with and without the cache."
+    cids = col.db.list("select id from cards limit 500")
+    cache = col.qaCache
+    def paint(times=5):
+        for i in range(times):
+            for c in col.getCards(cids, notes=True):
+                c.q(browser=True)
+    size = cache.cacheSize
+    cache.cacheSize = 0
+    timed("qa: 5 paints, no cache", paint)
+    cache.cacheSize = size
+    timed("qa: 5 paints, cached", paint)
+    print("qa: hit rate %0.2f" % cache.stats()['hitRate'])
+    col.indexes.enable("qa")
+    cache.clear()
+    timed("qa: 1 paint, saving to index", paint, 1)
+    cache._cache.clear()
+    timed("qa: 1 paint, loading from index", paint, 1)
+    col.indexes.disable("qa")
+
+def benchRender(col):
+    "Rendering with the search-and-replace Template vs compiled templates."
+    from anki.template import Template, compiled
+    # a cloze note type too, as its templates are munged per card
+    current = col.models.current()
+    col.models.setCurrent(col.models.byName("Cloze"))
+    notes = []
+    for i in range(2000):
+        f = col.newNote(forDeck=False)
+        f.fields = ["{{c1::alpha}} %d {{c2::beta}}" % i, "extra"]
+        notes.append(f)
+    col.addNotes(notes)
+    col.models.setCurrent(current)
+    cids = col.db.list("select id from cards limit 20000")
+    # and a more involved template
+    basic = col.models.byName("Basic")
+    t = basic['tmpls'][0]
+    old = t['qfmt']
+    t['qfmt'] = ("{{#Front}}<div class=front>{{Front}}</div>{{/Front}}"
+                 "{{^Back}}<i>no back</i>{{/Back}}{{text:Back}}"
+                 "{{#Tags}}<div class=tags>{{Tags}}</div>{{/Tags}}"
+                 "<div>{{Deck}} / {{Subdeck}} / {{Card}} / {{Type}}</div>")
+    ctx = dict(Front="front <b>text</b>", Back="", Tags="tag1 tag2",
+               Deck="Default", Subdeck="Default", Card="Card 1", Type="Basic")
+    def engine(fn):
+        for i in range(20000):
+            fn(t['qfmt'], ctx)
+    timed("render: 20000 renders, Template",
+          engine, lambda tmpl, ctx: Template(tmpl, ctx).render())
+    timed("render: 20000 renders, compiled", engine, compiled.render)
+    fast = compiled.render
+    compiled.render = lambda tmpl, ctx: Template(tmpl, ctx).render()
+    timed("render: renderQA, Template (%d)" % len(cids), col.renderQA, cids)
+    compiled.render = fast
+    timed("render: renderQA, compiled", col.renderQA, cids)
+    t['qfmt'] = old
+
+def benchParallel(col):
+    "Rendering every card in this process vs across worker processes."
+    # LaTeX's filter keeps full renders in this process, so as text
+    def run(workers):
+        for d in col.renderQAIter(type="all", workers=workers, textOnly=True):
+            pass
+    count = col.cardCount()
+    timed("parallel: %d cards, serial" % count, run, 0)
+    for workers in (2, 4):
+        timed("parallel: %d workers" % workers, run, workers)
+
+def benchPlain(col):
+    "Browser question/answer columns rendered in full vs as plain text."
+    from anki.utils import htmlToTextLine
+    cids = col.db.list("select id from cards limit 20000")
+    cache = col.qaCache
+    size = cache.cacheSize
+    cache.cacheSize = 0
+    def full():
+        for c in col.getCards(cids, notes=True):
+            htmlToTextLine(c.q(browser=True))
+            htmlToTextLine(c.a())
+    def plain():
+        for c in col.getCards(cids, notes=True):
+            c.q(browser=True, textOnly=True)
+            c.a(textOnly=True)
+    timed("plain: %d cards, full render" % len(cids), full)
+    timed("plain: %d cards, text only" % len(cids), plain)
+    timed("plain: renderQA, full", col.renderQA, cids)
+    timed("plain: renderQA, text only", col.renderQA, cids, "card", True)
+    cache.cacheSize = size
+
+def benchUndo(col):
+    "Undoing a bulk op by rollback + reload vs from the row journal."
+    cids = col.db.list("select id from cards limit 10000")
+    col.save("Suspend")
+    timed("undo: suspend %d cards, journaled" % len(cids),
+          col.sched.suspendCards, cids)
+    timed("undo: undo from journal", col.undo)
+    timed("undo: redo from journal", col.redo)
+    col.sched.unsuspendCards(cids)
+    col.save()
+    col.clearUndo()
+    timed("undo: suspend %d cards, not journaled" % len(cids),
+          col.sched.suspendCards, cids)
+    timed("undo: rollback + load", col.rollback)
+    # a review, with the registries much as usual
+    col.reset()
+    c = col.sched.getCard()
+    col.sched.answerCard(c, 3)
+    timed("undo: undo a review", col.undo)
+    col.clearUndo()
+
+def benchCheck(col):
+    "Check Database, with and without the optimize step, by phase."
+    for optimize in (False, True):
+        label = "optimize" if optimize else "no optimize"
+        timed("check: fixIntegrity, %s" % label, col.fixIntegrity,
+              None, optimize)
+        for phase, secs in col.dbcheck.timings:
+            print("check:   %-33s %7.1fms" % (phase, secs*1000))
+
+def benchTags(col):
+    "Tag searches, bulk edits and registry rebuilds, with and without index."
+    nids = col.db.list("select id from notes")[::10]
+    def run(label):
+        for q in ("tag:tag7", "tag:tag4*", "-tag:tag1"):
+            timed("tags: %s, %s" % (q, label), col.findCards, q)
+        timed("tags: bulk add, %s" % label,
+              col.tags.bulkAdd, nids, "new" + label)
+        timed("tags: bulk remove, %s" % label,
+              col.tags.bulkRem, nids, "new" + label)
+        timed("tags: registerNotes, %s" % label, col.tags.registerNotes)
+        timed("tags: byDeck, %s" % label, col.tags.byDeck, 1)
+    run("scan")
+    timed("tags: build index", col.indexes.enable, "tags")
+    run("indexed")
+    col.indexes.disable("tags")
+
+def benchPaging(col):
+    "Full browser searches vs the first page plus a count."
+    for sort in ("noteCrt", "noteFld", "cardDue"):
+        col.conf['sortType'] = sort
+        timed("paging: %s, findCards" % sort, col.findCards, "", True)
+        def firstPage():
+            p = col.find.pagedCards("", order=True)
+            return p[0], len(p)
+        timed("paging: %s, first page + count" % sort, firstPage)
+    col.conf['sortType'] = "noteFld"
+
+def benchRated(col):
+    "Rated searches against the revlog and the per-card rollup."
+    # a year of history, ten reviews per card
+    cids = col.db.list("select id from cards")
+    start = (col.sched.dayCutoff - 86400*365)*1000
+    col.db.executemany(
+        "insert or ignore into revlog values (?,?,0,?,0,0,0,0,0)",
+        ((start + random.randrange(86400*365*1000), cid, random.randint(1, 4))
+         for cid in cids for i in range(10)))
+    col.save()
+    def run(label):
+        for q in ("rated:1", "rated:30", "rated:30:1", "rated:365"):
+            timed("rated: %s, %s" % (q, label), col.findCards, q)
+    run("revlog")
+    timed("rated: build index", col.indexes.enable, "rated")
+    run("indexed")
+    timed("rated: log 1000 reviews", col.db.executemany,
+          "insert into revlog values (?,?,0,3,0,0,0,0,0)",
+          ((col.sched.dayCutoff*1000 + i, cid)
+           for i, cid in enumerate(cids[:1000])))
+    col.indexes.disable("rated")
+    col.db.execute("delete from revlog")
+
+benchmarks = [
+    ("ids", benchIds),
+    ("tuning", benchTuning),
+    ("text", benchText),
+    ("fields", benchFields),
+    ("regex", benchRegex),
+    ("tags", benchTags),
+    ("saved", benchSaved),
+    ("load", benchLoad),
+    ("add", benchAdd),
+    ("empty", benchEmpty),
+    ("qa", benchQA),
+    ("render", benchRender),
+    ("parallel", benchParallel),
+    ("plain", benchPlain),
+    ("undo", benchUndo),
+    ("check", benchCheck),
+    ("paging", benchPaging),
+    ("rated", benchRated),
+]
+
+def main():
+    only = sys.argv[1:]
+    count = int(os.environ.get("notes", 100000))
+    col = timed("build %d notes" % count, buildCol, count)
+    try:
+        for name, fn in benchmarks:
+            if only and name not in only:
+                continue
+            fn(col)
+            col.save()
+    finally:
+        path = col.path
+        col.close()
+        os.unlink(path)
+        if os.path.exists(col.indexes.path):
+            os.unlink(col.indexes.path)
+
+if __name__ == "__main__":
+    main()